@@ -0,0 +1,71 @@
+from collections import defaultdict
+import threading
+import time
+
+
+class AccessCache():
+    # Remembers access decisions for a short time, keyed by
+    # (session key, study, run id).
+    # Entries are dropped when their session is revoked or their study's run
+    # ends, and expire after ttl seconds regardless. A decision that was
+    # being worked out while an invalidation happened is not stored.
+
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # key -> (expiry time, decision)
+        self.decisions = {}
+        # Keys by session key and by study, so invalidating one only
+        # touches its own entries
+        self.session_keys = defaultdict(set)
+        self.study_keys = defaultdict(set)
+        # Bumped on every invalidation
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        # Returns None if there is no current decision
+        entry = self.decisions.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def put(self, key, decision, generation):
+        # generation: the value of self.generation before the decision was
+        # worked out
+        with self.lock:
+            if generation != self.generation:
+                return
+            if len(self.decisions) >= self.max_entries:
+                now = time.monotonic()
+                for k in [k for k, entry in self.decisions.items()
+                        if entry[0] < now]:
+                    self.remove(k)
+                if len(self.decisions) >= self.max_entries:
+                    self.decisions.clear()
+                    self.session_keys.clear()
+                    self.study_keys.clear()
+            self.decisions[key] = (time.monotonic() + self.ttl, decision)
+            self.session_keys[key[0]].add(key)
+            self.study_keys[key[1]].add(key)
+
+    def remove(self, key):
+        del self.decisions[key]
+        for (index, index_key) in [
+                (self.session_keys, key[0]), (self.study_keys, key[1])]:
+            keys = index[index_key]
+            keys.discard(key)
+            if len(keys) == 0:
+                del index[index_key]
+
+    def invalidate(self, index, index_key):
+        with self.lock:
+            self.generation += 1
+            for key in list(index.get(index_key, ())):
+                self.remove(key)
+
+    def invalidate_session(self, session_key):
+        self.invalidate(self.session_keys, session_key)
+
+    def invalidate_study(self, study):
+        self.invalidate(self.study_keys, study)
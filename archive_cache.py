@@ -0,0 +1,201 @@
+import glob
+import itertools
+import json
+import os
+import stat
+import threading
+import time
+from collections import defaultdict
+from data_archive import scan_files, generate_tar_members, tar_end, \
+    make_compressor, gzip_member, compress_stream, ARCHIVE_READ_SIZE
+from journal import write_file_atomic
+from logger import log
+
+
+class ArchiveCache():
+    # Keeps the latest .tar.gz of each study's data, so downloads of
+    # unchanged data are served from disk, and new files are added to the
+    # cached archive instead of compressing everything again.
+    # A cached archive is a series of gzip members holding tar members, with
+    # no end of archive marker; that is sent as one more gzip member after
+    # it. Its index records which files (by size and mtime) it holds.
+    # The least recently used archives are evicted beyond max_bytes.
+
+    def __init__(self, cache_path, max_bytes):
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        os.makedirs(cache_path, exist_ok=True)
+        for temp_path in glob.glob(os.path.join(cache_path, '*.tmp')):
+            os.remove(temp_path)
+        # key -> index
+        self.indexes = {}
+        for index_path in glob.glob(os.path.join(cache_path, '*.json')):
+            key = os.path.basename(index_path)[:-len('.json')]
+            try:
+                with open(index_path) as f:
+                    self.indexes[key] = json.load(f)
+            except ValueError:
+                os.remove(index_path)
+        # Numbers temporary files; concurrent builds each write their own
+        self.build_count = itertools.count()
+        self.lock = threading.Lock()
+        # Held while changing a key's archive
+        self.key_locks = defaultdict(threading.Lock)
+
+    def get_archive_path(self, key):
+        return os.path.join(self.cache_path, key + '.tar.gz')
+
+    def get_index_path(self, key):
+        return os.path.join(self.cache_path, key + '.json')
+
+    def get_key_lock(self, key):
+        with self.lock:
+            return self.key_locks[key]
+
+    def get_archive(self, key, source_path):
+        # Returns a generator of source_path's contents as .tar.gz chunks
+        entries = scan_files(source_path)
+        with self.get_key_lock(key):
+            index = self.indexes.get(key)
+            new_entries = None
+            if index is not None:
+                new_entries = self.get_new_entries(index, entries)
+            if new_entries is not None:
+                if len(new_entries) > 0:
+                    log('Adding {} files to cached archive'.format(
+                        len(new_entries)), key=key)
+                    self.append(key, index, new_entries)
+                index['last_used'] = time.time()
+                self.save_index(key)
+                # Opened now, so later changes don't affect this download
+                f = open(self.get_archive_path(key), 'rb')
+                response = self.send(f, index['body_size'], index['tar_size'])
+            else:
+                response = None
+        if response is not None:
+            self.evict(keep=key)
+            return response
+        log('Building archive', key=key)
+        return self.build(key, entries)
+
+    def get_new_entries(self, index, entries):
+        # Entries not in the cached archive, or None if it has files that
+        # have since changed or disappeared
+        current = {name: stat_result for (_, name, stat_result) in entries}
+        for (name, (size, mtime)) in index['files'].items():
+            stat_result = current.get(name)
+            if stat_result is None or stat_result.st_size != size or \
+                    stat_result.st_mtime_ns != mtime:
+                return None
+        for name in index['dirs']:
+            if name not in current:
+                return None
+        return [
+            entry for entry in entries
+                if entry[1] not in index['files'] and
+                    entry[1] not in index['dirs']
+        ]
+
+    def record_entries(self, index, entries):
+        dirs = set(index['dirs'])
+        for (_, name, stat_result) in entries:
+            if stat.S_ISDIR(stat_result.st_mode):
+                dirs.add(name)
+            else:
+                index['files'][name] = [
+                    stat_result.st_size, stat_result.st_mtime_ns
+                ]
+        index['dirs'] = sorted(dirs)
+
+    def append(self, key, index, entries):
+        with open(self.get_archive_path(key), 'r+b') as f:
+            # Drop anything left by an interrupted append
+            f.truncate(index['body_size'])
+            f.seek(index['body_size'])
+            compressor = make_compressor()
+            for data in generate_tar_members(entries):
+                index['tar_size'] += len(data)
+                f.write(compressor.compress(data))
+            f.write(compressor.flush())
+            index['body_size'] = f.tell()
+        self.record_entries(index, entries)
+
+    def send(self, f, body_size, tar_size):
+        with f:
+            remaining = body_size
+            while remaining > 0:
+                data = f.read(min(ARCHIVE_READ_SIZE, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+        yield gzip_member(tar_end(tar_size))
+
+    def build(self, key, entries):
+        # Sends a new archive while writing it to the cache
+        archive_path = self.get_archive_path(key)
+        temp_path = '{}.{}.tmp'.format(archive_path, next(self.build_count))
+        sizes = []
+        def count_members():
+            size = 0
+            for data in generate_tar_members(entries):
+                size += len(data)
+                yield data
+            sizes.append(size)
+        try:
+            with open(temp_path, 'wb') as f:
+                for compressed in compress_stream(
+                        count_members(), sync_first=True):
+                    f.write(compressed)
+                    yield compressed
+                body_size = f.tell()
+            tar_size = sizes[0]
+            index = {
+                'files': {},
+                'dirs': [],
+                'tar_size': tar_size,
+                'body_size': body_size,
+                'last_used': time.time()
+            }
+            self.record_entries(index, entries)
+            with self.get_key_lock(key):
+                os.replace(temp_path, archive_path)
+                self.indexes[key] = index
+                self.save_index(key)
+            self.evict(keep=key)
+            yield gzip_member(tar_end(tar_size))
+        finally:
+            # Only left if the download stopped early
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def save_index(self, key):
+        write_file_atomic(
+            self.get_index_path(key), json.dumps(self.indexes[key]))
+
+    def remove(self, key):
+        # Call with the key's lock held
+        self.indexes.pop(key, None)
+        for path in [self.get_index_path(key), self.get_archive_path(key)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def discard(self, key):
+        with self.get_key_lock(key):
+            self.remove(key)
+
+    def evict(self, keep=None):
+        while True:
+            with self.lock:
+                total = sum(
+                    index['body_size'] for index in self.indexes.values())
+                candidates = [
+                    (index['last_used'], key)
+                        for (key, index) in self.indexes.items()
+                            if key != keep
+                ]
+            if total <= self.max_bytes or len(candidates) == 0:
+                return
+            (_, key) = min(candidates)
+            log('Evicting cached archive', key=key)
+            self.discard(key)
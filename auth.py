@@ -1,8 +1,9 @@
 from collections import defaultdict
 from datetime import datetime, timedelta
-from flask import session
+from flask import session, has_request_context
 import json
 import secrets
+import threading
 
 class Lockout(Exception):
     pass
@@ -14,7 +15,8 @@ class SimpleSessionAuth():
     def __init__(self,
             users,
             timeout_attempts=None,
-            timeout_duration=timedelta(minutes=10)):
+            timeout_duration=timedelta(minutes=10),
+            on_revoke=None):
         self.sessions = {}
         self.users = users
         self.user_sessions = defaultdict(set)
@@ -24,25 +26,38 @@ class SimpleSessionAuth():
         self.timeouts = {}
         # Randomly pick an auth key variable name
         self.auth_name = secrets.token_urlsafe()
+        # Guards users and sessions; lookups of a single key are unlocked
+        self.lock = threading.RLock()
+        # Called with each session key that is revoked
+        self.on_revoke = on_revoke
 
     def add_auth(self, user):
         key = secrets.token_urlsafe()
         #TODO: store login time & track expiry
         #TODO: store login IP
-        self.sessions[key] = {
-            'user': user
-        }
-        self.sessions[key].update(self.users[user].get('permissions', {}))
-        self.user_sessions[user].add(key)
+        with self.lock:
+            self.sessions[key] = {
+                'user': user
+            }
+            self.sessions[key].update(self.users[user].get('permissions', {}))
+            self.user_sessions[user].add(key)
         session[self.auth_name] = key
         return key
 
     def revoke_auth(self, key):
         if key is not None:
-            # remove key from list of sessions logged into user
-            self.user_sessions[self.sessions[key]['user']].remove(key)
-            del self.sessions[key]
-            session.pop(self.auth_name, None)
+            with self.lock:
+                if key in self.sessions:
+                    # remove key from list of sessions logged into user
+                    self.user_sessions[self.sessions[key]['user']].discard(key)
+                    del self.sessions[key]
+            if self.on_revoke is not None:
+                self.on_revoke(key)
+            # Keys can be revoked from other users' requests, or from
+            # background threads (e.g. expiring invite codes)
+            if has_request_context() and \
+                    session.get(self.auth_name, None) == key:
+                session.pop(self.auth_name, None)
 
     def get_session_key(self):
         return session.get(self.auth_name, None)
@@ -52,14 +67,14 @@ class SimpleSessionAuth():
 
     def is_session_authenticated(self, permission_fn=None):
         key = self.get_session_key()
-        if key is not None and key not in self.sessions:
+        auth = self.sessions.get(key) if key is not None else None
+        if key is not None and auth is None:
             self.revoke_auth(key)
             key = None
         if key is None:
             return False
         if permission_fn is None:
             return True
-        auth = self.sessions[key]
         return permission_fn(auth)
 
     def user_can_login(self, user):
@@ -75,10 +90,11 @@ class SimpleSessionAuth():
         return True
 
     def check_add_auth(self, user):
-        if user not in self.users:
-            return False
-        self.add_auth(user)
-        return True
+        with self.lock:
+            if user not in self.users:
+                return False
+            self.add_auth(user)
+            return True
 
     def authenticate(self, user, password):
         # Log out if logged in
@@ -92,11 +108,12 @@ class SimpleSessionAuth():
                 self.timeout_attempts[user] = 0
             return True
         if self.max_attempts is not None:
-            self.timeout_attempts[user] += 1
-            if self.timeout_attempts[user] == self.max_attempts:
-                self.timeouts[user] = datetime.now()
-                self.timeout_attempts[user] = 0
-                raise Lockout()
+            with self.lock:
+                self.timeout_attempts[user] += 1
+                if self.timeout_attempts[user] == self.max_attempts:
+                    self.timeouts[user] = datetime.now()
+                    self.timeout_attempts[user] = 0
+                    raise Lockout()
 
         return False
 
@@ -110,37 +127,61 @@ class SimpleSessionAuth():
             return None
 
     def create_user(self, name, properties=None):
-        if name in self.users:
-            raise ValueError('User already exists')
-        self.users[name] = {}
+        user = {}
         if properties is not None:
-            self.users[name].update(properties)
-        self.users[name]['created_time'] = datetime.now()
+            user.update(properties)
+        user['created_time'] = datetime.now()
+        with self.lock:
+            if name in self.users:
+                raise ValueError('User already exists')
+            self.users[name] = user
 
     def create_temporary_user(
             self, name=None, properties=None, readable_name=False, name_bytes=16):
-        if name in self.users:
-            raise ValueError('User already exists')
-        while name is None or name in self.users:
-            if readable_name:
-                name = secrets.token_hex(name_bytes)
-            else:
-                name = secrets.token_urlsafe(name_bytes)
         props = {}
         if properties is not None:
             props.update(properties)
-        self.create_user(name, properties=props)
+        with self.lock:
+            if name in self.users:
+                raise ValueError('User already exists')
+            while name is None or name in self.users:
+                if readable_name:
+                    name = secrets.token_hex(name_bytes)
+                else:
+                    name = secrets.token_urlsafe(name_bytes)
+            self.create_user(name, properties=props)
         return name
 
+    def create_temporary_users(
+            self, count, properties=None, readable_name=False, name_bytes=16):
+        # Like create_temporary_user, for count users added in one go
+        make_name = secrets.token_hex if readable_name else \
+            secrets.token_urlsafe
+        created_time = datetime.now()
+        names = {}
+        with self.lock:
+            while len(names) < count:
+                name = make_name(name_bytes)
+                if name not in self.users:
+                    names[name] = None
+            for name in names:
+                user = {}
+                if properties is not None:
+                    user.update(properties)
+                user['created_time'] = created_time
+                self.users[name] = user
+        return list(names)
+
     def delete_user(self, user):
-        if user not in self.users:
-            raise ValueError('User does not exist')
-        # revoke_auth changes size of the user sessions list;
-        # iterate over a copy instead
-        for key in list(self.user_sessions[user]):
-            self.revoke_auth(key)
-        del self.users[user]
-        del self.user_sessions[user]
+        with self.lock:
+            if user not in self.users:
+                raise ValueError('User does not exist')
+            # revoke_auth changes size of the user sessions list;
+            # iterate over a copy instead
+            for key in list(self.user_sessions[user]):
+                self.revoke_auth(key)
+            del self.users[user]
+            del self.user_sessions[user]
 
     def revoke_session_key_if_temporary(self):
         auth_user = self.get_authed_user()
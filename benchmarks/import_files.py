@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# Time to stage a generated study of many resource files with
+# import_study.stage_study, receiving, hashing and linking them one at a time
+# (IMPORT_WORKERS = 1) compared with the default pool of workers.
+#   ./benchmarks/import_files.py [files] [KB per file] [workers]
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import import_study
+from blob_store import BlobStore
+
+STUDY = 'bench'
+
+
+def generate_study(directory, num_files, file_size):
+    # Upload streams are spooled to disk by werkzeug, so the generated
+    # files are read from disk too
+    os.makedirs(directory)
+    with open(os.path.join(directory, 'exp.js'), 'w') as f:
+        f.write('psychoJS.start({expName, expInfo});\n')
+    for i in range(num_files):
+        with open(os.path.join(directory, '{}.png'.format(i)), 'wb') as f:
+            f.write(os.urandom(file_size))
+
+def open_study_files(directory):
+    study_files = []
+    for name in sorted(os.listdir(directory)):
+        path = 'html/' + name if name.endswith('.js') else \
+            'html/resources/' + name
+        study_files.append({
+            'path': path,
+            'name': path[len('html/'):].replace('/', '_'),
+            'stream': open(os.path.join(directory, name), 'rb')
+        })
+    return study_files
+
+def measure(directory, path_root, workers):
+    # (seconds, CPU seconds) to stage the study into an empty blob store
+    shutil.rmtree(path_root, ignore_errors=True)
+    os.makedirs(path_root)
+    blob_store = BlobStore(os.path.join(path_root, '.blobs'))
+    study_files = open_study_files(directory)
+    import_study.IMPORT_WORKERS = workers
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        import_study.stage_study(STUDY, study_files, path_root, blob_store)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    for f in study_files:
+        f['stream'].close()
+    return (elapsed, cpu)
+
+def main():
+    num_files = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    file_size = int(sys.argv[2]) * 1024 if len(sys.argv) > 2 else 64 * 1024
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else \
+        import_study.IMPORT_WORKERS
+    root = tempfile.mkdtemp()
+    try:
+        directory = os.path.join(root, 'upload')
+        generate_study(directory, num_files, file_size)
+        print('{} files of {} KB'.format(num_files, file_size // 1024))
+        for (name, n) in [('sequential', 1),
+                ('pooled, {} workers'.format(workers), workers)]:
+            (elapsed, cpu) = measure(directory, os.path.join(root, 'study'), n)
+            print('{:24} {:8.2f} s {:8.0f} files/s {:8.2f} s CPU'.format(
+                name, elapsed, num_files / elapsed, cpu))
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
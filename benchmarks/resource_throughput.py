@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# Throughput and CPU cost of sending study resources with
+# resource_server.send_resource (byte ranges, WSGI file wrapper) compared
+# with Flask's send_from_directory, over a real waitress socket.
+#   ./benchmarks/resource_throughput.py [size in MB] [requests]
+import http.client
+import os
+import sys
+import tempfile
+import threading
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from flask import Flask, request, send_from_directory
+from waitress.server import create_server
+from resource_server import send_resource
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def make_app(directory):
+    app = Flask(__name__)
+    @app.route('/resource/<path:path>')
+    def resource(path):
+        return send_resource(request, directory, path)
+    @app.route('/flask/<path:path>')
+    def flask_file(path):
+        return send_from_directory(directory, path)
+    return app
+
+def fetch(port, path, headers={}):
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    connection.request('GET', path, headers=headers)
+    response = connection.getresponse()
+    size = 0
+    while True:
+        data = response.read(CHUNK_SIZE)
+        if not data:
+            break
+        size += len(data)
+    connection.close()
+    return size
+
+def measure(port, path, count, headers={}):
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    size = 0
+    for _ in range(count):
+        size += fetch(port, path, headers)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    return (size / elapsed / 1e6, cpu / count * 1000)
+
+def run_cases(directory, size_mb, count):
+    server = create_server(make_app(directory), host='127.0.0.1', port=0,
+        threads=4)
+    port = server.effective_port
+    threading.Thread(target=server.run, daemon=True).start()
+    half = size_mb * 1024 * 1024 // 2
+    cases = [
+        ('send_resource, whole file', '/resource/big.bin', {}),
+        ('send_from_directory, whole file', '/flask/big.bin', {}),
+        ('send_resource, second half', '/resource/big.bin',
+            {'Range': 'bytes={}-'.format(half)}),
+        ('send_resource, middle range', '/resource/big.bin',
+            {'Range': 'bytes=1000-{}'.format(half)}),
+        ('send_from_directory, second half', '/flask/big.bin',
+            {'Range': 'bytes={}-'.format(half)}),
+    ]
+    print('{} MB file, {} requests each (client and server in this '
+        'process)'.format(size_mb, count))
+    try:
+        for (name, path, headers) in cases:
+            fetch(port, path, headers)
+            (throughput, cpu_ms) = measure(port, path, count, headers)
+            print('{:36} {:8.0f} MB/s {:8.1f} ms CPU/request'.format(
+                name, throughput, cpu_ms))
+    finally:
+        server.close()
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, 'big.bin'), 'wb') as f:
+            for _ in range(size_mb):
+                f.write(os.urandom(1024 * 1024))
+        run_cases(directory, size_mb, count)
+
+if __name__ == '__main__':
+    main()
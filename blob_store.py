@@ -0,0 +1,101 @@
+import glob
+import hashlib
+import os
+import shutil
+import threading
+from logger import log
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class BlobStore():
+    # Content-addressed file store: each distinct file is kept once, as
+    # <root>/<first 2 hex digits>/<sha256>, and study resources are hard links
+    # to it. A blob whose only link is the store's own is unreferenced and is
+    # removed by collect_garbage().
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        # Left by an interrupted add()
+        for temp_path in glob.glob(os.path.join(root, '*', '*.tmp')):
+            os.remove(temp_path)
+        # Held while placing and linking a blob, so it can't be collected
+        # in between
+        self.lock = threading.Lock()
+
+    def get_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def add(self, source_path, dest_path, digest=None, move=False):
+        # Makes dest_path a link to the blob with source_path's contents,
+        # storing it first if it is new. Returns the blob's hash.
+        # With move=True, source_path is taken over (linked, not copied, if
+        # it is on the same filesystem) and removed.
+        if digest is None:
+            digest = hash_file(source_path)
+        blob_path = self.get_path(digest)
+        temp_path = None
+        if not os.path.exists(blob_path):
+            # Done outside the lock, so other files can be added meanwhile
+            temp_path = self.make_temp_copy(source_path, blob_path, move)
+        with self.lock:
+            if not os.path.exists(blob_path):
+                if temp_path is None:
+                    # Collected since it was checked
+                    temp_path = self.make_temp_copy(
+                        source_path, blob_path, move)
+                os.replace(temp_path, blob_path)
+            elif temp_path is not None:
+                # Added by another thread in the meantime
+                os.remove(temp_path)
+            try:
+                os.link(blob_path, dest_path)
+            except OSError:
+                # e.g. no hard links on this filesystem; keep a private copy
+                shutil.copyfile(blob_path, dest_path)
+        if move:
+            os.remove(source_path)
+        return digest
+
+    def make_temp_copy(self, source_path, blob_path, move):
+        # Temporary files are never collected, except at startup
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        temp_path = '{}.{}.tmp'.format(blob_path, threading.get_ident())
+        if move:
+            try:
+                os.link(source_path, temp_path)
+                return temp_path
+            except OSError:
+                pass
+        shutil.copyfile(source_path, temp_path)
+        return temp_path
+
+    def collect_garbage(self):
+        removed = 0
+        with self.lock:
+            for prefix in os.listdir(self.root):
+                prefix_path = os.path.join(self.root, prefix)
+                if not os.path.isdir(prefix_path):
+                    continue
+                for name in os.listdir(prefix_path):
+                    blob_path = os.path.join(prefix_path, name)
+                    if name.endswith('.tmp'):
+                        # Being added
+                        continue
+                    if os.stat(blob_path).st_nlink <= 1:
+                        os.remove(blob_path)
+                        removed += 1
+        if removed > 0:
+            log('Removed {} unused resource blobs'.format(removed))
@@ -0,0 +1,212 @@
+import heapq
+import itertools
+import json
+import random
+import threading
+
+# Session argument specs:
+#   value                 the same value for every session
+#   URL(param)            taken from the session's URL parameters
+#   uniform(a, b, ...)    balanced across sessions
+#   weighted(a:2, b:1)    balanced in proportion to the weights
+#   crossed(group, a, b)  balanced jointly with the other args in the same
+#                         group, over every combination of their values
+
+
+def parse_values(spec, prefix):
+    return [x.strip() for x in spec[len(prefix):-1].split(',')]
+
+def parse_weighted_values(spec):
+    values = []
+    weights = []
+    for item in parse_values(spec, 'weighted('):
+        (value, _, weight) = item.rpartition(':')
+        try:
+            weight = float(weight)
+            if weight <= 0:
+                raise ValueError()
+        except ValueError:
+            raise ValueError(
+                'Bad weight in "{}"; use weighted(value:weight, ...)'.format(
+                    spec))
+        values.append(value.strip())
+        weights.append(weight)
+    return (values, weights)
+
+
+class Design():
+    # One or more args assigned together from a fixed list of cells
+    # (combinations of values). Each assignment picks the cell with the
+    # fewest sessions relative to its weight, counting both completed and
+    # in-flight sessions. Cells live in a min-heap keyed on that load;
+    # stale entries are skipped on the way out.
+
+    def __init__(self, count_key, keys, cells, weights, counts):
+        # Completed sessions per cell are kept in counts[count_key]
+        self.count_key = count_key
+        self.keys = keys
+        self.cells = cells
+        self.weights = dict(zip(cells, weights))
+        self.counts = counts
+        self.reserved = {cell: 0 for cell in cells}
+        self.versions = {cell: 0 for cell in cells}
+        self.heap = []
+        for cell in cells:
+            self.push(cell)
+
+    def cell_id(self, cell):
+        if len(self.keys) == 1:
+            return cell[0]
+        return json.dumps(list(cell))
+
+    def get_completed(self, cell):
+        return self.counts.get(self.count_key, {}).get(self.cell_id(cell), 0)
+
+    def get_load(self, cell):
+        return (self.get_completed(cell) + self.reserved[cell]) / \
+            self.weights[cell]
+
+    def push(self, cell):
+        self.versions[cell] += 1
+        heapq.heappush(self.heap, (
+            self.get_load(cell),
+            random.random(), # random tie-break between equally loaded cells
+            self.versions[cell],
+            cell
+        ))
+        if len(self.heap) > 4 * len(self.cells):
+            # Drop stale entries
+            self.heap = [
+                entry for entry in self.heap
+                    if entry[2] == self.versions[entry[3]]
+            ]
+            heapq.heapify(self.heap)
+
+    def reserve(self):
+        while True:
+            (_, _, version, cell) = heapq.heappop(self.heap)
+            if version == self.versions[cell]:
+                break
+        self.reserved[cell] += 1
+        self.push(cell)
+        return cell
+
+    def release(self, cell, counted):
+        self.reserved[cell] -= 1
+        if counted and self.count_key not in self.keys:
+            # Args count their own values; crossed cells are counted here
+            cell_counts = self.counts.setdefault(self.count_key, {})
+            cell_id = self.cell_id(cell)
+            cell_counts[cell_id] = cell_counts.get(cell_id, 0) + 1
+        self.push(cell)
+
+
+class Counterbalancer():
+    # Resolves a run's session args for each new session.
+    # Arg specs are parsed once, when the run is created.
+    # counts: arg -> value -> number of completed sessions; shared with the
+    # run so it is saved along with it.
+
+    def __init__(self, session_args, counts):
+        self.counts = counts
+        self.arg_order = list(session_args)
+        self.in_flight = {}
+        # key -> values it can take, for balanced args
+        self.known_values = {}
+        self.lock = threading.Lock()
+        # (key, kind, value) for args that are not balanced
+        self.fixed_args = []
+        self.designs = []
+        crossed = {}
+        for key, spec in session_args.items():
+            if type(spec) is str and spec.endswith(')'):
+                if spec.startswith('URL('):
+                    self.fixed_args.append((key, 'url', spec[len('URL('):-1]))
+                    continue
+                elif spec.startswith('uniform('):
+                    values = parse_values(spec, 'uniform(')
+                    self.add_design(key, [key], [values], [1] * len(values))
+                    continue
+                elif spec.startswith('weighted('):
+                    (values, weights) = parse_weighted_values(spec)
+                    self.add_design(key, [key], [values], weights)
+                    continue
+                elif spec.startswith('crossed('):
+                    values = parse_values(spec, 'crossed(')
+                    if len(values) < 2:
+                        raise ValueError(
+                            'Use crossed(group, value, ...) for "{}"'.format(
+                                key))
+                    crossed.setdefault(values[0], []).append(
+                        (key, values[1:]))
+                    continue
+            self.fixed_args.append((key, 'value', spec))
+        for group, factors in crossed.items():
+            self.add_design(
+                'crossed({})'.format(group),
+                [key for (key, _) in factors],
+                [values for (_, values) in factors],
+                None
+            )
+
+    def add_design(self, count_key, keys, value_lists, weights):
+        for (key, values) in zip(keys, value_lists):
+            self.known_values[key] = values
+        cells = list(itertools.product(*value_lists))
+        if weights is None:
+            weights = [1] * len(cells)
+        self.designs.append(
+            Design(count_key, keys, cells, weights, self.counts))
+
+    def assign(self, params):
+        # Returns the session's args, and the reservations to hand back to
+        # release() when the session closes
+        args = {}
+        for (key, kind, value) in self.fixed_args:
+            if kind == 'url':
+                value = params.get(value)
+            if value is not None:
+                args[key] = value
+        with self.lock:
+            reservations = [
+                (design, design.reserve()) for design in self.designs
+            ]
+            for (design, cell) in reservations:
+                args.update(zip(design.keys, cell))
+            for key, value in args.items():
+                key_in_flight = self.in_flight.setdefault(key, {})
+                key_in_flight[value] = key_in_flight.get(value, 0) + 1
+        args = {key: args[key] for key in self.arg_order if key in args}
+        return (args, reservations)
+
+    def release(self, args, reservations, counted):
+        # Returns the keys of counts that changed
+        changed = set()
+        with self.lock:
+            for key, value in args.items():
+                self.in_flight[key][value] -= 1
+                if self.in_flight[key][value] == 0:
+                    del self.in_flight[key][value]
+                if counted:
+                    key_counts = self.counts.setdefault(key, {})
+                    key_counts[value] = key_counts.get(value, 0) + 1
+                    changed.add(key)
+            for (design, cell) in reservations:
+                design.release(cell, counted)
+                if counted:
+                    changed.add(design.count_key)
+        return changed
+
+    def get_counts(self, key):
+        # [(value, completed sessions, sessions in progress)]
+        with self.lock:
+            completed = self.counts.get(key, {})
+            in_flight = self.in_flight.get(key, {})
+            values = list(self.known_values.get(key, []))
+            for value in itertools.chain(completed, in_flight):
+                if value not in values:
+                    values.append(value)
+            return [
+                (value, completed.get(value, 0), in_flight.get(value, 0))
+                    for value in values
+            ]
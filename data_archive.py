@@ -0,0 +1,122 @@
+import os
+import stat
+import tarfile
+import zlib
+
+# Bytes read from each file at a time while archiving
+ARCHIVE_READ_SIZE = 256 * 1024
+ARCHIVE_COMPRESS_LEVEL = 6
+
+
+def scan_files(source_path):
+    # (path, archive name, stat result) for everything under source_path, in
+    # a stable order. Names starting with '.' (e.g. spooled, unfinished data)
+    # are skipped, as is anything other than files and directories.
+    entries = []
+    for (dirpath, dirnames, filenames) in os.walk(source_path):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        for name in dirnames + sorted(
+                f for f in filenames if not f.startswith('.')):
+            path = os.path.join(dirpath, name)
+            try:
+                stat_result = os.stat(path)
+            except FileNotFoundError:
+                # Removed since it was listed
+                continue
+            if stat.S_ISDIR(stat_result.st_mode) or \
+                    stat.S_ISREG(stat_result.st_mode):
+                entries.append((
+                    path,
+                    os.path.relpath(path, source_path).replace(os.sep, '/'),
+                    stat_result
+                ))
+    return entries
+
+def make_tar_info(name, stat_result):
+    info = tarfile.TarInfo(name)
+    info.mode = stat.S_IMODE(stat_result.st_mode)
+    info.mtime = int(stat_result.st_mtime)
+    if stat.S_ISDIR(stat_result.st_mode):
+        info.type = tarfile.DIRTYPE
+    else:
+        info.size = stat_result.st_size
+    return info
+
+def generate_tar_members(entries):
+    # Generates tar members (without the end of archive marker) for entries
+    # from scan_files(), in pieces of at most ARCHIVE_READ_SIZE bytes of file
+    # data. Files are archived at their scanned size.
+    for (path, name, stat_result) in entries:
+        info = make_tar_info(name, stat_result)
+        f = None
+        if info.isfile():
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                continue
+        yield info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+        if f is None:
+            continue
+        with f:
+            remaining = info.size
+            while remaining > 0:
+                data = f.read(min(ARCHIVE_READ_SIZE, remaining))
+                if not data:
+                    # Shrank since it was listed; keep the archive readable
+                    data = tarfile.NUL * min(ARCHIVE_READ_SIZE, remaining)
+                remaining -= len(data)
+                yield data
+        if info.size % tarfile.BLOCKSIZE != 0:
+            yield tarfile.NUL * (
+                tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)
+
+def tar_end(size):
+    # End of archive marker for a tar whose members take size bytes, filling
+    # up the last record
+    end = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+    size += len(end)
+    if size % tarfile.RECORDSIZE != 0:
+        end += tarfile.NUL * (tarfile.RECORDSIZE - size % tarfile.RECORDSIZE)
+    return end
+
+def make_compressor():
+    return zlib.compressobj(
+        ARCHIVE_COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def gzip_member(data):
+    compressor = make_compressor()
+    return compressor.compress(data) + compressor.flush()
+
+def compress_stream(pieces, sync_first=False):
+    # Generates one gzip member holding the pieces
+    compressor = make_compressor()
+    for data in pieces:
+        compressed = compressor.compress(data)
+        if sync_first:
+            # Get the download going right away
+            compressed += compressor.flush(zlib.Z_SYNC_FLUSH)
+            sync_first = False
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def stat_entries(source_path, names):
+    # Entries (as from scan_files()) for the given archive names; files that
+    # no longer exist are skipped
+    entries = []
+    for name in names:
+        path = os.path.join(source_path, *name.split('/'))
+        try:
+            stat_result = os.stat(path)
+        except FileNotFoundError:
+            continue
+        if stat.S_ISREG(stat_result.st_mode):
+            entries.append((path, name, stat_result))
+    return entries
+
+def generate_tar(entries):
+    size = 0
+    for data in generate_tar_members(entries):
+        size += len(data)
+        yield data
+    yield tar_end(size)
@@ -0,0 +1,183 @@
+import array
+import collections
+import mmap
+import os
+import threading
+
+# Lines shown per page when browsing a data file
+PAGE_LINES = 100
+# Data files whose line offsets are kept between requests
+MAX_LINE_INDEXES = 32
+
+
+def get_index_key(stat_result, records):
+    return (stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns,
+        records)
+
+
+class LineIndex():
+    # Start offsets of a file's lines, found as far as they have been asked
+    # for. Lines are read through mmap, so only the pages of the file up to
+    # the lines being viewed are touched.
+    # With records, a "line" is a CSV record: a newline inside a quoted
+    # value (an odd number of quotes so far in the record) doesn't end it.
+
+    def __init__(self, path, stat_result, records=False):
+        self.path = path
+        self.records = records
+        self.key = get_index_key(stat_result, records)
+        self.size = stat_result.st_size
+        self.offsets = array.array('Q', [0])
+        # Whether offsets reaches the end of the file
+        self.complete = self.size == 0
+        self.lock = threading.Lock()
+
+    def get_lines(self, start, count):
+        # Up to count lines (bytes, without line endings) starting at line
+        # start, and whether there are more after them
+        if self.size == 0:
+            return ([], False)
+        with open(self.path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            with self.lock:
+                self.find_lines(data, start + count + 1)
+                offsets = self.offsets[start:start + count + 1]
+                more = len(self.offsets) > start + count
+            starts = offsets[:count].tolist()
+            ends = offsets[1:count + 1].tolist()
+            if len(ends) < len(starts):
+                # The last line
+                ends.append(self.size)
+            lines = [
+                data[begin:end].rstrip(b'\r\n')
+                    for (begin, end) in zip(starts, ends)
+            ]
+            return (lines, more)
+
+    def find_lines(self, data, num_lines):
+        while not self.complete and len(self.offsets) < num_lines:
+            position = self.offsets[-1]
+            quoted = False
+            while True:
+                end = data.find(b'\n', position)
+                if end == -1 or end + 1 >= self.size:
+                    self.complete = True
+                    break
+                if self.records and data[position:end].count(b'"') % 2:
+                    quoted = not quoted
+                position = end + 1
+                if not quoted:
+                    self.offsets.append(position)
+                    break
+
+    def get_num_lines(self):
+        # None until the whole file has been indexed
+        if not self.complete:
+            return None
+        return len(self.offsets) if self.size > 0 else 0
+
+
+class LineIndexCache():
+    # The LineIndexes of recently viewed files; an index is dropped when its
+    # file changes
+
+    def __init__(self, max_entries=MAX_LINE_INDEXES):
+        self.max_entries = max_entries
+        self.indexes = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path, records=False):
+        stat_result = os.stat(path)
+        with self.lock:
+            index = self.indexes.pop(path, None)
+            if index is None or \
+                    index.key != get_index_key(stat_result, records):
+                index = LineIndex(path, stat_result, records=records)
+            self.indexes[path] = index
+            while len(self.indexes) > self.max_entries:
+                self.indexes.popitem(last=False)
+            return index
+
+
+class SessionIndex():
+    # Which data files each session of each run wrote, kept up to date from
+    # the study's write log (see write_log.py) rather than by listing data
+    # folders. Files written before there was a write log are found by
+    # listing their run's folder once, and listed under no session.
+
+    def __init__(self, write_log, data_path):
+        self.write_log = write_log
+        self.data_path = data_path
+        self.lock = threading.Lock()
+        # Write log records read so far
+        self.cursor = 0
+        # run id -> token -> file names (in the run's folder)
+        self.runs = collections.defaultdict(dict)
+        # run id -> all its file names
+        self.names = collections.defaultdict(set)
+        # Runs whose folder has been listed
+        self.listed_runs = set()
+
+    def update(self):
+        (records, cursor) = self.write_log.read(self.cursor)
+        for record in records:
+            name = record['file'].rpartition('/')[2]
+            sessions = self.runs[record['run']]
+            files = sessions.setdefault(record['token'], [])
+            if name not in files:
+                files.append(name)
+            self.names[record['run']].add(name)
+            # Found by listing the folder before it was logged
+            if name in sessions.get(None, []):
+                sessions[None].remove(name)
+        self.cursor = cursor
+
+    def get_run_ids(self):
+        run_ids = set()
+        for name in os.listdir(self.data_path):
+            (prefix, _, run_id) = name.partition('_')
+            if prefix == 'run' and run_id.isdigit():
+                run_ids.add(int(run_id))
+        with self.lock:
+            self.update()
+            run_ids.update(self.runs)
+        return sorted(run_ids)
+
+    def list_run(self, run_id):
+        # Call holding lock
+        if run_id in self.listed_runs:
+            return
+        self.listed_runs.add(run_id)
+        names = self.names[run_id]
+        unlogged = []
+        run_path = os.path.join(self.data_path, 'run_{}'.format(run_id))
+        if os.path.isdir(run_path):
+            unlogged = sorted(
+                entry.name for entry in os.scandir(run_path)
+                    if entry.is_file() and
+                        not entry.name.startswith('.') and
+                        entry.name not in names
+            )
+        if len(unlogged) > 0:
+            self.runs[run_id][None] = unlogged
+            names.update(unlogged)
+
+    def get_sessions(self, run_id):
+        # [(token, [file names])], in the order sessions started; token is
+        # None for files written before the write log
+        with self.lock:
+            self.update()
+            self.list_run(run_id)
+            sessions = self.runs[run_id]
+            return sorted(
+                ((token, list(files)) for (token, files) in sessions.items()),
+                key=lambda item: (item[0] is not None,
+                    int(item[0]) if item[0] and item[0].isdigit() else 0,
+                    item[0] or '')
+            )
+
+    def has_file(self, run_id, name):
+        with self.lock:
+            self.update()
+            self.list_run(run_id)
+            return name in self.names[run_id]
@@ -0,0 +1,78 @@
+import queue
+import threading
+import zlib
+from logger import log
+
+
+class DataWriter():
+    # Performs file writes off the request thread.
+    # Work is queued by key (e.g. the study id); all work for a key is
+    # handled by the same worker, so it happens in the order it was submitted.
+    # With no workers, work is done immediately on the calling thread.
+
+    def __init__(self, num_workers=4, max_pending=1000):
+        self.queues = [
+            queue.Queue(maxsize=max_pending) for _ in range(num_workers)
+        ]
+        self.workers = []
+        for q in self.queues:
+            worker = threading.Thread(target=self.work, args=(q,), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        self.stopped = False
+
+    def get_queue(self, key):
+        return self.queues[zlib.crc32(str(key).encode()) % len(self.queues)]
+
+    def submit(self, key, fn, *args, **kwargs):
+        if self.stopped or len(self.queues) == 0:
+            self.run_task(fn, args, kwargs)
+            return
+        # Blocks if the queue is full, applying back-pressure to requests
+        self.get_queue(key).put((fn, args, kwargs))
+
+    def run_task(self, fn, args, kwargs):
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            log('ERROR: write failed ({}: {})'.format(type(e).__name__, e))
+
+    def work(self, q):
+        while True:
+            task = q.get()
+            try:
+                if task is None:
+                    return
+                self.run_task(*task)
+            finally:
+                q.task_done()
+
+    def flush(self, key=None):
+        # Wait for all work submitted so far (for the given key, or for all
+        # keys) to finish
+        if self.stopped:
+            return
+        if key is None:
+            queues = self.queues
+        elif len(self.queues) > 0:
+            queues = [self.get_queue(key)]
+        else:
+            queues = []
+        events = []
+        for q in queues:
+            done = threading.Event()
+            q.put((done.set, (), {}))
+            events.append(done)
+        for done in events:
+            done.wait()
+
+    def shutdown(self):
+        if self.stopped:
+            return
+        log('Flushing pending writes...')
+        self.flush()
+        self.stopped = True
+        for q in self.queues:
+            q.put(None)
+        for worker in self.workers:
+            worker.join()
@@ -1,31 +1,117 @@
 import json
 from logger import log
 import os
-import tempfile
 from werkzeug.utils import secure_filename
-from import_study import import_study
+from import_study import stage_study, swap_in_study, clean_up_imports, \
+    compress_js
+from blob_store import BlobStore
+from archive_cache import ArchiveCache
+from data_archive import stat_entries, generate_tar, compress_stream
+from write_log import WriteLog
+from merged_data import MergedDataset, TOKEN_COLUMN, RUN_COLUMN
+from run_summary import RunSummary
+from data_browser import SessionIndex, LineIndexCache, PAGE_LINES
+import functools
+from data_writer import DataWriter
+from state_backend import JsonStateBackend, SERVER_KEY
+from flusher import FlushScheduler
+from expiry import ExpiryScheduler
+from collections import defaultdict
+import threading
 import datetime
 import shutil
-import subprocess
-from contextlib import contextmanager
 from dateutil.parser import parse as parse_datestr
 import urllib
-import random
+from counterbalance import Counterbalancer
 
 
 EXPERIMENT_SESSION_TIMEOUT = datetime.timedelta(hours=1)
+# Incoming session data is spooled here (relative to the run's data path)
+# until the session closes and the data is either kept or discarded
+SPOOL_DIR = '.spool'
+# Data and metadata files are written by a pool of background threads
+DATA_WRITER_THREADS = 4
+DATA_WRITER_MAX_PENDING = 1000
+# Queue key for server-wide (not study-specific) writes
+SERVER_WRITE_KEY = SERVER_KEY
+# Changed metadata is written at most once per interval (seconds)
+METADATA_FLUSH_INTERVAL = 2.0
+# Resource files shared between studies (see blob_store.py), under the
+# study path. Names starting with '.' are never studies.
+BLOB_DIR = '.blobs'
+# Cached data archives (see archive_cache.py), under the data path
+ARCHIVE_CACHE_DIR = '.archive_cache'
+ARCHIVE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+# Per-study record of written data files, and users' export cursors into it
+# (see write_log.py), in the study's data path
+WRITE_LOG_FILE = '.writes.log'
+EXPORT_CURSORS_FILE = '.export_cursors.json'
+# Each run's CSV data merged into one file (see merged_data.py), under
+# <study data path>/.merged/run_<id>; brought up to date at most once per
+# interval (seconds), or when downloaded
+MERGED_DATA_DIR = '.merged'
+MERGED_DATA_COMPACT_INTERVAL = 60.0
+# Running totals for the run_details page (see run_summary.py), beside the
+# run's merged data
+RUN_SUMMARY_FILE = 'summary.json'
+
+# Locking:
+# - Each study has a lock (PsychoJsExperiment.lock) guarding its run and
+#   sessions.
+# - The server's code_lock guards participant codes, their indexes and the
+#   user <-> session maps.
+# - Locks are taken in that order (study, then codes, then auth); never
+#   take a study lock while holding the code lock.
+# - Imports into a study (creating it or replacing its files) hold its
+#   import lock throughout, before any of the above; it is per study name,
+#   so it exists before the study does.
+# - Never wait on metadata flushes (sync_metadata, flush_writes) while
+#   holding a study lock; the flusher takes study locks to read metadata.
+# Single dict lookups are left unlocked.
+
+def write_spool(spool_path, key, value, log_fn=log):
+    os.makedirs(spool_path, exist_ok=True)
+    target_file = os.path.join(spool_path, key)
+    temp_file = target_file + '.tmp'
+    with open(temp_file, 'w') as f:
+        f.write(value)
+    os.replace(temp_file, target_file)
+    log_fn('Spooled {}'.format(key))
+
+def promote_spool(spool_path, data_path, log_fn=log, record_fn=None):
+    # record_fn: called with the keys written
+    if not os.path.isdir(spool_path):
+        return
+    keys = []
+    for key in os.listdir(spool_path):
+        if key.endswith('.tmp'):
+            continue
+        os.replace(
+            os.path.join(spool_path, key),
+            os.path.join(data_path, key)
+        )
+        log_fn('Wrote {}'.format(key))
+        keys.append(key)
+    if record_fn is not None and len(keys) > 0:
+        record_fn(keys)
+    shutil.rmtree(spool_path, ignore_errors=True)
 
 class ExperimentSession():
 
-    def __init__(self, run, token, data_path, session_args={}):
+    def __init__(self, run, token, data_path, session_args={},
+            reservations=[]):
         self.token = token
         self.run = run
         self.data_path = data_path
-        self.data = {}
+        self.spool_path = os.path.join(data_path, SPOOL_DIR, token)
         self.start_time = datetime.datetime.now()
         self.has_data = False
         self.is_complete = False
+        self.is_closed = False
         self.session_args = session_args
+        # Args assigned by the run, and their counterbalancing reservations
+        self.assigned_args = dict(session_args)
+        self.reservations = reservations
 
     def log(self, msg, **kwargs):
         self.run.log(msg, token=self.token, **kwargs)
@@ -42,35 +128,46 @@ class ExperimentSession():
             self.log('Incoming data, format {}'.format(save_format))
             if value is None or len(value) < 1 or value == '\n':
                 self.log('Data is empty, ignoring.')
+            elif any([s in key for s in ['..', '/', '~']]):
+                self.log('Skipping {}'.format(key))
             else:
-                self.data[key] = value
+                self.spool_data(key, value)
                 self.has_data = True
 
+    def spool_data(self, key, value):
+        # Write incoming data to disk right away instead of holding it
+        # in memory until the session closes
+        self.run.submit_write(write_spool, self.spool_path, key, value,
+            log_fn=self.log)
+
     def save_data(self):
-        for key in self.data:
-            if any([s in key for s in ['..', '/', '~']]):
-                self.log('Skipping {}'.format(key))
-                continue
-            target_file = os.path.join(
-                self.data_path,
-                key
-            )
-            with open(target_file, 'w') as f:
-                f.write(self.data[key])
-            self.log('Wrote {}'.format(key))
+        self.run.submit_write(promote_spool, self.spool_path, self.data_path,
+            log_fn=self.log,
+            record_fn=functools.partial(self.run.record_written, self.token,
+                session_args=dict(self.session_args)))
+
+    def discard_data(self):
+        self.run.submit_write(
+            shutil.rmtree, self.spool_path, ignore_errors=True)
 
     def set_completed(self, completed):
         self.is_complete = completed
 
-    def close(self, bulk=False):
-        self.log('Closing session ({})'.format(
-            'complete' if self.is_complete else 'incomplete'
-        ))
-        if self.has_data and \
-                (self.is_complete or self.run.save_incomplete_data):
-            self.log('Saving data...')
-            self.save_data()
-        self.run.on_session_closed(self, bulk)
+    def close(self):
+        with self.run.experiment.lock:
+            if self.is_closed:
+                return
+            self.is_closed = True
+            self.log('Closing session ({})'.format(
+                'complete' if self.is_complete else 'incomplete'
+            ))
+            if self.has_data and \
+                    (self.is_complete or self.run.save_incomplete_data):
+                self.log('Saving data...')
+                self.save_data()
+            else:
+                self.discard_data()
+            self.run.on_session_closed(self)
 
     def fill_url_params(self, url):
         #TODO: super hacky
@@ -109,7 +206,8 @@ class ExperimentRun():
             save_incomplete_data=True,
             briefing_url=None,
             debriefing_url=None,
-            session_args={}):
+            session_args={},
+            arg_counts=None):
         self.experiment = exp
         self.id = id
         self.data_path = data_path
@@ -130,7 +228,9 @@ class ExperimentRun():
         self.debriefing_url = debriefing_url
         # Session URL params
         self.session_args = session_args
-        self.arg_counts = {}
+        # Completed sessions for each session arg value
+        self.arg_counts = arg_counts if arg_counts is not None else {}
+        self.counterbalancer = Counterbalancer(session_args, self.arg_counts)
 
     def to_dict(self):
         obj = {
@@ -145,7 +245,8 @@ class ExperimentRun():
             'briefing_url': self.briefing_url,
             'debriefing_url': self.debriefing_url,
             'session_args': json.dumps(self.session_args),
-            'arg_counts': json.dumps(self.arg_counts)
+            'arg_counts': json.dumps(self.arg_counts),
+            'next_session_token': self.next_session_token
         }
         return obj
 
@@ -161,15 +262,56 @@ class ExperimentRun():
             obj.get('save_incomplete_data', True),
             obj.get('briefing_url', None),
             obj.get('debriefing_url', None),
-            json.loads(obj.get('session_args', '{}'))
+            json.loads(obj.get('session_args', '{}')),
+            json.loads(obj.get('arg_counts', '{}'))
         )
-        run.arg_counts = json.loads(obj.get('arg_counts', '{}'))
         run.num_sessions = obj['num_sessions']
+        run.next_session_token = obj.get('next_session_token', 0)
+        run.recover_spooled_sessions()
+        run.skip_used_tokens()
         return run
 
     def log(self, msg, **kwargs):
         self.experiment.log(msg, run=self.id, **kwargs)
 
+    def submit_write(self, fn, *args, **kwargs):
+        self.experiment.submit_write(fn, *args, **kwargs)
+
+    def record_written(self, token, keys, session_args=None):
+        if session_args is None:
+            session_args = {}
+        run_dir = os.path.relpath(self.data_path, self.experiment.data_path)
+        self.experiment.write_log.record(self.id, token, [
+            '{}/{}'.format(run_dir, key) for key in keys
+        ])
+        csv_keys = [key for key in keys if key.lower().endswith('.csv')]
+        if len(csv_keys) == 0:
+            return
+        try:
+            for key in csv_keys:
+                rows = self.experiment.get_merged_data(
+                    self.id).append_session(token, self.id, session_args,
+                        [os.path.join(self.data_path, key)])
+                self.experiment.get_run_summary(self).add_rows(
+                    token, key, session_args, rows,
+                    skip_columns=set(session_args) | {TOKEN_COLUMN,
+                        RUN_COLUMN})
+        except Exception as e:
+            # The data files themselves are saved
+            self.log('ERROR: could not merge data ({}: {})'.format(
+                type(e).__name__, e), token=token)
+            return
+        self.experiment.server.compactor.mark_dirty(
+            (self.experiment.id, self.id))
+
+    def skip_used_tokens(self):
+        # Session tokens must stay unique within a run: the write log, merged
+        # data and run summary tell sessions apart by them. Sessions may have
+        # been written or counted since the metadata was last saved.
+        self.next_session_token = max(self.next_session_token,
+            self.experiment.write_log.get_max_token(self.id),
+            self.experiment.get_run_summary(self).get_max_token())
+
     def get_remaining_sessions(self):
         if self.size is None:
             return None
@@ -183,25 +325,47 @@ class ExperimentRun():
         self.log('Run complete')
         self.experiment.on_run_finished(self)
 
-    def on_session_closed(self, session, bulk=False):
-        if session.has_data and (
-                session.is_complete or self.save_incomplete_data):
+    def on_session_closed(self, session):
+        counted = session.has_data and (
+            session.is_complete or self.save_incomplete_data)
+        if counted:
             self.num_sessions += 1
-        else:
-            # This submission does not count, undo its session args contribution
-            for key in session.session_args:
-                val = session.session_args[key]
-                self.decrement_arg_count(key, val)
-                if self.arg_counts[key][val] == 0:
-                    del self.arg_counts[key][val]
+        changed_counts = self.counterbalancer.release(
+            session.assigned_args, session.reservations, counted)
+        self.submit_write(self.experiment.get_run_summary(self).add_session,
+            session.token, dict(session.session_args), session.is_complete,
+            (datetime.datetime.now() - session.start_time).total_seconds())
 
         token = session.token
         del self.sessions[token]
-        self.experiment.on_session_closed(session, bulk=bulk)
+        self.experiment.on_session_closed(session)
         if self.size is not None and self.get_remaining_sessions() == 0:
             self.finish_run()
-        elif not bulk:  #TODO: HACK to prevent extra file writes
-            self.experiment.save_metadata()
+        else:
+            self.experiment.record_event({
+                'type': 'run_counts',
+                'run': self.id,
+                'num_sessions': self.num_sessions,
+                'arg_counts': {
+                    key: self.arg_counts[key] for key in changed_counts
+                }
+            })
+
+    def recover_spooled_sessions(self):
+        # Sessions that were still open when the server stopped leave their
+        # spooled data behind; treat them as incomplete sessions
+        spool_root = os.path.join(self.data_path, SPOOL_DIR)
+        if not os.path.isdir(spool_root):
+            return
+        for token in os.listdir(spool_root):
+            spool_path = os.path.join(spool_root, token)
+            if self.save_incomplete_data:
+                self.log('Recovering spooled session data', token=token)
+                promote_spool(spool_path, self.data_path, log_fn=self.log,
+                    record_fn=functools.partial(self.record_written, token))
+            else:
+                self.log('Discarding spooled session data', token=token)
+                shutil.rmtree(spool_path, ignore_errors=True)
 
     def has_session(self, token):
         return token in self.sessions
@@ -211,88 +375,32 @@ class ExperimentRun():
 
     def close_all_sessions(self):
         for session in list(self.sessions.values()):
-            #TODO: HACK to prevent extra file writes
-            session.close(bulk=True)
-
-    def timeout_old_sessions(self):
-        now = datetime.datetime.now()
-        expired_sessions = [
-            t for t in self.sessions
-                if now - self.sessions[t].start_time
-                    > EXPERIMENT_SESSION_TIMEOUT
-        ]
-        for token in expired_sessions:
-            self.log('Closing expired session.', token=token)
-            self.sessions[token].close()
-
-    def get_arg_count(self, key, value):
-        if key not in self.arg_counts:
-            self.arg_counts[key] = {}
-        if value not in self.arg_counts[key]:
-            self.arg_counts[key][value] = 0
-        return self.arg_counts[key][value]
-
-    def set_arg_count(self, key, value, new_count):
-        self.arg_counts[key][value] = new_count
-
-    def increment_arg_count(self, key, value):
-        self.set_arg_count(key, value, self.get_arg_count(key, value) + 1)
-
-    def decrement_arg_count(self, key, value):
-        self.set_arg_count(key, value, self.get_arg_count(key, value) - 1)
+            session.close()
 
     def get_key_counts(self, key):
-        return [
-            (v, self.arg_counts[key][v]) for v in self.arg_counts.get(key, {})
-        ]
-
-    def parse_arg_string(self, key, value, params):
-        if value is None:
-            return None
-        if type(value) is str and value.endswith(')'):
-            if value.startswith('URL('):
-                url_key = value[len('URL('):-1]
-                if url_key in params:
-                    return params[url_key]
-                return None
-            elif value.startswith('uniform('):
-                value_list = [x.strip() for x in
-                    value[len('uniform('):-1].split(',')]
-                lowest_count = None
-                least_common_values = None
-                for v in value_list:
-                    count = self.get_arg_count(key, v)
-                    if lowest_count is None or count < lowest_count:
-                        lowest_count = count
-                        least_common_values = [v]
-                    elif count == lowest_count:
-                        least_common_values.append(v)
-                return random.choice(least_common_values)
-        return value
+        return self.counterbalancer.get_counts(key)
 
     def open_session(self, params):
-        token = self.get_next_session_token()
-        # Resolve session arguments from given params
-        session_args = {}
-        for key in self.session_args:
-            value = self.parse_arg_string(key, self.session_args[key], params)
-            if value is not None:
-                session_args[key] = value
-                self.increment_arg_count(key, value)
-
-        self.log('Opening session', token=token, **session_args)
-        experiment_session = ExperimentSession(
-            self,
-            token,
-            self.data_path,
-            session_args
-        )
-        self.sessions[token] = experiment_session
-        return experiment_session
+        with self.experiment.lock:
+            token = self.get_next_session_token()
+            # Resolve session arguments from given params
+            (session_args, reservations) = self.counterbalancer.assign(params)
+
+            self.log('Opening session', token=token, **session_args)
+            experiment_session = ExperimentSession(
+                self,
+                token,
+                self.data_path,
+                session_args,
+                reservations
+            )
+            self.sessions[token] = experiment_session
+            return experiment_session
 
     def cancel(self):
-        self.close_all_sessions()
-        self.finish_run()
+        with self.experiment.lock:
+            self.close_all_sessions()
+            self.finish_run()
 
 
 class PsychoJsExperiment():
@@ -303,6 +411,16 @@ class PsychoJsExperiment():
         self.config = {}
         # Filesystem location
         self.data_path = data_path
+        self.write_log = WriteLog(
+            os.path.join(data_path, WRITE_LOG_FILE),
+            os.path.join(data_path, EXPORT_CURSORS_FILE)
+        )
+        # Data files by run and session, for browsing
+        self.session_index = SessionIndex(self.write_log, data_path)
+        # Run id -> MergedDataset / RunSummary, loaded as needed
+        self.merged_data = {}
+        self.run_summaries = {}
+        self.merged_data_lock = threading.Lock()
         # Current run
         self.next_run_id = 1
         self.run = None
@@ -311,10 +429,50 @@ class PsychoJsExperiment():
         self.secret_url = None
         # Group
         self.group = None
+        # Guards the run and its sessions
+        self.lock = threading.RLock()
 
     def log(self, msg, **kwargs):
         self.server.log(msg, study=self.id, **kwargs)
 
+    def submit_write(self, fn, *args, **kwargs):
+        self.server.writer.submit(self.id, fn, *args, **kwargs)
+
+    def get_merged_data_path(self, run_id):
+        return os.path.join(
+            self.data_path, MERGED_DATA_DIR, 'run_{}'.format(run_id))
+
+    def get_merged_data(self, run_id):
+        with self.merged_data_lock:
+            if run_id not in self.merged_data:
+                self.merged_data[run_id] = MergedDataset(
+                    self.get_merged_data_path(run_id))
+            return self.merged_data[run_id]
+
+    def get_run_summary(self, run):
+        with self.merged_data_lock:
+            if run.id not in self.run_summaries:
+                self.run_summaries[run.id] = RunSummary(
+                    os.path.join(
+                        self.get_merged_data_path(run.id), RUN_SUMMARY_FILE),
+                    run.session_args.keys()
+                )
+            return self.run_summaries[run.id]
+
+    def get_merged_data_runs(self):
+        # Ids of the runs with merged data
+        run_ids = []
+        try:
+            names = os.listdir(os.path.join(self.data_path, MERGED_DATA_DIR))
+        except FileNotFoundError:
+            return run_ids
+        for name in names:
+            (prefix, _, run_id) = name.partition('_')
+            if prefix == 'run' and run_id.isdigit() and \
+                    self.get_merged_data(int(run_id)).exists():
+                run_ids.append(int(run_id))
+        return sorted(run_ids)
+
     def load_config(self):
         self.config = {
             'experiment': {
@@ -343,49 +501,47 @@ class PsychoJsExperiment():
             raise ValueError()
         return self.run.get_session(token)
 
-    def timeout_old_sessions(self):
-        if not self.is_active():
-            raise ValueError()
-        self.run.timeout_old_sessions()
-
     def get_next_run_id(self):
         id = self.next_run_id
         self.next_run_id += 1
         return id
 
     def start_run(self, **kwargs):
-        if self.is_active():
-            raise ValueError()
-        while True:
-            id = self.get_next_run_id()
-            run_data_path = os.path.join(
-                self.data_path, 'run_{}'.format(id)
+        with self.lock:
+            if self.is_active():
+                raise ValueError()
+            while True:
+                id = self.get_next_run_id()
+                run_data_path = os.path.join(
+                    self.data_path, 'run_{}'.format(id)
+                )
+                #TODO: HACK
+                if not os.path.exists(run_data_path):
+                    break
+            self.log('Starting run {}'.format(id))
+            self.run = ExperimentRun(
+                self,
+                id,
+                run_data_path,
+                **kwargs
             )
-            #TODO: HACK
-            if not os.path.exists(run_data_path):
-                break
-        self.log('Starting run {}'.format(id))
-        self.run = ExperimentRun(
-            self,
-            id,
-            run_data_path,
-            **kwargs
-        )
-        os.makedirs(run_data_path)
-        self.save_metadata()
+            os.makedirs(run_data_path)
+            self.save_metadata()
 
     def cancel_run(self):
-        if not self.is_active():
-            raise ValueError()
-        self.run.cancel()
+        with self.lock:
+            if not self.is_active():
+                raise ValueError()
+            self.run.cancel()
 
     def open_session(self, params):
-        if not self.is_active():
-            raise ValueError()
-        return self.run.open_session(params)
+        with self.lock:
+            if not self.is_active():
+                raise ValueError()
+            return self.run.open_session(params)
 
-    def on_session_closed(self, session, bulk=False):
-        self.server.on_session_closed(self, session, bulk=bulk)
+    def on_session_closed(self, session):
+        self.server.on_session_closed(self, session)
 
     def get_remaining_sessions(self):
         if not self.is_active():
@@ -410,27 +566,39 @@ class PsychoJsExperiment():
         if self.has_secret_url():
             self.server.remove_secret_url_code(self.secret_url)
         self.save_metadata()
+        self.server.on_study_access_changed(self.id)
 
     def is_editable_by(self, user):
         return user in self.admins
 
     def add_admin(self, user):
-        self.admins.add(user)
+        with self.lock:
+            self.admins.add(user)
 
     def remove_admin(self, user):
-        self.admins.remove(user)
+        with self.lock:
+            self.admins.remove(user)
 
     def meta_to_json_str(self):
+        return json.dumps(self.meta_to_dict())
+
+    def meta_to_dict(self):
+        with self.lock:
+            return self.build_meta_dict()
+
+    def build_meta_dict(self):
         meta = {}
         meta['admins'] = list(self.admins)
         meta['next_run_id'] = self.next_run_id
         meta['group'] = self.group
         if self.is_active():
             meta['run'] = self.run.to_dict()
-        return json.dumps(meta)
+        return meta
 
     def load_meta_json_str(self, json_str):
-        meta = json.loads(json_str)
+        self.load_meta(json.loads(json_str))
+
+    def load_meta(self, meta):
         self.admins = set(meta.get('admins', []))
         self.next_run_id = meta.get('next_run_id', 1)
         self.group = meta.get('group', None)
@@ -441,6 +609,9 @@ class PsychoJsExperiment():
         self.log('Saving metadata')
         self.server.save_study_metadata(self.id)
 
+    def record_event(self, record):
+        self.server.record_study_event(self.id, record)
+
     def has_secret_url(self):
         return self.secret_url is not None
 
@@ -492,39 +663,125 @@ class PsychoJsExperiment():
 
 class ExperimentServer():
 
-    def __init__(self, data_path, study_path, code_generator_fn):
+    def __init__(self, data_path, study_path, code_generator_fn,
+            flush_interval=METADATA_FLUSH_INTERVAL, state_backend=None,
+            bulk_code_generator_fn=None, access_changed_fn=None):
         self.experiments = {}
         self.data_path = data_path
         self.study_path = study_path
         # Participant codes
+        self.code_lock = threading.RLock()
         self.participant_codes = {}
+        # Per-study indexes of participant_codes:
+        # study -> invite codes (dict used as an ordered set)
+        self.study_invite_codes = defaultdict(dict)
+        # study -> secret url code
+        self.study_secret_url_codes = {}
         # Code generation
         self.code_generator_fn = code_generator_fn
+        self.bulk_code_generator_fn = bulk_code_generator_fn
+        # Called with a study's id when who may access it changes
+        self.access_changed_fn = access_changed_fn
         # HTTP Session to Experiment Session map
         self.user_session_map = {}
         self.session_user_map = {}
+        # Background file writes
+        self.writer = DataWriter(
+            num_workers=DATA_WRITER_THREADS,
+            max_pending=DATA_WRITER_MAX_PENDING
+        )
+        # Metadata storage
+        if state_backend is None:
+            state_backend = JsonStateBackend(study_path)
+        self.state_backend = state_backend
+        # Metadata changes waiting to be flushed
+        self.metadata_lock = threading.Lock()
+        self.pending_records = defaultdict(list)
+        self.pending_snapshots = set()
+        self.flusher = FlushScheduler(
+            self.flush_metadata, interval=flush_interval)
+        # Runs' merged data waiting to be compacted, by (study, run id)
+        self.compactor = FlushScheduler(
+            self.compact_merged_data, interval=MERGED_DATA_COMPACT_INTERVAL)
+        # Session and participant code timeouts
+        self.expiry = ExpiryScheduler()
+        # Study name -> lock held while importing files into it
+        self.import_locks = defaultdict(threading.Lock)
+        self.import_locks_lock = threading.Lock()
+        # Study resources
+        self.blob_store = BlobStore(os.path.join(study_path, BLOB_DIR))
+        # Data downloads
+        self.archive_cache = ArchiveCache(
+            os.path.join(data_path, ARCHIVE_CACHE_DIR),
+            ARCHIVE_CACHE_MAX_BYTES
+        )
+        # Data browsing
+        self.line_indexes = LineIndexCache()
 
     def log(self, msg, **kwargs):
         log(msg, **kwargs)
 
-    def get_metafile_path(self, study):
-        return os.path.join(
-            self.study_path,
-            study,
-            'meta.json'
-        )
+    def get_metadata_snapshot(self, key):
+        if key == SERVER_WRITE_KEY:
+            with self.code_lock:
+                return self.save_server_metadata()
+        return self.experiments[key].meta_to_dict()
+
+    def schedule_snapshot(self, key):
+        with self.metadata_lock:
+            self.pending_snapshots.add(key)
+        self.flusher.mark_dirty(key)
+
+    def schedule_record(self, key, record):
+        with self.metadata_lock:
+            self.pending_records[key].append(record)
+        self.flusher.mark_dirty(key)
+
+    def discard_pending_metadata(self, key):
+        self.flusher.discard(key)
+        with self.metadata_lock:
+            self.pending_records.pop(key, None)
+            self.pending_snapshots.discard(key)
+
+    def flush_metadata(self, key):
+        # Called by the flush scheduler for each dirty key
+        if key != SERVER_WRITE_KEY and key not in self.experiments:
+            return
+        backend = self.state_backend
+        with self.metadata_lock:
+            records = self.pending_records.pop(key, [])
+            snapshot = key in self.pending_snapshots
+            self.pending_snapshots.discard(key)
+        try:
+            if snapshot or backend.needs_snapshot(key, len(records)):
+                meta = self.get_metadata_snapshot(key)
+                self.writer.submit(key, backend.save_snapshot, key, meta)
+            elif len(records) > 0:
+                self.writer.submit(key, backend.append_records, key, records)
+        except:
+            # Put everything back for the next attempt
+            with self.metadata_lock:
+                self.pending_records[key][:0] = records
+                if snapshot:
+                    self.pending_snapshots.add(key)
+            raise
+
+    def sync_metadata(self, key=None):
+        self.flusher.sync(key)
 
     def save_study_metadata(self, study):
-        with open(self.get_metafile_path(study), 'w') as md:
-            md.write(self.experiments[study].meta_to_json_str())
+        self.schedule_snapshot(study)
+
+    def record_study_event(self, study, record):
+        self.schedule_record(study, record)
 
     def load_study_metadata(self, study):
-        with open(self.get_metafile_path(study)) as md:
-            self.experiments[study].load_meta_json_str(
-                md.read()
-            )
+        meta = self.state_backend.load(study)
+        self.experiments[study].load_meta(meta or {})
 
     def load_server_metadata(self, meta_json):
+        self.study_invite_codes.clear()
+        self.study_secret_url_codes.clear()
         if 'participant_codes' in meta_json:
             for props in meta_json['participant_codes']:
                 code = props['code']
@@ -540,43 +797,54 @@ class ExperimentServer():
                     kwargs['session_count'] = props.get('session_count', 0)
                 self.add_participant_code(study, code=code, **kwargs)
 
+    def participant_code_metadata(self, code):
+        props = self.participant_codes[code]
+        meta_obj = {
+            'study': props['study'],
+            'code': code
+        }
+        if props.get('is_secret_url', False):
+            meta_obj['is_secret_url'] = True
+        else:
+            meta_obj['timeout'] = props['timeout'].isoformat()
+            meta_obj['unique_session'] = props['unique_session']
+            meta_obj['session_limit'] = props['session_limit']
+            meta_obj['session_count'] = props.get('session_count', 0)
+        return meta_obj
+
     def save_server_metadata(self):
         metadata = {}
-        metadata['participant_codes'] = []
-        for code in self.participant_codes:
-            props = self.participant_codes[code]
-            meta_obj = {
-                'study': props['study'],
-                'code': code
-            }
-            if props.get('is_secret_url', False):
-                meta_obj['is_secret_url'] = True
-            else:
-                meta_obj['timeout'] = props['timeout'].isoformat()
-                meta_obj['unique_session'] = props['unique_session']
-                meta_obj['session_limit'] = props['session_limit']
-                meta_obj['session_count'] = props.get('session_count', 0)
-            metadata['participant_codes'].append(meta_obj)
+        metadata['participant_codes'] = [
+            self.participant_code_metadata(code)
+                for code in self.participant_codes
+        ]
         return metadata
 
 
-    def get_server_metadata_file_path(self):
-        return os.path.join(
-            self.study_path,
-            'server.json'
-        )
-
     def save_server_metadata_file(self):
         self.log('Saving server metadata...')
-        with open(self.get_server_metadata_file_path(), 'w') as md:
-            md.write(json.dumps(self.save_server_metadata(), indent=2))
+        self.schedule_snapshot(SERVER_WRITE_KEY)
+
+    def record_server_event(self, record):
+        self.schedule_record(SERVER_WRITE_KEY, record)
+
+    def flush_writes(self, study=None):
+        self.sync_metadata(study)
+        self.writer.flush(study)
+
+    def shutdown(self):
+        self.expiry.stop()
+        self.flusher.stop()
+        self.writer.shutdown()
+        self.compactor.stop()
+        self.state_backend.close()
 
     def load_server_metadata_file(self):
-        try:
-            with open(self.get_server_metadata_file_path()) as md:
-                self.load_server_metadata(json.loads(md.read()))
-        except FileNotFoundError:
+        meta = self.state_backend.load(SERVER_WRITE_KEY)
+        if meta is None:
             self.log('nothing to load')
+            return
+        self.load_server_metadata(meta)
 
     def add_study(self, study):
         study_path = os.path.join(self.study_path, study)
@@ -596,101 +864,179 @@ class ExperimentServer():
         )
         self.experiments[study].load_config()
 
+    def get_import_lock(self, study):
+        with self.import_locks_lock:
+            return self.import_locks[study]
+
     def _import_study_files(self, study, files, replace=False):
+        # Call holding the study's import lock; the staging folder is shared
+        # by imports into the same study
         if study in self.experiments and not replace:
             raise ValueError('Study "{}" already exists.'.format(study))
-        with tempfile.TemporaryDirectory() as temp_dir:
-            self.log('Saving study files to {}'.format(temp_dir), study=study)
-            study_files = []
-            for file in files:
-                path = file.filename
-                new_filename = secure_filename(path)[len('html_'):]
-                full_path = os.path.join(
-                    temp_dir,
-                    new_filename
-                )
-                study_files.append({
-                    'path': path,
-                    'full_path': full_path,
-                    'name': new_filename
-                })
-                file.save(full_path)
-            self.log('Copying new files', study=study)
-            import_study(study, study_files, self.study_path, replace=replace)
-            self.log('Done copying files', study=study)
+        study_files = []
+        for file in files:
+            path = file.filename
+            study_files.append({
+                'path': path,
+                'name': secure_filename(path)[len('html_'):],
+                'stream': file.stream
+            })
+        self.log('Importing new files', study=study)
+        staging_path = stage_study(study, study_files, self.study_path,
+            self.blob_store, replace=replace)
+        # Metadata files are linked into the new version; make sure none are
+        # being written until it is in place
+        self.flush_writes(study)
+        with self.flusher.flush_lock:
+            self.writer.flush(study)
+            swap_in_study(
+                study, staging_path, self.study_path, self.blob_store)
+        self.log('Done copying files', study=study)
 
     def create_new_study(self, values, files):
         study = values['name']
         bad_chars = ['/','?','+']
-        name_blacklist = ['new', 'logout']
-        if study is None or len(study) < 1 or \
+        name_blacklist = ['new', 'logout', SERVER_WRITE_KEY]
+        if study is None or len(study) < 1 or study.startswith('.') or \
                 any([c in study for c in bad_chars]) or study in name_blacklist:
             raise ValueError('Invalid study name.')
         self.log('Trying to add new study "{}"'.format(study), study=study)
-        self._import_study_files(study, files, replace=False)
-        self.add_study(study)
+        with self.get_import_lock(study):
+            self._import_study_files(study, files, replace=False)
+            self.add_study(study)
 
 
     def update_study_files(self, study, files):
         if self.experiments[study].is_active():
             raise ValueError('Study is currently running; deactivate it before changing files.')
         self.log('Updating study files', study=study)
-        self._import_study_files(study, files, replace=True)
+        with self.get_import_lock(study):
+            self._import_study_files(study, files, replace=True)
         self.save_study_metadata(study)
 
     def delete_study(self, study, delete_data=False):
         log('Removing study "{}"'.format(study), study=study)
         exp = self.experiments[study]
-        del self.experiments[study]
         if exp.is_active():
             exp.cancel_run()
+        # Drop any participant codes still pointing at the study
+        self.revoke_participant_codes(study)
+        if study in self.study_secret_url_codes:
+            self.remove_secret_url_code(self.study_secret_url_codes[study])
+        del self.experiments[study]
+        self.on_study_access_changed(study)
+        self.discard_pending_metadata(study)
+        self.writer.submit(study, self.state_backend.delete, study)
+        self.flush_writes(study)
         shutil.rmtree(os.path.join(self.study_path, study))
+        self.blob_store.collect_garbage()
         if delete_data:
+            self.archive_cache.discard(study)
             shutil.rmtree(os.path.join(self.data_path, study))
             log('Removed all collected data.'.format(study), study=study)
         log('Study has been deleted.', study=study)
 
-    @contextmanager
     def get_study_data_archive(self, study):
+        # Returns a generator of the study's data as .tar.gz chunks
         if study not in self.experiments:
             raise ValueError('No such study "{}"'.format(study))
         log('Retrieving study data', study=study)
-        with tempfile.TemporaryDirectory() as temp_path:
-            data_file_path = os.path.join(
-                temp_path, 'study_data_{}.tar.gz'.format(study))
-            tar_source = self.experiments[study].data_path
-            cmd = ' '.join([
-                'tar',
-                '-czf',
-                data_file_path,
-                '*'
-            ])
-            log(cmd, study=study)
-            subprocess.run(
-                cmd,
-                check=True,
-                shell=True,
-                cwd=tar_source
-            )
-            yield data_file_path
+        self.flush_writes(study)
+        return self.archive_cache.get_archive(
+            study, self.experiments[study].data_path)
+
+    def get_study_data_changes(self, study, after, run=None, since=None,
+            until=None):
+        # Data files written after the `after` cursor (see WriteLog.read)
+        if study not in self.experiments:
+            raise ValueError('No such study "{}"'.format(study))
+        self.flush_writes(study)
+        return self.experiments[study].write_log.read(
+            after, run=run, since=since, until=until)
+
+    def get_study_data_files_archive(self, study, files):
+        # Returns a generator of the given data files as .tar.gz chunks
+        entries = stat_entries(self.experiments[study].data_path, files)
+        log('Retrieving {} data files'.format(len(entries)), study=study)
+        return compress_stream(generate_tar(entries), sync_first=True)
+
+    def compact_merged_data(self, key):
+        (study, run_id) = key
+        exp = self.experiments.get(study)
+        if exp is not None:
+            exp.get_merged_data(run_id).compact()
+
+    def get_merged_data_file(self, study, run_id):
+        # Path of the run's merged data, brought up to date; None if it
+        # has none
+        if study not in self.experiments:
+            raise ValueError('No such study "{}"'.format(study))
+        self.flush_writes(study)
+        merged_data = self.experiments[study].get_merged_data(run_id)
+        if not merged_data.exists():
+            return None
+        merged_data.compact()
+        return merged_data.merged_path
+
+    def get_data_run_ids(self, study):
+        return self.experiments[study].session_index.get_run_ids()
+
+    def get_data_sessions(self, study, run_id):
+        return self.experiments[study].session_index.get_sessions(run_id)
+
+    def get_data_file_page(self, study, run_id, name, page):
+        # Lines of a data file (records, for CSV files), PAGE_LINES at a
+        # time. Returns (lines, whether there are more pages, the file's line
+        # count if known yet)
+        exp = self.experiments[study]
+        if page < 0 or not exp.session_index.has_file(run_id, name):
+            raise ValueError('No such data file "{}"'.format(name))
+        index = self.line_indexes.get(
+            os.path.join(exp.data_path, 'run_{}'.format(run_id), name),
+            records=name.lower().endswith('.csv'))
+        (lines, more) = index.get_lines(page * PAGE_LINES, PAGE_LINES)
+        if page > 0 and len(lines) == 0:
+            raise ValueError('No page {} of "{}"'.format(page, name))
+        return (lines, more, index.get_num_lines())
+
+    def get_export_cursor(self, study, user):
+        return self.experiments[study].write_log.get_user_cursor(user)
+
+    def set_export_cursor(self, study, user, cursor):
+        self.experiments[study].write_log.set_user_cursor(user, cursor)
 
     def load_experiments(self):
         if not os.path.exists(self.study_path):
             self.log('Creating study directory')
             os.makedirs(self.study_path)
 
+        clean_up_imports(self.study_path)
         self.log('Registering experiments...')
         for study in os.listdir(self.study_path):
-            if not os.path.isdir(os.path.join(
+            if study.startswith('.') or not os.path.isdir(os.path.join(
                     self.study_path,
                     study)):
                 continue
             self.log('Adding "{}"...'.format(study))
             self.add_study(study)
             self.load_study_metadata(study)
+            self.check_compressed_js(study)
 
         self.log('Loading server metadata...')
         self.load_server_metadata_file()
+        self.expiry.start()
+
+    def on_study_access_changed(self, study):
+        if self.access_changed_fn is not None:
+            self.access_changed_fn(study)
+
+    def check_compressed_js(self, study):
+        # Studies imported before exp.js.gz existed
+        js_path = os.path.join(self.study_path, study, 'exp.js')
+        gz_path = js_path + '.gz'
+        if os.path.isfile(js_path) and (not os.path.isfile(gz_path) or
+                os.path.getmtime(gz_path) < os.path.getmtime(js_path)):
+            compress_js(study, js_path)
 
     def study_available(self, study):
         return study in self.experiments and \
@@ -707,6 +1053,10 @@ class ExperimentServer():
 
     def handle_request(self, study, params, user_key):
         exp = self.experiments[study]
+        with exp.lock:
+            return self.handle_study_request(exp, params, user_key)
+
+    def handle_study_request(self, exp, params, user_key):
         command = params['command']
         exp.log('Request: {}'.format(command))
         response = {}
@@ -768,56 +1118,133 @@ class ExperimentServer():
         return groups
 
     def set_study_group(self, study, group):
-        self.experiments[study].group = group
+        with self.experiments[study].lock:
+            self.experiments[study].group = group
         self.save_study_metadata(study)
 
 
     def add_participant_code(self, study, code=None, **kwargs):
         props = self.code_generator_fn(study, code=code)
+        return self.register_participant_code(props, **kwargs)
+
+    def register_participant_code(self, props, **kwargs):
         code = props['code']
+        study = props['study']
         self.log('New code',code=code, study=study)
         props.update(kwargs)
         props['sessions'] = set()
-        self.participant_codes[code] = props
+        with self.code_lock:
+            self.participant_codes[code] = props
+            self.index_participant_code(code, props)
+        if 'timeout' in props:
+            self.expiry.schedule(
+                ('code', code),
+                props['timeout'],
+                lambda: self.expire_participant_code(code)
+            )
         return code
 
-    def remove_participant_code(self, code, bulk=False):
-        self.log('Removing participant code', code=code)
-        props = self.participant_codes[code]
-        props['on_remove']()
-        if len(props['sessions']) > 0:
-            self.log('REMOVED CODE STILL HAD SESSIONS!!',code=code)
-        del self.participant_codes[code]
-        if not bulk:
-            self.save_server_metadata_file()
+    def expire_participant_code(self, code):
+        if code in self.participant_codes:
+            self.log('Participant code is expired', code=code)
+            self.remove_code_and_session(code)
+
+    def index_participant_code(self, code, props):
+        if 'unique_session' in props:
+            self.study_invite_codes[props['study']][code] = None
+        elif props.get('is_secret_url', False):
+            self.study_secret_url_codes[props['study']] = code
+
+    def unindex_participant_code(self, code, props):
+        study = props['study']
+        if study in self.study_invite_codes:
+            self.study_invite_codes[study].pop(code, None)
+            if len(self.study_invite_codes[study]) == 0:
+                del self.study_invite_codes[study]
+        if self.study_secret_url_codes.get(study) == code:
+            del self.study_secret_url_codes[study]
+
+    def remove_participant_code(self, code):
+        with self.code_lock:
+            if code not in self.participant_codes:
+                # Already removed by another thread
+                return
+            self.log('Removing participant code', code=code)
+            props = self.participant_codes[code]
+            if len(props['sessions']) > 0:
+                self.log('REMOVED CODE STILL HAD SESSIONS!!',code=code)
+            del self.participant_codes[code]
+            self.unindex_participant_code(code, props)
+            self.expiry.cancel(('code', code))
+            self.record_server_event({'type': 'code_removed', 'code': code})
+            # Last, so the registry stays consistent if it fails. Runs on
+            # the expiry thread too, outside any request.
+            try:
+                props['on_remove']()
+            except Exception as e:
+                self.log('ERROR: removing code user failed ({}: {})'.format(
+                    type(e).__name__, e), code=code)
 
     # Invite codes - single use access for individual participants
     # most restrictive access mode
     def add_invite_code(self, study, **kwargs):
-        self.add_participant_code(
+        code = self.add_participant_code(
             study,
             unique_session=True,
             **kwargs
         )
+        self.record_code_added(code)
+
+    def add_invite_codes(self, study, count, **kwargs):
+        if self.bulk_code_generator_fn is not None:
+            new_props = self.bulk_code_generator_fn(study, count)
+        else:
+            new_props = [self.code_generator_fn(study) for _ in range(count)]
+        # The whole batch shows up at once
+        with self.code_lock:
+            codes = [
+                self.register_participant_code(
+                    props,
+                    unique_session=True,
+                    **kwargs
+                ) for props in new_props
+            ]
+        # One snapshot instead of a journal record per code
         self.save_server_metadata_file()
+        return codes
+
+    def record_code_added(self, code):
+        self.record_server_event({
+            'type': 'code_added',
+            'code': code,
+            'props': self.participant_code_metadata(code)
+        })
 
     # Secret url - level of access between public and participant codes
     # participants can keep accessing the study at the url until it is closed
     def add_secret_url(self, study):
-        code = self.add_participant_code(
-            study,
-            is_secret_url=True
-        )
-        self.get_experiment(study).set_secret_url(code)
-        self.save_server_metadata_file()
+        exp = self.get_experiment(study)
+        with exp.lock:
+            code = self.add_participant_code(
+                study,
+                is_secret_url=True
+            )
+            exp.set_secret_url(code)
+        self.record_code_added(code)
 
     def remove_secret_url_code(self, code):
-        props = self.participant_codes[code]
+        props = self.participant_codes.get(code)
+        if props is None:
+            return
         self.remove_participant_code(code)
         self.get_experiment(props['study']).remove_secret_url()
-        self.save_server_metadata_file()
 
-    def on_session_closed(self, experiment, session, bulk=False):
+    def on_session_closed(self, experiment, session):
+        self.expiry.cancel(self.session_expiry_key(experiment.id, session))
+        with self.code_lock:
+            self.on_user_session_closed(experiment, session)
+
+    def on_user_session_closed(self, experiment, session):
         user_key = self.get_user_for_session(experiment.id, session.token)
         session_obj = self.get_session_for_user(user_key)
         del self.user_session_map[user_key]
@@ -825,31 +1252,40 @@ class ExperimentServer():
         # If the user is accessing the server through a participant code,
         # log the session's completion in the code stats
         code = session_obj.get('code')
-        if code is not None:
+        if code is not None and code in self.participant_codes:
             props = self.participant_codes[code]
             props['sessions'].remove(session.token)
             # Remove the code if it's reached its session limit
             if 'session_limit' in props:
                 session_count = props.get('session_count', 0) + 1
                 if session_count == props['session_limit']:
-                    self.remove_participant_code(code, bulk=bulk)
+                    self.remove_participant_code(code)
                 else:
                     props['session_count'] = session_count
-                    if not bulk:
-                        self.save_server_metadata_file()
-
-    def remove_code_and_session(self, code, bulk=False):
-        props = self.participant_codes[code]
+                    self.record_server_event({
+                        'type': 'code_used',
+                        'code': code,
+                        'session_count': session_count
+                    })
+
+    def remove_code_and_session(self, code):
+        with self.code_lock:
+            props = self.participant_codes.get(code)
+            if props is None:
+                return
+            tokens = list(props['sessions'])
+        # Study lock must not be taken under the code lock
         exp = self.get_experiment(props['study'])
-        for token in list(props['sessions']):
-            exp.get_session(token).close(bulk=bulk)
-        else:
-            self.remove_participant_code(code, bulk=bulk)
+        with exp.lock:
+            for token in tokens:
+                if exp.has_session(token):
+                    exp.get_session(token).close()
+        self.remove_participant_code(code)
 
     def get_study_for_participant_code(self, code):
-        if code not in self.participant_codes:
+        props = self.participant_codes.get(code)
+        if props is None:
             raise ValueError()
-        props = self.participant_codes[code]
         if 'timeout' in props and \
                 datetime.datetime.now() >= props['timeout']:
             self.log('Participant code is expired', code=code)
@@ -868,55 +1304,71 @@ class ExperimentServer():
 
     def close_user_session(self, user_key):
         self.log('Closing existing user session...')
-        self.get_session_for_user(user_key)['session'].close()
+        self.close_user_session_if_exists(user_key)
 
     def close_user_session_if_exists(self, user_key):
-        if self.user_has_session(user_key):
+        user_session = self.get_session_for_user(user_key)
+        if user_session is not None:
             self.log('Closing existing session for user')
-            self.get_session_for_user(user_key)['session'].close()
+            # close() is a no-op if the session has closed in the meantime
+            user_session['session'].close()
 
     def start_session_for_user(self, study, user_key, params, code=None):
         exp = self.get_experiment(study)
-        exp.timeout_old_sessions()
-        session = exp.open_session(params)
-        self.user_session_map[user_key] = {
-            'study': study,
-            'session': session,
-            'code': code
-        }
-        self.session_user_map[(study, session.token)] = user_key
-        if code is not None:
-            self.participant_codes[code]['sessions'].add(session.token)
+        with exp.lock:
+            session = exp.open_session(params)
+            self.expiry.schedule(
+                self.session_expiry_key(study, session),
+                session.start_time + EXPERIMENT_SESSION_TIMEOUT,
+                lambda: self.expire_session(study, session)
+            )
+            with self.code_lock:
+                self.user_session_map[user_key] = {
+                    'study': study,
+                    'session': session,
+                    'code': code
+                }
+                self.session_user_map[(study, session.token)] = user_key
+                if code is not None:
+                    self.participant_codes[code]['sessions'].add(
+                        session.token)
+
+    def session_expiry_key(self, study, session):
+        return ('session', study, session.run.id, session.token)
+
+    def expire_session(self, study, session):
+        run = session.run
+        with run.experiment.lock:
+            if run.sessions.get(session.token) is session:
+                run.log('Closing expired session.', token=session.token)
+                session.close()
 
     def activate_participant_code(self, code, params, user_key):
         props = self.participant_codes[code]
         study = props['study']
         exp = self.experiments[study]
         self.log('Participant code accessed', code=code)
-        if not self.user_has_session(user_key):
-            self.start_session_for_user(study, user_key, params, code)
+        with exp.lock:
+            if not self.user_has_session(user_key):
+                self.start_session_for_user(study, user_key, params, code)
 
     def get_participant_codes(self, study):
         codes = []
-        for code in self.participant_codes:
-            props = self.participant_codes[code]
-            if 'unique_session' not in props:
-                continue
-            if props['study'] == study:
+        with self.code_lock:
+            for code in self.study_invite_codes.get(study, {}):
                 code_obj = {
                     'code': code
                 }
-                code_obj.update(props)
+                code_obj.update(self.participant_codes[code])
                 codes.append(code_obj)
         return codes
 
     def revoke_participant_codes(self, study):
         self.log('Revoking all participant codes', study=study)
-        target_codes = [
-            code for code in self.participant_codes if
-                self.participant_codes[code]['study'] == study and
-                self.participant_codes[code].get('unique_session', False)
-        ]
+        with self.code_lock:
+            target_codes = [
+                code for code in self.study_invite_codes.get(study, {}) if
+                    self.participant_codes[code]['unique_session']
+            ]
         for code in target_codes:
-            self.remove_code_and_session(code, bulk=True)
-        self.save_server_metadata_file()
+            self.remove_code_and_session(code)
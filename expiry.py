@@ -0,0 +1,76 @@
+import datetime
+import heapq
+import itertools
+import threading
+from logger import log
+
+
+class ExpiryScheduler():
+    # Calls a function for each key once its deadline has passed.
+    # Deadlines are kept in a min-heap; cancelled or rescheduled entries stay
+    # in the heap and are skipped when they reach the top.
+
+    def __init__(self):
+        self.heap = []
+        # key -> sequence number of its live heap entry
+        self.entries = {}
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.started = False
+        self.stopped = False
+
+    def start(self):
+        if not self.started:
+            self.started = True
+            self.thread.start()
+
+    def schedule(self, key, deadline, fn):
+        with self.condition:
+            seq = next(self.sequence)
+            self.entries[key] = seq
+            heapq.heappush(self.heap, (deadline, seq, key, fn))
+            self.condition.notify()
+
+    def cancel(self, key):
+        with self.condition:
+            self.entries.pop(key, None)
+
+    def next_due(self):
+        # Waits for the next live entry to come due; None once stopped
+        with self.condition:
+            while not self.stopped:
+                if len(self.heap) == 0:
+                    self.condition.wait()
+                    continue
+                (deadline, seq, key, fn) = self.heap[0]
+                if self.entries.get(key) != seq:
+                    heapq.heappop(self.heap)
+                    continue
+                wait_time = (deadline - datetime.datetime.now()).total_seconds()
+                if wait_time > 0:
+                    self.condition.wait(wait_time)
+                    continue
+                heapq.heappop(self.heap)
+                del self.entries[key]
+                return (key, fn)
+        return None
+
+    def run(self):
+        while True:
+            due = self.next_due()
+            if due is None:
+                return
+            (key, fn) = due
+            try:
+                fn()
+            except Exception as e:
+                log('ERROR: expiry failed ({}: {})'.format(
+                    type(e).__name__, e), key=key)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.started:
+            self.thread.join()
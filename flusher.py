@@ -0,0 +1,60 @@
+import threading
+from logger import log
+
+
+class FlushScheduler():
+    # Coalesces metadata writes. Changed objects are marked dirty, and a
+    # background thread flushes each dirty object at most once per interval.
+    # sync() flushes immediately on the calling thread.
+
+    def __init__(self, flush_fn, interval=2.0):
+        self.flush_fn = flush_fn
+        self.interval = interval
+        self.dirty = set()
+        self.lock = threading.Lock()
+        # Only one flush at a time, so writes are queued in the order
+        # their contents were taken
+        self.flush_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def mark_dirty(self, key):
+        with self.lock:
+            self.dirty.add(key)
+
+    def discard(self, key):
+        with self.lock:
+            self.dirty.discard(key)
+
+    def take_dirty(self, key=None):
+        with self.lock:
+            if key is None:
+                keys = list(self.dirty)
+                self.dirty.clear()
+            elif key in self.dirty:
+                keys = [key]
+                self.dirty.remove(key)
+            else:
+                keys = []
+        return keys
+
+    def sync(self, key=None):
+        with self.flush_lock:
+            for k in self.take_dirty(key):
+                try:
+                    self.flush_fn(k)
+                except Exception as e:
+                    # Try again on the next pass
+                    log('ERROR: flush failed ({}: {})'.format(
+                        type(e).__name__, e), key=k)
+                    self.mark_dirty(k)
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.sync()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        self.sync()
@@ -2,8 +2,82 @@ import sys
 import os
 import shutil
 import glob
+import gzip
+import hashlib
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from logger import log
 
+# Staged and replaced versions of a study sit next to it during an update.
+# Names starting with '.' are not loaded as studies.
+STAGING_PREFIX = '.staging_'
+OLD_PREFIX = '.old_'
+MANIFEST_FILE = 'manifest.json'
+# Files in a study's folder that come from its upload; anything else (e.g.
+# meta.json) is server state and is kept across updates
+IMPORTED_FILES = ['exp.js', 'exp.js.gz', MANIFEST_FILE, 'resources']
+# Uploads are received into this folder inside the staging folder
+UPLOAD_DIR = '.upload'
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Log progress every this many bytes received
+UPLOAD_PROGRESS_INTERVAL = 64 * 1024 * 1024
+# Threads for per-file import work (writing, hashing and linking files).
+# hashlib and file I/O release the GIL, so threads run this in parallel.
+IMPORT_WORKERS = 4
+
+
+class ProgressLog():
+    # Logs bytes received across import threads, every UPLOAD_PROGRESS_INTERVAL
+
+    def __init__(self, study_name, num_files):
+        self.study_name = study_name
+        self.num_files = num_files
+        self.received = 0
+        self.files_done = 0
+        self.next_progress = UPLOAD_PROGRESS_INTERVAL
+        self.lock = threading.Lock()
+
+    def on_bytes(self, n):
+        with self.lock:
+            self.received += n
+            if self.received >= self.next_progress:
+                log('Received {} MB ({} of {} files done)'.format(
+                    self.received // (1024 * 1024),
+                    self.files_done,
+                    self.num_files
+                ), study=self.study_name)
+                self.next_progress += UPLOAD_PROGRESS_INTERVAL
+
+    def on_file_done(self):
+        with self.lock:
+            self.files_done += 1
+
+def receive_file(f, upload_path, progress):
+    f['full_path'] = os.path.join(upload_path, f['name'])
+    h = hashlib.sha256()
+    with open(f['full_path'], 'wb') as dest_file:
+        while True:
+            chunk = f['stream'].read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+            dest_file.write(chunk)
+            progress.on_bytes(len(chunk))
+    f['hash'] = h.hexdigest()
+    progress.on_file_done()
+
+def receive_files(study_name, study_files, upload_path, executor):
+    # Writes each uploaded file's stream to upload_path, hashing it on the
+    # way. Sets each file's 'full_path' and 'hash'.
+    os.makedirs(upload_path)
+    progress = ProgressLog(study_name, len(study_files))
+    # list() waits for all files, and raises the first error
+    list(executor.map(
+        lambda f: receive_file(f, upload_path, progress), study_files))
+    log('Received {} files ({} bytes)'.format(
+        len(study_files), progress.received), study=study_name)
+
 def import_js(study_name, study_files, study_path):
     log('Copying js', study=study_name)
     js_file_path = None
@@ -42,11 +116,18 @@ def import_js(study_name, study_files, study_path):
     return js_file_path
 
 
-def import_resources(study_name, study_files, js_file_path, study_path):
-    # Copy the uploaded study resources and make them available in the study
+def import_resources(study_name, study_files, js_file_path, study_path,
+        blob_store, executor):
+    # Link the uploaded study resources into the study from the blob store,
+    # and make them available in the study.
+    # Returns the study's resource table: one entry per resource, with the
+    # hash of its contents
     log('Copying resources', study=study_name)
     os.makedirs(os.path.join(study_path, 'resources'))
     resources = []
+    resource_table = []
+    # Resource paths are numbered in upload order, before any linking
+    resource_files = []
     for f in study_files:
         if not f['name'].startswith('resources_'):
             continue
@@ -56,9 +137,21 @@ def import_resources(study_name, study_files, js_file_path, study_path):
         idx = f['name'].rfind('.')
         if idx > -1:
             extension = f['name'][idx:]
-        resource_path = 'resources/{}{}'.format(len(resources),extension)
-        shutil.copy(
-            f['full_path'], os.path.join(study_path, resource_path))
+        resource_path = 'resources/{}{}'.format(
+            len(resource_files), extension)
+        resource_files.append((f, resource_path))
+    list(executor.map(
+        lambda item: blob_store.add(
+            item[0]['full_path'], os.path.join(study_path, item[1]),
+            digest=item[0]['hash'], move=True),
+        resource_files
+    ))
+    for (f, resource_path) in resource_files:
+        resource_table.append({
+            'name': f['path'][len('html/resources/'):],
+            'path': resource_path,
+            'hash': f['hash']
+        })
         resources.append(
             '{}name: "{}", path: "{}"{}'.format(
                 '{',
@@ -100,14 +193,122 @@ psychoJS.start({}configURL: \'config.json\', expInfo: expInfo, resources: resour
 
     with open(js_file_path, 'w', encoding='utf-8') as f:
         f.write(contents.replace(replace_str, resource_str, 1))
+    return resource_table
+
+def write_manifest(study_path, resource_table):
+    with open(os.path.join(study_path, MANIFEST_FILE), 'w') as f:
+        json.dump({'resources': resource_table}, f, indent=2)
+
+def read_manifest(study_path):
+    try:
+        with open(os.path.join(study_path, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
 
-def import_study(study_name, study_files, path_root, replace=False):
+def log_changes(study_name, old_manifest, resource_table):
+    if old_manifest is None:
+        return
+    old_hashes = {r['name']: r['hash'] for r in old_manifest['resources']}
+    new_hashes = {r['name']: r['hash'] for r in resource_table}
+    unchanged = [
+        name for name in new_hashes if old_hashes.get(name) == new_hashes[name]
+    ]
+    log('{} resources unchanged, {} changed or added, {} removed'.format(
+        len(unchanged),
+        len(new_hashes) - len(unchanged),
+        len([name for name in old_hashes if name not in new_hashes])
+    ), study=study_name)
+
+def compress_js(study_name, js_file_path):
+    # Precompressed copy of exp.js, sent to clients that accept gzip
+    log('Compressing js', study=study_name)
+    with open(js_file_path, 'rb') as f:
+        contents = f.read()
+    gz_path = js_file_path + '.gz'
+    with open(gz_path + '.tmp', 'wb') as f:
+        f.write(gzip.compress(contents, compresslevel=9, mtime=0))
+    os.replace(gz_path + '.tmp', gz_path)
+
+def stage_study(study_name, study_files, path_root, blob_store,
+        replace=False):
+    # Imports the study into a staging folder next to it, leaving any current
+    # version in place (and serving) until swap_in_study().
+    # study_files: dicts with the file's upload 'path', a safe 'name' and its
+    # 'stream'. Each file is written once; resources are then moved into the
+    # blob store (or dropped, if it already has them).
+    # Returns the staging folder's path.
+    study_path = os.path.join(path_root, study_name)
+    if os.path.exists(study_path) and not replace:
+        raise ValueError('Study already exists')
+    staging_path = os.path.join(path_root, STAGING_PREFIX + study_name)
+    if os.path.exists(staging_path):
+        shutil.rmtree(staging_path)
+    os.makedirs(staging_path)
+    try:
+        upload_path = os.path.join(staging_path, UPLOAD_DIR)
+        with ThreadPoolExecutor(max_workers=IMPORT_WORKERS) as executor:
+            receive_files(study_name, study_files, upload_path, executor)
+            js_file_path = import_js(study_name, study_files, staging_path)
+            resource_table = import_resources(study_name, study_files,
+                js_file_path, staging_path, blob_store, executor)
+        compress_js(study_name, js_file_path)
+        write_manifest(staging_path, resource_table)
+        shutil.rmtree(upload_path)
+    except:
+        shutil.rmtree(staging_path)
+        raise
+    log_changes(study_name, read_manifest(study_path), resource_table)
+    return staging_path
+
+def clean_up_imports(path_root):
+    # Removes what interrupted imports left behind, restoring the previous
+    # version of a study if the new one never made it into place
+    for name in os.listdir(path_root):
+        path = os.path.join(path_root, name)
+        if name.startswith(OLD_PREFIX):
+            study_path = os.path.join(path_root, name[len(OLD_PREFIX):])
+            if not os.path.exists(study_path):
+                log('Restoring previous version', study=name[len(OLD_PREFIX):])
+                os.rename(path, study_path)
+                continue
+        elif not name.startswith(STAGING_PREFIX):
+            continue
+        log('Removing unfinished import {}'.format(name))
+        shutil.rmtree(path)
+
+def link_or_copy(source, dest):
+    if os.path.isdir(source):
+        shutil.copytree(source, dest, copy_function=link_or_copy)
+        return
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copy2(source, dest)
+
+def swap_in_study(study_name, staging_path, path_root, blob_store):
+    # Replaces the study's files with the staged version, keeping the files
+    # the server keeps there (e.g. meta.json). Those are linked (or copied)
+    # into the staged version, never moved, so whichever step a crash
+    # interrupts, either the live or the .old_ folder still has them and
+    # clean_up_imports() puts that back. The caller must keep them from
+    # being written meanwhile.
     study_path = os.path.join(path_root, study_name)
     if os.path.exists(study_path):
-        if not replace:
-            raise ValueError('Study already exists')
-        log('Removing current files', study=study_name)
-        shutil.rmtree(study_path)
-    os.makedirs(study_path)
-    js_file_path = import_js(study_name, study_files, study_path)
-    import_resources(study_name, study_files, js_file_path, study_path)
+        for name in os.listdir(study_path):
+            if name not in IMPORTED_FILES:
+                link_or_copy(
+                    os.path.join(study_path, name),
+                    os.path.join(staging_path, name)
+                )
+        old_path = os.path.join(path_root, OLD_PREFIX + study_name)
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+        os.rename(study_path, old_path)
+        os.rename(staging_path, study_path)
+        shutil.rmtree(old_path)
+        # Blobs only the replaced version used
+        blob_store.collect_garbage()
+    else:
+        os.rename(staging_path, study_path)
+    log('New version in place', study=study_name)
@@ -0,0 +1,79 @@
+import json
+import os
+from logger import log
+
+# Number of log records after which the snapshot is rewritten
+COMPACT_AFTER = 200
+
+
+def write_file_atomic(path, contents):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        f.write(contents)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+class MetadataJournal():
+    # Metadata stored as a JSON snapshot plus an append-only log of the
+    # changes made since the snapshot was written.
+    # Records must be idempotent (set values rather than adjust them):
+    # a crash between writing a snapshot and truncating the log means
+    # records already in the snapshot get replayed on top of it.
+
+    def __init__(self, snapshot_path, compact_after=COMPACT_AFTER):
+        self.snapshot_path = snapshot_path
+        self.log_path = snapshot_path + '.log'
+        self.compact_after = compact_after
+        # Records appended since the last snapshot
+        self.num_records = 0
+
+    def load(self, default=None):
+        # Returns the snapshot contents and the records logged since;
+        # `default` is returned if there is no snapshot yet
+        state = default
+        try:
+            with open(self.snapshot_path) as f:
+                state = json.loads(f.read())
+        except FileNotFoundError:
+            pass
+        records = []
+        try:
+            with open(self.log_path, 'r+') as f:
+                end = 0
+                for line in iter(f.readline, ''):
+                    try:
+                        if not line.endswith('\n'):
+                            raise ValueError()
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # Interrupted append; the change was never committed.
+                        # Cut it off so later appends start on a clean line.
+                        log('Dropping partial journal record in {}'.format(
+                            self.log_path))
+                        f.truncate(end)
+                        break
+                    end = f.tell()
+        except FileNotFoundError:
+            pass
+        self.num_records = len(records)
+        return state, records
+
+    def needs_compaction(self, new_records=0):
+        return self.num_records + new_records >= self.compact_after
+
+    def on_records(self, count):
+        self.num_records += count
+
+    def on_snapshot(self):
+        self.num_records = 0
+
+    def append(self, records):
+        with open(self.log_path, 'a') as f:
+            f.write(''.join(json.dumps(r) + '\n' for r in records))
+
+    def write_snapshot(self, contents):
+        write_file_atomic(self.snapshot_path, contents)
+        # Everything in the log is now part of the snapshot
+        open(self.log_path, 'w').close()
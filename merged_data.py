@@ -0,0 +1,225 @@
+import csv
+import io
+import json
+import os
+import threading
+from data_archive import compress_stream
+from journal import write_file_atomic
+from logger import log
+
+ROWS_FILE = 'rows.csv'
+STATE_FILE = 'state.json'
+MERGED_FILE = 'merged.csv.gz'
+# Leading columns of every row
+TOKEN_COLUMN = 'session_token'
+RUN_COLUMN = 'run_id'
+# Bytes of CSV text compressed at a time while compacting
+COMPACT_CHUNK_SIZE = 256 * 1024
+# Data files are read and written with this encoding; undecodable bytes are
+# carried through as they are
+ENCODING = 'utf-8'
+ENCODING_ERRORS = 'surrogateescape'
+
+
+def read_csv_rows(path):
+    # (header, rows) of a data file, skipping blank rows
+    with open(path, newline='', encoding=ENCODING,
+            errors=ENCODING_ERRORS) as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        return (header, [row for row in reader if any(row)])
+
+def name_columns(header, taken):
+    # Names for a header's columns, unique among themselves and not in
+    # taken: a repeated name gets a numbered suffix (rt, rt_2, ...)
+    names = []
+    seen = set(taken)
+    for column in header:
+        name = column
+        n = 1
+        while name in seen:
+            n += 1
+            name = '{}_{}'.format(column, n)
+        seen.add(name)
+        names.append(name)
+    return names
+
+
+class MergedDataset():
+    # All of a run's CSV data in one place, kept up to date as sessions are
+    # saved. Rows are appended to rows.csv with a session_token and run_id
+    # column, the session's arguments, then the file's own columns; a
+    # column whose name is already used by one before it is renamed with a
+    # numbered suffix rather than overwriting it. Columns
+    # are numbered in the order they first appear (listed in state.json), so
+    # earlier rows may be shorter than later ones.
+    # compact() turns that into merged.csv.gz: one header, every row padded
+    # to it. New rows are added to it as another gzip member while the
+    # columns stay the same; it is rewritten when they change.
+
+    def __init__(self, path):
+        self.path = path
+        self.rows_path = os.path.join(path, ROWS_FILE)
+        self.state_path = os.path.join(path, STATE_FILE)
+        self.merged_path = os.path.join(path, MERGED_FILE)
+        # Guards columns and size
+        self.lock = threading.Lock()
+        # One compaction at a time
+        self.compact_lock = threading.Lock()
+        self.columns = []
+        # Bytes of rows.csv holding complete rows
+        self.size = 0
+        # What merged.csv.gz holds: number of columns, bytes of rows.csv,
+        # and its own size
+        self.compacted = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        self.columns = state['columns']
+        self.size = state['size']
+        self.compacted = state.get('compacted')
+        # Cut off rows appended after the state was last saved, and
+        # anything added to merged.csv.gz by an interrupted compact()
+        for (path, size) in [(self.rows_path, self.size),
+                (self.merged_path,
+                    self.compacted['file_size'] if self.compacted else 0)]:
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                log('Truncating {}'.format(path))
+                os.truncate(path, size)
+
+    def save_state(self):
+        write_file_atomic(self.state_path, json.dumps({
+            'columns': self.columns,
+            'size': self.size,
+            'compacted': self.compacted
+        }))
+
+    def append_session(self, token, run_id, session_args, data_paths):
+        # Adds the rows of a session's CSV data files. Returns them, as
+        # dicts of column -> value.
+        rows = []
+        session_values = {TOKEN_COLUMN: token, RUN_COLUMN: str(run_id)}
+        session_values.update(zip(
+            name_columns(list(session_args), session_values),
+            (str(value) for value in session_args.values())
+        ))
+        for path in data_paths:
+            (header, file_rows) = read_csv_rows(path)
+            columns = name_columns(header, session_values)
+            if columns != header:
+                log('WARN: renamed data columns {}'.format([
+                    '{} -> {}'.format(old, new)
+                        for (old, new) in zip(header, columns) if old != new
+                ]), path=path)
+            for row in file_rows:
+                values = dict(session_values)
+                values.update(zip(columns, row))
+                rows.append(values)
+        if len(rows) == 0:
+            return rows
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            index = {column: i for i, column in enumerate(self.columns)}
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for values in rows:
+                for column in values:
+                    if column not in index:
+                        index[column] = len(self.columns)
+                        self.columns.append(column)
+                line = [''] * len(self.columns)
+                for (column, value) in values.items():
+                    line[index[column]] = value
+                writer.writerow(line)
+            with open(self.rows_path, 'ab') as f:
+                f.seek(self.size)
+                f.truncate()
+                f.write(buffer.getvalue().encode(ENCODING, ENCODING_ERRORS))
+                self.size = f.tell()
+            self.save_state()
+        return rows
+
+    def exists(self):
+        return self.size > 0
+
+    def is_compacted(self):
+        with self.lock:
+            return self.compacted is not None and \
+                self.compacted['columns'] == len(self.columns) and \
+                self.compacted['size'] == self.size
+
+    def read_rows(self, start, stop):
+        # Parsed rows from the given byte range of rows.csv
+        def generate_lines(f, remaining):
+            for line in f:
+                if remaining <= 0:
+                    break
+                line = line[:remaining]
+                remaining -= len(line)
+                yield line.decode(ENCODING, ENCODING_ERRORS)
+        with open(self.rows_path, 'rb') as f:
+            f.seek(start)
+            for row in csv.reader(generate_lines(f, stop - start)):
+                yield row
+
+    def generate_csv(self, rows, num_columns, header=None):
+        # Encoded CSV text in pieces of about COMPACT_CHUNK_SIZE
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if header is not None:
+            writer.writerow(header)
+        for row in rows:
+            writer.writerow(row + [''] * (num_columns - len(row)))
+            if buffer.tell() >= COMPACT_CHUNK_SIZE:
+                yield buffer.getvalue().encode(ENCODING, ENCODING_ERRORS)
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue().encode(ENCODING, ENCODING_ERRORS)
+
+    def compact(self):
+        # Brings merged.csv.gz up to date with the rows appended so far
+        with self.compact_lock:
+            with self.lock:
+                columns = list(self.columns)
+                size = self.size
+                compacted = self.compacted
+            if size == 0 or (compacted is not None and
+                    compacted['columns'] == len(columns) and
+                    compacted['size'] == size):
+                return
+            if compacted is not None and \
+                    compacted['columns'] == len(columns) and \
+                    os.path.exists(self.merged_path):
+                # Same header; add the new rows
+                with open(self.merged_path, 'r+b') as f:
+                    # Dropping anything left by a failed compaction
+                    f.seek(compacted['file_size'])
+                    f.truncate()
+                    for data in compress_stream(self.generate_csv(
+                            self.read_rows(compacted['size'], size),
+                            len(columns))):
+                        f.write(data)
+                    file_size = f.tell()
+                log('Added to merged data', path=self.path)
+            else:
+                temp_path = self.merged_path + '.tmp'
+                with open(temp_path, 'wb') as f:
+                    for data in compress_stream(self.generate_csv(
+                            self.read_rows(0, size), len(columns),
+                            header=columns)):
+                        f.write(data)
+                    file_size = f.tell()
+                os.replace(temp_path, self.merged_path)
+                log('Rewrote merged data', path=self.path)
+            with self.lock:
+                self.compacted = {
+                    'columns': len(columns),
+                    'size': size,
+                    'file_size': file_size
+                }
+                self.save_state()
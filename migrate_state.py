@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# One-shot copy of all server state between state backends, e.g.
+#   ./migrate_state.py json sqlite
+# Stop the server before migrating.
+import argparse
+from logger import log
+from state_backend import make_state_backend, SERVER_KEY
+
+
+def migrate(source, target):
+    for study in source.list_studies():
+        meta = source.load(study)
+        if meta is not None:
+            log('Migrating study metadata', study=study)
+            target.save_snapshot(study, meta)
+    meta = source.load(SERVER_KEY)
+    if meta is not None:
+        log('Migrating {} participant codes'.format(
+            len(meta.get('participant_codes', []))))
+        target.save_snapshot(SERVER_KEY, meta)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Copy server state from one state backend to another.')
+    parser.add_argument('source', choices=['json', 'sqlite'])
+    parser.add_argument('target', choices=['json', 'sqlite'])
+    parser.add_argument('--study-path', default='./study/')
+    parser.add_argument('--db-path', default=None,
+        help='SQLite database (default: <study-path>/state.db)')
+    args = parser.parse_args()
+    if args.source == args.target:
+        parser.error('source and target are the same backend')
+    source = make_state_backend(args.source, args.study_path, args.db_path)
+    target = make_state_backend(args.target, args.study_path, args.db_path)
+    migrate(source, target)
+    source.close()
+    target.close()
+    log('Done.')
@@ -0,0 +1,132 @@
+import datetime
+import mimetypes
+import os
+import posixpath
+import urllib.parse
+from flask import Response
+from werkzeug.http import http_date
+from werkzeug.wsgi import wrap_file
+try:
+    from werkzeug.utils import safe_join
+except ImportError:
+    from werkzeug.security import safe_join
+
+# Bytes per read when a range has to be copied through Python
+RESOURCE_CHUNK_SIZE = 256 * 1024
+# Resource names are reused when a study is re-imported, so clients
+# revalidate (by ETag / Last-Modified) rather than cache blindly
+RESOURCE_CACHE_CONTROL = 'no-cache'
+OFFLOAD_MODES = ['x-accel-redirect', 'x-sendfile']
+
+
+def get_etag(stat_result):
+    return '{}-{}'.format(stat_result.st_mtime_ns, stat_result.st_size)
+
+def to_timestamp(date):
+    # Older werkzeug parses HTTP dates as naive UTC datetimes
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.timestamp()
+
+def if_range_matches(request, etag, mtime):
+    # A Range header only applies if the client's copy is still current
+    if 'If-Range' not in request.headers:
+        return True
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    return if_range.date is not None and \
+        int(mtime) <= to_timestamp(if_range.date)
+
+def not_modified(request, etag, mtime):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    return request.if_modified_since is not None and \
+        int(mtime) <= to_timestamp(request.if_modified_since)
+
+def read_range(f, length):
+    try:
+        while length > 0:
+            data = f.read(min(RESOURCE_CHUNK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+def send_resource(request, directory, path):
+    # Sends a file with byte-range support. Returns None if there is no
+    # such file.
+    # Bodies that run to the end of the file are handed to the WSGI server's
+    # file wrapper, so it reads the file itself (waitress, in large blocks
+    # straight into the socket) instead of via a response iterator.
+    full_path = safe_join(directory, path)
+    if full_path is None or not os.path.isfile(full_path):
+        return None
+    f = open(full_path, 'rb')
+    stat_result = os.fstat(f.fileno())
+    size = stat_result.st_size
+    mtime = stat_result.st_mtime
+    etag = get_etag(stat_result)
+
+    if not_modified(request, etag, mtime):
+        f.close()
+        response = Response(status=304)
+    else:
+        (start, stop) = (0, size)
+        status = 200
+        if request.range is not None and if_range_matches(request, etag, mtime):
+            byte_range = request.range.range_for_length(size)
+            if byte_range is not None:
+                (start, stop) = byte_range
+                status = 206
+            elif len(request.range.ranges) == 1:
+                f.close()
+                response = Response(status=416)
+                response.headers['Content-Range'] = 'bytes */{}'.format(size)
+                return response
+            # Multiple ranges: send the whole file
+        f.seek(start)
+        if stop == size:
+            body = wrap_file(request.environ, f, RESOURCE_CHUNK_SIZE)
+        else:
+            body = read_range(f, stop - start)
+        response = Response(
+            body,
+            status=status,
+            mimetype=mimetypes.guess_type(full_path)[0] or
+                'application/octet-stream',
+            direct_passthrough=True
+        )
+        response.content_length = stop - start
+        if status == 206:
+            response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                start, stop - 1, size)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Cache-Control'] = RESOURCE_CACHE_CONTROL
+    response.headers['Last-Modified'] = http_date(mtime)
+    response.set_etag(etag)
+    return response
+
+def send_offloaded(mode, root, location, directory, path):
+    # Leaves sending the file to a front proxy: the response is empty, with a
+    # header naming the file. Returns None if there is no such file.
+    # location is the proxy's internal location that serves root (only used
+    # for X-Accel-Redirect); directory is relative to root.
+    full_path = safe_join(os.path.join(root, directory), path)
+    if full_path is None or not os.path.isfile(full_path):
+        return None
+    response = Response(
+        mimetype=mimetypes.guess_type(full_path)[0] or
+            'application/octet-stream'
+    )
+    if mode == 'x-accel-redirect':
+        relative_path = os.path.relpath(full_path, root).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = urllib.parse.quote(
+            posixpath.join(location, relative_path))
+    elif mode == 'x-sendfile':
+        response.headers['X-Sendfile'] = os.path.abspath(full_path)
+    else:
+        raise ValueError('Unknown offload mode "{}"'.format(mode))
+    return response
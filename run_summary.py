@@ -0,0 +1,191 @@
+import json
+import math
+import os
+import threading
+from journal import write_file_atomic
+
+
+def add_value(stats, value):
+    # stats: [count, sum, sum of squares, min, max]
+    if stats[0] == 0:
+        stats[3] = stats[4] = value
+    else:
+        stats[3] = min(stats[3], value)
+        stats[4] = max(stats[4], value)
+    stats[0] += 1
+    stats[1] += value
+    stats[2] += value * value
+
+def merge_stats(stats, other):
+    if other[0] == 0:
+        return
+    if stats[0] == 0:
+        stats[3:] = other[3:]
+    else:
+        stats[3] = min(stats[3], other[3])
+        stats[4] = max(stats[4], other[4])
+    for i in range(3):
+        stats[i] += other[i]
+
+def new_stats():
+    return [0, 0.0, 0.0, None, None]
+
+def describe(stats):
+    (count, total, squares, low, high) = stats
+    if count == 0:
+        return None
+    mean = total / count
+    sd = math.sqrt(max(squares / count - mean * mean, 0.0))
+    return {'n': count, 'mean': mean, 'sd': sd, 'min': low, 'max': high}
+
+def to_number(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+
+class RunSummary():
+    # Running totals for a run, updated as each session closes (outcome and
+    # duration) and as its data rows are saved (every numeric column), per
+    # group of session argument values. Only sums are kept, so reading the
+    # summary costs the same however many sessions the run has.
+    # Every update bumps seq; get_report() is recomputed only when it
+    # changes.
+    # Updates are counted once: a session's outcome per token, its rows per
+    # data file, so replaying one (e.g. when spooled data is recovered)
+    # changes nothing.
+
+    def __init__(self, path, group_names):
+        self.path = path
+        # Session arguments whose values group sessions
+        self.group_names = sorted(group_names)
+        self.lock = threading.Lock()
+        self.seq = 0
+        # Group key (JSON list of values) -> {
+        #   'complete': n, 'incomplete': n,
+        #   'duration': stats of completed sessions' durations (seconds),
+        #   'columns': {column: stats}
+        # }
+        self.groups = {}
+        # Tokens whose outcome, and 'token/file' whose rows, are counted
+        self.counted_sessions = set()
+        self.counted_files = set()
+        self.report = None
+        self.report_seq = None
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            self.seq = state['seq']
+            self.groups = state['groups']
+            self.counted_sessions = set(state.get('counted_sessions', []))
+            self.counted_files = set(state.get('counted_files', []))
+        except FileNotFoundError:
+            pass
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        write_file_atomic(self.path, json.dumps({
+            'seq': self.seq,
+            'groups': self.groups,
+            'counted_sessions': sorted(self.counted_sessions),
+            'counted_files': sorted(self.counted_files)
+        }))
+
+    def get_max_token(self):
+        # The highest (numeric) session token counted
+        with self.lock:
+            return max((int(token) for token in self.counted_sessions
+                if token.isdigit()), default=0)
+
+    def get_group(self, session_args):
+        key = json.dumps([
+            str(session_args.get(name, '')) for name in self.group_names])
+        if key not in self.groups:
+            self.groups[key] = {
+                'complete': 0,
+                'incomplete': 0,
+                'duration': new_stats(),
+                'columns': {}
+            }
+        return self.groups[key]
+
+    def add_session(self, token, session_args, is_complete, duration):
+        with self.lock:
+            if token in self.counted_sessions:
+                return
+            self.counted_sessions.add(token)
+            group = self.get_group(session_args)
+            if is_complete:
+                group['complete'] += 1
+                add_value(group['duration'], duration)
+            else:
+                group['incomplete'] += 1
+            self.seq += 1
+            self.save()
+
+    def add_rows(self, token, name, session_args, rows, skip_columns=()):
+        # rows: dicts of column -> value, from the session's data file name;
+        # non-numeric values are ignored
+        with self.lock:
+            key = '{}/{}'.format(token, name)
+            if key in self.counted_files:
+                return
+            self.counted_files.add(key)
+            columns = self.get_group(session_args)['columns']
+            for row in rows:
+                for (column, value) in row.items():
+                    number = to_number(value)
+                    if number is None or column in skip_columns:
+                        continue
+                    if column not in columns:
+                        columns[column] = new_stats()
+                    add_value(columns[column], number)
+            self.seq += 1
+            self.save()
+
+    def get_report(self):
+        with self.lock:
+            if self.report_seq != self.seq:
+                self.report = self.build_report()
+                self.report_seq = self.seq
+            return self.report
+
+    def build_report(self):
+        columns = sorted(set(
+            column for group in self.groups.values()
+                for column in group['columns']
+        ))
+        groups = []
+        (complete, incomplete) = (0, 0)
+        durations = new_stats()
+        for key in sorted(self.groups):
+            group = self.groups[key]
+            sessions = group['complete'] + group['incomplete']
+            complete += group['complete']
+            incomplete += group['incomplete']
+            merge_stats(durations, group['duration'])
+            groups.append({
+                'values': json.loads(key),
+                'sessions': sessions,
+                'complete': group['complete'],
+                'completion_rate': group['complete'] / sessions
+                    if sessions > 0 else None,
+                'duration': describe(group['duration']),
+                'columns': {
+                    column: describe(stats)
+                        for (column, stats) in group['columns'].items()
+                }
+            })
+        return {
+            'seq': self.seq,
+            'sessions': complete + incomplete,
+            'complete': complete,
+            'completion_rate': complete / (complete + incomplete)
+                if complete + incomplete > 0 else None,
+            'duration': describe(durations),
+            'group_names': self.group_names,
+            'groups': groups,
+            'columns': columns
+        }
@@ -1,12 +1,22 @@
 #!/usr/bin/env python3
 from waitress import serve
 from flask import Flask, send_from_directory, render_template, jsonify, \
-    request, abort, session, redirect, url_for, send_file, flash
+    request, abort, session, redirect, url_for, flash, \
+    Response, stream_with_context
 from experiment_server import ExperimentServer
+from state_backend import make_state_backend
+from static_cache import StaticAssetCache, IMMUTABLE_CACHE_CONTROL, \
+    REVALIDATE_CACHE_CONTROL
+from access_cache import AccessCache
+from resource_server import send_resource, send_offloaded, OFFLOAD_MODES
+from data_browser import PAGE_LINES
+import csv
 import json
 import os
 from logger import log
 import datetime
+import atexit
+from dateutil.parser import parse as parse_datestr
 from auth import SimpleSessionAuth, Lockout
 from secrets import token_urlsafe
 
@@ -15,6 +25,25 @@ from secrets import token_urlsafe
 SECRET_KEY = token_urlsafe()
 DATA_PATH = './data/'
 STUDY_PATH = './study/'
+# Where server state is kept: 'json' (meta.json / server.json files) or
+# 'sqlite' (STATE_DB_PATH). Switch with migrate_state.py.
+STATE_BACKEND = 'json'
+STATE_DB_PATH = os.path.join(STUDY_PATH, 'state.db')
+# Request handler threads; studies are locked individually, so requests for
+# different studies are handled in parallel
+WAITRESS_THREADS = 16
+# Served from memory; loaded once at startup
+STATIC_ASSET_DIRS = ['js', 'css']
+# Let a front proxy send study files and the PsychoJS library once access has
+# been checked: None, 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache,
+# lighttpd). For nginx, OFFLOAD_STUDY_LOCATION and OFFLOAD_LIB_LOCATION must
+# be internal locations aliased to STUDY_PATH and to this directory.
+OFFLOAD_MODE = None
+OFFLOAD_STUDY_LOCATION = '/_offload/study/'
+OFFLOAD_LIB_LOCATION = '/_offload/lib/'
+# How long (seconds) a participant's study access decision is reused for
+# their next requests; revoking access clears it immediately
+ACCESS_CACHE_TTL = 10
 USERS = {
     'admin': {
         'password': 'default',
@@ -44,15 +73,23 @@ def user_can_access_study(study):
 ALLOW_UNAUTHED_STUDY_ACCESS = False
 ATTEMPTS_BEFORE_LOCKOUT = 10
 LOCKOUT_DURATION = datetime.timedelta(minutes=10)
+MAX_BULK_INVITE_CODES = 10000
+INVITE_CODE_DURATIONS = {
+    'hour': datetime.timedelta(hours=1),
+    'day': datetime.timedelta(days=1),
+    'week': datetime.timedelta(weeks=1)
+}
 
 
 def init():
     app = Flask(__name__, static_url_path='', static_folder='static')
     app.secret_key = SECRET_KEY
+    access_cache = AccessCache(ACCESS_CACHE_TTL)
     auth = SimpleSessionAuth(
         USERS,
         timeout_attempts=ATTEMPTS_BEFORE_LOCKOUT,
-        timeout_duration=LOCKOUT_DURATION
+        timeout_duration=LOCKOUT_DURATION,
+        on_revoke=access_cache.invalidate_session
     )
 
     def user_is_admin():
@@ -69,10 +106,13 @@ def init():
             readable_name=True,
             name_bytes=6
         )
+        return (username, make_remove_temp_user_fn(username))
+
+    def make_remove_temp_user_fn(username):
         def remove_temp_user_fn():
             log('Removing temp user',user=username)
             auth.delete_user(username)
-        return (username, remove_temp_user_fn)
+        return remove_temp_user_fn
 
     def code_generator_fn(study, code=None):
         (username, remove_fn) = make_temp_user_for_study(study, username=code)
@@ -82,9 +122,38 @@ def init():
             'on_remove': remove_fn
         }
 
-    exp_server = ExperimentServer(DATA_PATH, STUDY_PATH, code_generator_fn)
+    def bulk_code_generator_fn(study, count):
+        usernames = auth.create_temporary_users(
+            count,
+            properties={
+                'permissions': {
+                    'studies': [study]
+                }
+            },
+            readable_name=True,
+            name_bytes=6
+        )
+        return [{
+            'code': username,
+            'study': study,
+            'on_remove': make_remove_temp_user_fn(username)
+        } for username in usernames]
+
+    exp_server = ExperimentServer(
+        DATA_PATH,
+        STUDY_PATH,
+        code_generator_fn,
+        state_backend=make_state_backend(
+            STATE_BACKEND, STUDY_PATH, STATE_DB_PATH),
+        bulk_code_generator_fn=bulk_code_generator_fn,
+        access_changed_fn=access_cache.invalidate_study
+    )
 
     exp_server.load_experiments()
+    # Make sure queued data is on disk before the process exits
+    atexit.register(exp_server.shutdown)
+    app.extensions['exp_server'] = exp_server
+    app.extensions['auth'] = auth
     def admin_access_allowed(study=None):
         if study is not None:
             try:
@@ -101,12 +170,58 @@ def init():
     def study_access_allowed(study):
         if not exp_server.study_available(study):
             return False
-        if ALLOW_UNAUTHED_STUDY_ACCESS or \
-                exp_server.get_experiment(study).get_access_type() == 'anyone':
+        run = exp_server.get_experiment(study).run
+        if run is None:
+            return False
+        if ALLOW_UNAUTHED_STUDY_ACCESS or run.access_type == 'anyone':
             return True
-        return auth.is_session_authenticated(
-            permission_fn=user_can_access_study(study)
-        )
+        user_key = auth.get_session_key()
+        if user_key is None:
+            return False
+        cache_key = (user_key, study, run.id)
+        allowed = access_cache.get(cache_key)
+        if allowed is None:
+            generation = access_cache.generation
+            allowed = auth.is_session_authenticated(
+                permission_fn=user_can_access_study(study)
+            )
+            access_cache.put(cache_key, allowed, generation)
+        return allowed
+
+    if OFFLOAD_MODE is not None and OFFLOAD_MODE not in OFFLOAD_MODES:
+        raise ValueError('Unknown offload mode "{}"'.format(OFFLOAD_MODE))
+    if OFFLOAD_MODE is None:
+        static_assets = StaticAssetCache(app.root_path, STATIC_ASSET_DIRS)
+    else:
+        log('Offloading file transfers with {}'.format(OFFLOAD_MODE))
+
+    def send_static_asset(directory, filename, immutable=False):
+        if OFFLOAD_MODE is not None:
+            response = send_offloaded(OFFLOAD_MODE, app.root_path,
+                OFFLOAD_LIB_LOCATION, directory, filename)
+            if response is not None:
+                response.headers['Cache-Control'] = \
+                    IMMUTABLE_CACHE_CONTROL if immutable else \
+                    REVALIDATE_CACHE_CONTROL
+        else:
+            response = static_assets.make_response(
+                request, directory, filename, immutable=immutable)
+        if response is None:
+            abort(404)
+        return response
+
+    def send_study_file(study, directory, path):
+        # directory is relative to the study's folder
+        if OFFLOAD_MODE is not None:
+            response = send_offloaded(OFFLOAD_MODE, STUDY_PATH,
+                OFFLOAD_STUDY_LOCATION, os.path.join(study, directory), path)
+        else:
+            response = send_resource(
+                request, os.path.join(exp_server.get_path(study), directory),
+                path)
+        if response is None:
+            abort(404)
+        return response
 
     if not os.path.exists(DATA_PATH):
         log('Creating data directory at {}'.format(DATA_PATH))
@@ -185,7 +300,8 @@ def init():
             'run_details.html',
             study=exp,
             user=auth.get_authed_user(),
-            run=exp.run
+            run=exp.run,
+            summary=exp.get_run_summary(exp.run).get_report()
         )
 
     @app.route('/manage/<study>/activate', methods=['GET', 'POST'])
@@ -288,9 +404,150 @@ def init():
     def download_study_data(study):
         if not admin_access_allowed(study=study):
             abort(404)
-        with exp_server.get_study_data_archive(study) as data_file:
-            # cache_timeout: prevent Flask from caching data archive
-            return send_file(data_file, as_attachment=True, cache_timeout=-1)
+        return Response(
+            stream_with_context(exp_server.get_study_data_archive(study)),
+            mimetype='application/gzip',
+            headers={
+                'Content-Disposition':
+                    'attachment; filename=study_data_{}.tar.gz'.format(study),
+                'Cache-Control': 'no-store'
+            }
+        )
+
+    def get_time_param(name):
+        # ISO format local time, or None
+        value = request.values.get(name, None)
+        if value is None or value == '':
+            return None
+        time = parse_datestr(value)
+        if time.tzinfo is not None:
+            time = time.astimezone().replace(tzinfo=None)
+        return time.isoformat()
+
+    @app.route('/manage/<study>/data/changes', methods=['GET'])
+    def download_study_data_changes(study):
+        # Data files written since a cursor: the `cursor` parameter, or where
+        # the user's last export (without one) left off. The new cursor is
+        # in the X-Export-Cursor header, or the JSON listing with format=json.
+        # Only a full, unfiltered archive moves the user's stored cursor;
+        # anything less would skip files they haven't got.
+        if not admin_access_allowed(study=study):
+            abort(404)
+        user = auth.get_authed_user()
+        cursor = request.values.get('cursor', None)
+        try:
+            if cursor is None:
+                after = exp_server.get_export_cursor(study, user)
+            else:
+                after = int(cursor)
+            run = request.values.get('run', '')
+            run = int(run) if run != '' else None
+            since = get_time_param('since')
+            until = get_time_param('until')
+        except ValueError:
+            abort(400)
+        (records, new_cursor) = exp_server.get_study_data_changes(
+            study, after, run=run, since=since, until=until)
+        if request.values.get('format', None) == 'json':
+            return jsonify({'cursor': new_cursor, 'files': records})
+        move_cursor = cursor is None and run is None and since is None and \
+            until is None
+        # A file written more than once is sent once
+        files = list(dict.fromkeys(record['file'] for record in records))
+        def generate_archive():
+            for data in exp_server.get_study_data_files_archive(study, files):
+                yield data
+            # Only move the user's cursor once they have everything
+            if move_cursor:
+                exp_server.set_export_cursor(study, user, new_cursor)
+        return Response(
+            stream_with_context(generate_archive()),
+            mimetype='application/gzip',
+            headers={
+                'Content-Disposition':
+                    'attachment; filename=study_data_{}_{}-{}.tar.gz'.format(
+                        study, after, new_cursor),
+                'Cache-Control': 'no-store',
+                'X-Export-Cursor': str(new_cursor)
+            }
+        )
+
+    @app.route('/manage/<study>/data/merged/<int:run>', methods=['GET'])
+    def download_merged_data(study, run):
+        if not admin_access_allowed(study=study):
+            abort(404)
+        path = exp_server.get_merged_data_file(study, run)
+        if path is None:
+            abort(404)
+        response = send_resource(
+            request, os.path.dirname(path), os.path.basename(path))
+        if response is None:
+            abort(404)
+        response.mimetype = 'application/gzip'
+        response.headers['Content-Disposition'] = \
+            'attachment; filename=study_data_{}_run_{}.csv.gz'.format(
+                study, run)
+        return response
+
+    @app.route('/manage/<study>/browse/', methods=['GET'])
+    def browse_study_data(study):
+        if not admin_access_allowed(study=study):
+            abort(404)
+        run_ids = exp_server.get_data_run_ids(study)
+        run = request.values.get('run', '')
+        if run.isdigit():
+            run = int(run)
+        elif len(run_ids) > 0:
+            run = run_ids[-1]
+        else:
+            run = None
+        return render_template(
+            'data_browser.html',
+            study=exp_server.get_experiment(study),
+            user=auth.get_authed_user(),
+            run_ids=run_ids,
+            run=run,
+            sessions=exp_server.get_data_sessions(study, run)
+                if run is not None else []
+        )
+
+    @app.route('/manage/<study>/browse/<int:run>/<name>', methods=['GET'])
+    def browse_data_file(study, run, name):
+        if not admin_access_allowed(study=study):
+            abort(404)
+        try:
+            page = int(request.values.get('page', 0))
+            (lines, more, num_lines) = exp_server.get_data_file_page(
+                study, run, name, page)
+        except (ValueError, FileNotFoundError):
+            abort(404)
+        lines = [line.decode('utf-8', 'replace') for line in lines]
+        header = None
+        is_csv = name.lower().endswith('.csv')
+        if is_csv:
+            # One record per line, which may hold quoted newlines
+            rows = [next(csv.reader([line]), []) for line in lines]
+            if page > 0:
+                (header_lines, _, _) = exp_server.get_data_file_page(
+                    study, run, name, 0)
+                header = next(csv.reader(
+                    [header_lines[0].decode('utf-8', 'replace')]), None)
+        else:
+            rows = [[line] for line in lines]
+        return render_template(
+            'data_file.html',
+            study=exp_server.get_experiment(study),
+            user=auth.get_authed_user(),
+            run=run,
+            name=name,
+            page=page,
+            first_line=page * PAGE_LINES + 1,
+            unit='Records' if is_csv else 'Lines',
+            header=header,
+            rows=rows,
+            more=more,
+            num_lines=num_lines
+        )
 
     @app.route('/manage/<study>/delete/', methods=['GET', 'POST'])
     def delete_study(study):
@@ -309,14 +566,25 @@ def init():
             user=auth.get_authed_user()
         )
 
+    def get_invite_code_timeout():
+        try:
+            return datetime.datetime.now() + \
+                INVITE_CODE_DURATIONS[request.values['timeout']]
+        except:
+            raise ValueError('Invalid timeout specified.')
+
+    def invite_codes_allowed(study):
+        if not admin_access_allowed(study=study):
+            return False
+        exp = exp_server.get_experiment(study)
+        return exp.is_active() and exp.get_access_type() in [
+            'invite-only', 'invite-and-url']
+
     @app.route('/manage/<study>/invite/', methods=['GET', 'POST'])
     def create_participant_code(study):
-        if not admin_access_allowed(study=study):
+        if not invite_codes_allowed(study):
             abort(404)
         exp = exp_server.get_experiment(study)
-        if not exp.is_active() or exp.get_access_type() not in [
-                'invite-only', 'invite-and-url']:
-            abort(404)
         if request.method == 'POST':
             try:
                 if 'revoke-codes' in request.values:
@@ -324,14 +592,7 @@ def init():
                     #TODO: HACK for convenience
                     raise ValueError(
                         'Revoked all invite codes for {}'.format(study))
-                try:
-                    timeout = datetime.datetime.now() + {
-                        'hour': datetime.timedelta(hours=1),
-                        'day': datetime.timedelta(days=1),
-                        'week': datetime.timedelta(weeks=1)
-                    }[request.values['timeout']]
-                except:
-                    raise ValueError('Invalid timeout specified.')
+                timeout = get_invite_code_timeout()
                 exp_server.add_invite_code(
                     study,
                     timeout=timeout,
@@ -347,6 +608,50 @@ def init():
             codes=codes
         )
 
+    @app.route('/manage/<study>/invite/bulk', methods=['POST'])
+    def create_bulk_participant_codes(study):
+        if not invite_codes_allowed(study):
+            abort(404)
+        try:
+            timeout = get_invite_code_timeout()
+            try:
+                count = int(request.values['count'])
+                session_limit = int(request.values.get('sessionLimit', 1))
+                if count < 1 or count > MAX_BULK_INVITE_CODES or \
+                        session_limit < 1:
+                    raise ValueError()
+            except:
+                raise ValueError(
+                    'Please enter between 1 and {} codes of at least one session each.'.format(
+                        MAX_BULK_INVITE_CODES))
+        except ValueError as e:
+            flash(str(e))
+            return redirect(url_for('create_participant_code', study=study))
+        log('Creating {} invite codes'.format(count), study=study)
+        codes = exp_server.add_invite_codes(
+            study,
+            count,
+            timeout=timeout,
+            session_limit=session_limit
+        )
+        def generate_csv():
+            yield 'code,url,sessions,expires\n'
+            for code in codes:
+                yield '{},{},{},{}\n'.format(
+                    code,
+                    url_for('participate_code', code=code, _external=True),
+                    session_limit,
+                    timeout.isoformat()
+                )
+        return Response(
+            stream_with_context(generate_csv()),
+            mimetype='text/csv',
+            headers={
+                'Content-Disposition':
+                    'attachment; filename=invite_codes_{}.csv'.format(study)
+            }
+        )
+
     @app.route('/manage/new/', methods=['GET', 'POST'])
     def new_study():
         if not admin_access_allowed():
@@ -469,67 +774,71 @@ def init():
 
     @app.route('/css/<path>')
     def send_css(path):
-        return send_from_directory('css', path)
+        return send_static_asset('css', path)
 
     @app.route('/study/<study>/js/core.js')
     def send_core_wrapper(study):
         if not study_access_allowed(study):
             abort(404)
-        return send_from_directory('js', 'wrapper_core.js')
+        return send_static_asset('js', 'wrapper_core.js')
 
     @app.route('/study/<study>/js/util.js')
     def send_util_wrapper(study):
         if not study_access_allowed(study):
             abort(404)
-        return send_from_directory('js', 'wrapper_util.js')
+        return send_static_asset('js', 'wrapper_util.js')
 
     @app.route('/study/<study>/js/core<version>.js')
     def send_core_wrapper_versioned(study, version):
         if not study_access_allowed(study):
             abort(404)
-        return send_from_directory('js', 'wrapper_core{}.js'.format(version))
+        return send_static_asset(
+            'js', 'wrapper_core{}.js'.format(version), immutable=True)
 
     @app.route('/study/<study>/js/util<version>.js')
     def send_util_wrapper_versioned(study, version):
         if not study_access_allowed(study):
             abort(404)
-        return send_from_directory('js', 'wrapper_util{}.js'.format(version))
+        return send_static_asset(
+            'js', 'wrapper_util{}.js'.format(version), immutable=True)
 
     @app.route('/study/<study>/js/_<file>')
     def send_unwrapped_js(study, file):
         if not study_access_allowed(study):
             abort(404)
-        return send_from_directory('js/psychojs', file)
+        return send_static_asset('js/psychojs', file)
 
     @app.route('/study/<study>/js/_<file>-<version>.js')
     def send_unwrapped_old_js(study, file, version):
         if not study_access_allowed(study):
             abort(404)
-        return send_from_directory(
+        return send_static_asset(
             'js/psychojs-{}'.format(version),
-            '{}.js'.format(file)
+            '{}.js'.format(file),
+            immutable=True
         )
 
     @app.route('/study/<study>/js/<path:path>')
     def send_js(study, path):
         if not study_access_allowed(study):
             abort(404)
-        return send_from_directory('js/psychojs', path)
+        return send_static_asset('js/psychojs', path)
 
     @app.route('/study/<study>/js/<path:path>-<version>.js')
     def send_old_js(study, path, version):
         if not study_access_allowed(study):
             abort(404)
-        return send_from_directory(
+        return send_static_asset(
             'js/psychojs-{}'.format(version),
-            '{}.js'.format(path)
+            '{}.js'.format(path),
+            immutable=True
         )
 
     @app.route('/study/<study>/css/<path:path>')
     def send_study_css(study, path):
         if not study_access_allowed(study):
             abort(404)
-        return send_from_directory('css', path)
+        return send_static_asset('css', path)
 
     @app.route('/study/<study>/')
     def send_study(study):
@@ -583,15 +892,25 @@ def init():
     def send_study_main_js(study):
         if not study_access_allowed(study):
             abort(404)
+        if OFFLOAD_MODE is not None:
+            # The proxy handles compression (e.g. nginx gzip_static)
+            return send_study_file(study, '', 'exp.js')
         study_path = exp_server.get_path(study)
-        return send_from_directory(study_path, 'exp.js')
+        if 'gzip' in request.accept_encodings and \
+                os.path.isfile(os.path.join(study_path, 'exp.js.gz')):
+            response = send_from_directory(
+                study_path, 'exp.js.gz', mimetype='text/javascript')
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = send_from_directory(study_path, 'exp.js')
+        response.vary.add('Accept-Encoding')
+        return response
 
     @app.route('/study/<study>/resources/<path:path>')
     def send_study_resource(study, path):
         if not study_access_allowed(study):
             abort(404)
-        study_path = exp_server.get_path(study)
-        return send_from_directory(os.path.join(study_path,'resources'), path)
+        return send_study_file(study, 'resources', path)
 
     @app.route('/study/<study>/server/', methods=['GET', 'POST'])
     def study_server(study):
@@ -608,5 +927,6 @@ if __name__ == '__main__':
     serve(
         wsgi_app,
         host='127.0.0.1',
-        port='8080'
+        port='8080',
+        threads=WAITRESS_THREADS
     )
@@ -0,0 +1,322 @@
+import json
+import os
+import sqlite3
+import threading
+from logger import log
+from journal import MetadataJournal
+
+# Key under which server-wide (not study-specific) state is stored
+SERVER_KEY = '_server'
+
+
+def apply_study_record(meta, record):
+    if record['type'] == 'run_counts':
+        run = meta.get('run')
+        if run is None or run['id'] != record['run']:
+            return
+        run['num_sessions'] = record['num_sessions']
+        arg_counts = json.loads(run.get('arg_counts', '{}'))
+        arg_counts.update(record['arg_counts'])
+        run['arg_counts'] = json.dumps(arg_counts)
+
+def apply_server_record(codes, record):
+    # codes: code -> participant code metadata
+    if record['type'] == 'code_added':
+        codes[record['code']] = record['props']
+    elif record['type'] == 'code_removed':
+        codes.pop(record['code'], None)
+    elif record['type'] == 'code_used':
+        if record['code'] in codes:
+            codes[record['code']]['session_count'] = record['session_count']
+
+
+# State backends store study metadata (meta.json format) and server metadata
+# (server.json format) under a key: the study id, or SERVER_KEY.
+# Changes arrive either as a full snapshot or as a list of change records
+# (see apply_study_record / apply_server_record).
+
+class JsonStateBackend():
+    # meta.json / server.json snapshots with an append-only change log
+
+    def __init__(self, study_path):
+        self.study_path = study_path
+        self.journals = {}
+        self.lock = threading.Lock()
+
+    def get_journal(self, key):
+        with self.lock:
+            if key not in self.journals:
+                if key == SERVER_KEY:
+                    path = os.path.join(self.study_path, 'server.json')
+                else:
+                    path = os.path.join(self.study_path, key, 'meta.json')
+                self.journals[key] = MetadataJournal(path)
+            return self.journals[key]
+
+    def load(self, key):
+        (meta, records) = self.get_journal(key).load()
+        if meta is None and len(records) == 0:
+            return None
+        if key == SERVER_KEY:
+            codes = {}
+            for props in (meta or {}).get('participant_codes', []):
+                codes[props['code']] = props
+            for record in records:
+                apply_server_record(codes, record)
+            return {'participant_codes': list(codes.values())}
+        meta = meta or {}
+        for record in records:
+            apply_study_record(meta, record)
+        return meta
+
+    def needs_snapshot(self, key, num_records):
+        return self.get_journal(key).needs_compaction(num_records)
+
+    def save_snapshot(self, key, meta):
+        journal = self.get_journal(key)
+        journal.on_snapshot()
+        journal.write_snapshot(
+            json.dumps(meta, indent=2 if key == SERVER_KEY else None))
+
+    def append_records(self, key, records):
+        journal = self.get_journal(key)
+        journal.on_records(len(records))
+        journal.append(records)
+
+    def delete(self, key):
+        with self.lock:
+            self.journals.pop(key, None)
+
+    def list_studies(self):
+        return [
+            study for study in os.listdir(self.study_path)
+                if os.path.isfile(os.path.join(
+                    self.study_path, study, 'meta.json'))
+        ]
+
+    def close(self):
+        pass
+
+
+class SqliteStateBackend():
+    # Row-per-object storage in an SQLite database (WAL mode); changes are
+    # applied as transactional row updates
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS studies (
+                study TEXT PRIMARY KEY,
+                admins TEXT NOT NULL,
+                next_run_id INTEGER NOT NULL,
+                study_group TEXT
+            );
+            CREATE TABLE IF NOT EXISTS runs (
+                study TEXT NOT NULL,
+                run_id INTEGER NOT NULL,
+                active INTEGER NOT NULL,
+                num_sessions INTEGER NOT NULL,
+                settings TEXT NOT NULL,
+                PRIMARY KEY (study, run_id)
+            );
+            CREATE TABLE IF NOT EXISTS arg_counts (
+                study TEXT NOT NULL,
+                run_id INTEGER NOT NULL,
+                arg TEXT NOT NULL,
+                value TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (study, run_id, arg, value)
+            );
+            CREATE TABLE IF NOT EXISTS participant_codes (
+                code TEXT PRIMARY KEY,
+                study TEXT NOT NULL,
+                is_secret_url INTEGER NOT NULL,
+                timeout TEXT,
+                unique_session INTEGER,
+                session_limit INTEGER,
+                session_count INTEGER
+            );
+            -- Codes are looked up in memory (see ExperimentServer), and a
+            -- study's runs through the primary key; these were never used
+            DROP INDEX IF EXISTS runs_active;
+            DROP INDEX IF EXISTS participant_codes_study;
+            DROP INDEX IF EXISTS participant_codes_timeout;
+            ''')
+
+    def load(self, key):
+        with self.lock:
+            if key == SERVER_KEY:
+                return self.load_server()
+            return self.load_study(key)
+
+    def load_server(self):
+        codes = []
+        for row in self.db.execute('''
+                SELECT code, study, is_secret_url, timeout, unique_session,
+                    session_limit, session_count
+                FROM participant_codes ORDER BY rowid'''):
+            props = {'code': row[0], 'study': row[1]}
+            if row[2]:
+                props['is_secret_url'] = True
+            else:
+                props['timeout'] = row[3]
+                props['unique_session'] = bool(row[4])
+                props['session_limit'] = row[5]
+                props['session_count'] = row[6]
+            codes.append(props)
+        if len(codes) == 0:
+            return None
+        return {'participant_codes': codes}
+
+    def load_study(self, study):
+        row = self.db.execute('''
+            SELECT admins, next_run_id, study_group FROM studies
+            WHERE study = ?''', (study,)).fetchone()
+        if row is None:
+            return None
+        meta = {
+            'admins': json.loads(row[0]),
+            'next_run_id': row[1],
+            'group': row[2]
+        }
+        run_row = self.db.execute('''
+            SELECT run_id, num_sessions, settings FROM runs
+            WHERE study = ? AND active = 1''', (study,)).fetchone()
+        if run_row is not None:
+            run = json.loads(run_row[2])
+            run['id'] = run_row[0]
+            run['num_sessions'] = run_row[1]
+            arg_counts = {}
+            for (arg, value, count) in self.db.execute('''
+                    SELECT arg, value, count FROM arg_counts
+                    WHERE study = ? AND run_id = ?''', (study, run_row[0])):
+                arg_counts.setdefault(arg, {})[value] = count
+            run['arg_counts'] = json.dumps(arg_counts)
+            meta['run'] = run
+        return meta
+
+    def needs_snapshot(self, key, num_records):
+        return False
+
+    def save_snapshot(self, key, meta):
+        with self.lock, self.db:
+            if key == SERVER_KEY:
+                self.db.execute('DELETE FROM participant_codes')
+                for props in meta.get('participant_codes', []):
+                    self.insert_code(props)
+            else:
+                self.save_study(key, meta)
+
+    def save_study(self, study, meta):
+        self.db.execute('''
+            INSERT OR REPLACE INTO studies
+                (study, admins, next_run_id, study_group)
+            VALUES (?, ?, ?, ?)''', (
+                study,
+                json.dumps(meta.get('admins', [])),
+                meta.get('next_run_id', 1),
+                meta.get('group')
+            ))
+        self.db.execute(
+            'UPDATE runs SET active = 0 WHERE study = ?', (study,))
+        if 'run' not in meta:
+            return
+        settings = dict(meta['run'])
+        run_id = settings.pop('id')
+        num_sessions = settings.pop('num_sessions')
+        arg_counts = json.loads(settings.pop('arg_counts', '{}'))
+        self.db.execute('''
+            INSERT OR REPLACE INTO runs
+                (study, run_id, active, num_sessions, settings)
+            VALUES (?, ?, 1, ?, ?)''', (
+                study, run_id, num_sessions, json.dumps(settings)
+            ))
+        self.db.execute(
+            'DELETE FROM arg_counts WHERE study = ? AND run_id = ?',
+            (study, run_id))
+        self.set_arg_counts(study, run_id, arg_counts)
+
+    def set_arg_counts(self, study, run_id, arg_counts):
+        for arg in arg_counts:
+            self.db.execute('''
+                DELETE FROM arg_counts
+                WHERE study = ? AND run_id = ? AND arg = ?''',
+                (study, run_id, arg))
+            self.db.executemany('''
+                INSERT INTO arg_counts (study, run_id, arg, value, count)
+                VALUES (?, ?, ?, ?, ?)''', [
+                    (study, run_id, arg, value, count)
+                        for value, count in arg_counts[arg].items()
+                ])
+
+    def insert_code(self, props):
+        self.db.execute('''
+            INSERT OR REPLACE INTO participant_codes
+                (code, study, is_secret_url, timeout, unique_session,
+                session_limit, session_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?)''', (
+                props['code'],
+                props['study'],
+                1 if props.get('is_secret_url', False) else 0,
+                props.get('timeout'),
+                props.get('unique_session'),
+                props.get('session_limit'),
+                props.get('session_count', 0)
+            ))
+
+    def append_records(self, key, records):
+        with self.lock, self.db:
+            for record in records:
+                if record['type'] == 'run_counts':
+                    self.db.execute('''
+                        UPDATE runs SET num_sessions = ?
+                        WHERE study = ? AND run_id = ?''', (
+                            record['num_sessions'], key, record['run']
+                        ))
+                    self.set_arg_counts(
+                        key, record['run'], record['arg_counts'])
+                elif record['type'] == 'code_added':
+                    self.insert_code(record['props'])
+                elif record['type'] == 'code_removed':
+                    self.db.execute(
+                        'DELETE FROM participant_codes WHERE code = ?',
+                        (record['code'],))
+                elif record['type'] == 'code_used':
+                    self.db.execute('''
+                        UPDATE participant_codes SET session_count = ?
+                        WHERE code = ?''', (
+                            record['session_count'], record['code']
+                        ))
+
+    def delete(self, key):
+        with self.lock, self.db:
+            for table in ['studies', 'runs', 'arg_counts']:
+                self.db.execute(
+                    'DELETE FROM {} WHERE study = ?'.format(table), (key,))
+
+    def list_studies(self):
+        with self.lock:
+            return [
+                row[0] for row in self.db.execute('SELECT study FROM studies')
+            ]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def make_state_backend(backend, study_path, db_path=None):
+    if backend == 'json':
+        return JsonStateBackend(study_path)
+    elif backend == 'sqlite':
+        if db_path is None:
+            db_path = os.path.join(study_path, 'state.db')
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        log('Using state database {}'.format(db_path))
+        return SqliteStateBackend(db_path)
+    raise ValueError('Unknown state backend "{}"'.format(backend))
@@ -0,0 +1,82 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import posixpath
+from flask import Response
+from logger import log
+
+# Cache-Control for paths that name a fixed library version
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Everything else may change with a server update, so clients revalidate
+# (cheaply, with If-None-Match)
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+# Assets that also get a gzip variant, compressed once at startup
+GZIP_EXTENSIONS = ['.js', '.css']
+
+
+class StaticAssetCache():
+    # In-memory copies of files that don't change while the server runs (the
+    # bundled PsychoJS library and CSS), keyed by path relative to root,
+    # e.g. 'js/psychojs/core.js'. Each has a strong ETag (a content hash), so
+    # repeat requests are answered with 304 Not Modified. Text assets also
+    # keep a gzip copy for clients that accept it.
+
+    def __init__(self, root, directories):
+        self.root = root
+        self.assets = {}
+        for directory in directories:
+            self.load_directory(directory)
+        log('Cached {} static assets ({} bytes)'.format(
+            len(self.assets),
+            sum(len(asset['data']) for asset in self.assets.values())
+        ))
+
+    def load_directory(self, directory):
+        for (dirpath, _, filenames) in os.walk(
+                os.path.join(self.root, directory)):
+            for filename in filenames:
+                full_path = os.path.join(dirpath, filename)
+                path = os.path.relpath(full_path, self.root).replace(
+                    os.sep, '/')
+                with open(full_path, 'rb') as f:
+                    data = f.read()
+                etag = hashlib.sha256(data).hexdigest()[:32]
+                asset = {
+                    'data': data,
+                    'etag': etag,
+                    'mimetype': mimetypes.guess_type(filename)[0] or
+                        'application/octet-stream',
+                    'gzip_data': None
+                }
+                if os.path.splitext(filename)[1] in GZIP_EXTENSIONS:
+                    gzip_data = gzip.compress(data, compresslevel=9, mtime=0)
+                    if len(gzip_data) < len(data):
+                        asset['gzip_data'] = gzip_data
+                        # Each encoding is a separate representation
+                        asset['gzip_etag'] = etag + '-gz'
+                self.assets[path] = asset
+
+    def get(self, directory, filename):
+        # Only paths loaded at startup are found, so '..' can't escape root
+        return self.assets.get(posixpath.join(directory, filename))
+
+    def make_response(self, request, directory, filename, immutable=False):
+        # Returns None if the asset is not cached
+        asset = self.get(directory, filename)
+        if asset is None:
+            return None
+        if asset['gzip_data'] is not None and \
+                'gzip' in request.accept_encodings:
+            response = Response(asset['gzip_data'], mimetype=asset['mimetype'])
+            response.headers['Content-Encoding'] = 'gzip'
+            response.set_etag(asset['gzip_etag'])
+        else:
+            response = Response(asset['data'], mimetype=asset['mimetype'])
+            response.set_etag(asset['etag'])
+        if asset['gzip_data'] is not None:
+            response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL \
+            if immutable else REVALIDATE_CACHE_CONTROL
+        # Turns the response into a 304 if the client's copy is current
+        return response.make_conditional(request)
@@ -0,0 +1,69 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serve
+from experiment_server import ExperimentServer
+
+STUDY = 's1'
+
+
+def make_code(study, code=None):
+    return {'code': code or os.urandom(6).hex(), 'study': study,
+        'on_remove': lambda: None}
+
+
+@pytest.fixture
+def exp_server(tmp_path):
+    # A server with one (inactive) study and no web app
+    os.makedirs(str(tmp_path / 'study' / STUDY))
+    server = ExperimentServer(
+        str(tmp_path / 'data'), str(tmp_path / 'study'), make_code)
+    server.load_experiments()
+    yield server
+    server.shutdown()
+
+
+def restart(server):
+    # A new server on the same files, as after a restart; the caller shuts
+    # it down
+    server.shutdown()
+    restarted = ExperimentServer(server.data_path, server.study_path,
+        make_code)
+    restarted.load_experiments()
+    return restarted
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # The web app, with one (inactive) study
+    monkeypatch.chdir(tmp_path)
+    study_path = str(tmp_path / 'study') + '/'
+    os.makedirs(os.path.join(study_path, STUDY, 'resources'))
+    with open(os.path.join(study_path, STUDY, 'exp.js'), 'w') as f:
+        f.write('// experiment')
+    monkeypatch.setattr(serve, 'SECRET_KEY', 'test')
+    monkeypatch.setattr(serve, 'STUDY_PATH', study_path)
+    monkeypatch.setattr(serve, 'DATA_PATH', str(tmp_path / 'data') + '/')
+    app = serve.init()
+    app.config['SERVER_NAME'] = 'localhost'
+    yield app
+    app.extensions['exp_server'].shutdown()
+
+
+def login(client, user='admin', password='default'):
+    return client.post('/manage/', data={'user': user, 'pass': password})
+
+
+def run_session(server, user_key, data=None, complete=True, study=STUDY):
+    # Opens a session for user_key, saves data ({key: csv text}) and closes
+    # it; returns the session
+    server.start_session_for_user(study, user_key, {})
+    session = server.get_session_for_user(user_key)['session']
+    for (key, value) in (data or {}).items():
+        session.accept_data(key, value, 'csv')
+    session.set_completed(complete)
+    session.close()
+    return session
@@ -0,0 +1,56 @@
+import time
+from access_cache import AccessCache
+
+
+def fill(cache, sessions, studies):
+    for session in range(sessions):
+        for study in range(studies):
+            cache.put((session, study, 1), True, cache.generation)
+
+
+def test_invalidate_session_and_study():
+    cache = AccessCache(60)
+    fill(cache, 3, 2)
+    cache.invalidate_session(0)
+    assert cache.get((0, 0, 1)) is None
+    assert cache.get((0, 1, 1)) is None
+    assert cache.get((1, 0, 1)) is True
+    cache.invalidate_study(1)
+    assert cache.get((1, 1, 1)) is None
+    assert cache.get((2, 1, 1)) is None
+    assert cache.get((2, 0, 1)) is True
+    assert set(cache.decisions) == {(1, 0, 1), (2, 0, 1)}
+    assert set(cache.session_keys) == {1, 2}
+    assert set(cache.study_keys) == {0}
+
+
+def test_decision_from_before_an_invalidation_is_not_stored():
+    cache = AccessCache(60)
+    generation = cache.generation
+    cache.invalidate_session('other')
+    cache.put(('key', 's', 1), True, generation)
+    assert cache.get(('key', 's', 1)) is None
+
+
+def test_expiry_and_max_entries():
+    cache = AccessCache(0.01, max_entries=10)
+    fill(cache, 10, 1)
+    time.sleep(0.02)
+    assert cache.get((0, 0, 1)) is None
+    # Full of expired entries: they make room
+    cache.put(('new', 0, 1), False, cache.generation)
+    assert cache.decisions.keys() == {('new', 0, 1)}
+    assert cache.get(('new', 0, 1)) is False
+    assert set(cache.session_keys) == {'new'}
+
+
+def test_revoking_many_sessions_is_cheap():
+    cache = AccessCache(60, max_entries=100000)
+    fill(cache, 20000, 2)
+    start = time.monotonic()
+    for session in range(20000):
+        cache.invalidate_session(session)
+    # Rebuilding the cache on every revoke took minutes here
+    assert time.monotonic() - start < 1
+    assert cache.decisions == {}
+    assert len(cache.session_keys) == 0 and len(cache.study_keys) == 0
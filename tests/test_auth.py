@@ -0,0 +1,17 @@
+from auth import SimpleSessionAuth
+
+
+def test_create_temporary_users():
+    auth = SimpleSessionAuth({'admin': {'password': 'x'}})
+    properties = {'permissions': {'studies': ['s1']}}
+    names = auth.create_temporary_users(500, properties=properties,
+        readable_name=True, name_bytes=2)
+    assert len(names) == len(set(names)) == 500
+    assert 'admin' not in names
+    assert all(len(name) == 4 for name in names)
+    for name in names:
+        assert auth.users[name]['permissions'] == properties['permissions']
+        assert 'password' not in auth.users[name]
+    assert len(set(auth.users[name]['created_time'] for name in names)) == 1
+    assert len(auth.users) == 501
+    assert auth.create_temporary_users(0) == []
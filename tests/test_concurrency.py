@@ -0,0 +1,80 @@
+import datetime
+import threading
+from conftest import STUDY, run_session
+
+THREADS = 8
+SESSIONS_PER_THREAD = 40
+
+
+def hammer(fn):
+    errors = []
+    def work(i):
+        try:
+            for j in range(SESSIONS_PER_THREAD):
+                fn(i, j)
+        except Exception as e:
+            errors.append(e)
+    threads = [
+        threading.Thread(target=work, args=(i,)) for i in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def test_concurrent_sessions_keep_counts_consistent(exp_server):
+    exp = exp_server.get_experiment(STUDY)
+    exp.start_run(session_args={'cond': 'uniform(a, b, c)'})
+    complete = []
+    def session(i, j):
+        # Every third session is abandoned; incomplete data is still saved
+        is_complete = j % 3 != 0
+        run_session(exp_server, 'u{}-{}'.format(i, j),
+            {'d{}-{}.csv'.format(i, j): 'x\n1\n'}, complete=is_complete)
+        complete.append(is_complete)
+
+    assert hammer(session) == []
+
+    total = THREADS * SESSIONS_PER_THREAD
+    assert len(complete) == total
+    assert exp.run.num_sessions == total
+    assert exp.run.sessions == {}
+    counts = exp.run.get_key_counts('cond')
+    assert sum(completed for (_, completed, _) in counts) == total
+    assert all(in_flight == 0 for (_, _, in_flight) in counts)
+    # uniform() keeps the values balanced
+    assert max(c for (_, c, _) in counts) - \
+        min(c for (_, c, _) in counts) <= THREADS
+    assert exp_server.user_session_map == {}
+    assert exp_server.session_user_map == {}
+
+
+def test_concurrent_invite_codes_keep_registry_consistent(exp_server):
+    exp = exp_server.get_experiment(STUDY)
+    exp.start_run(access_type='invite-only')
+    timeout = datetime.datetime.now() + datetime.timedelta(hours=1)
+    def session(i, j):
+        code = exp_server.add_participant_code(STUDY, unique_session=True,
+            timeout=timeout, session_limit=1)
+        user_key = 'k{}-{}'.format(i, j)
+        exp_server.activate_participant_code(code, {}, user_key)
+        # A code can't start a second session for the same participant
+        exp_server.activate_participant_code(code, {}, user_key)
+        s = exp_server.get_session_for_user(user_key)['session']
+        s.accept_data('d{}-{}.csv'.format(i, j), 'x\n1\n', 'csv')
+        s.set_completed(True)
+        s.close()
+        # Used up, so removed
+        assert code not in exp_server.participant_codes
+
+    assert hammer(session) == []
+
+    assert exp.run.num_sessions == THREADS * SESSIONS_PER_THREAD
+    assert exp_server.participant_codes == {}
+    assert exp_server.study_invite_codes.get(STUDY, {}) == {}
+    assert exp_server.get_participant_codes(STUDY) == []
+    assert exp_server.user_session_map == {}
+    exp_server.flush_writes(STUDY)
+    (records, cursor) = exp.write_log.read()
+    assert cursor == THREADS * SESSIONS_PER_THREAD
@@ -0,0 +1,139 @@
+import json
+import random
+import pytest
+from conftest import STUDY, run_session
+from counterbalance import Counterbalancer
+from experiment_server import ExperimentRun
+
+
+def run_sessions(balancer, n, counted=True):
+    for _ in range(n):
+        (args, reservations) = balancer.assign({})
+        balancer.release(args, reservations, counted)
+
+
+def completed(balancer, key):
+    return {value: count for (value, count, _) in balancer.get_counts(key)}
+
+
+def test_uniform_stays_balanced_with_sessions_in_flight():
+    balancer = Counterbalancer({'cond': 'uniform(a, b, c)'}, {})
+    rng = random.Random(1)
+    open_sessions = []
+    for _ in range(3000):
+        if len(open_sessions) < 10 and rng.random() < 0.6:
+            loads = {value: done + in_flight
+                for (value, done, in_flight) in balancer.get_counts('cond')}
+            open_sessions.append(balancer.assign({}))
+            # The value with the fewest completed and in-flight sessions
+            assert loads[open_sessions[-1][0]['cond']] == min(loads.values())
+        elif len(open_sessions) > 0:
+            (args, reservations) = open_sessions.pop(
+                rng.randrange(len(open_sessions)))
+            # Abandoned sessions don't count
+            balancer.release(args, reservations, rng.random() < 0.8)
+    for (args, reservations) in open_sessions:
+        balancer.release(args, reservations, True)
+    counts = balancer.get_counts('cond')
+    assert all(in_flight == 0 for (_, _, in_flight) in counts)
+    done = [count for (_, count, _) in counts]
+    assert max(done) - min(done) <= 10
+    # Stale heap entries are dropped now and then
+    design = balancer.designs[0]
+    assert len(design.heap) <= 4 * len(design.cells) + 1
+    assert sum(design.reserved.values()) == 0
+
+
+def test_released_reservations_are_handed_out_again():
+    balancer = Counterbalancer({'cond': 'uniform(a, b)'}, {})
+    (args, reservations) = balancer.assign({})
+    balancer.release(args, reservations, False)
+    assert completed(balancer, 'cond') == {'a': 0, 'b': 0}
+    (other_args, _) = balancer.assign({})
+    (next_args, _) = balancer.assign({})
+    assert {other_args['cond'], next_args['cond']} == {'a', 'b'}
+
+
+def test_weighted_proportions():
+    balancer = Counterbalancer({'cond': 'weighted(a:3, b:1, c:0.5)'}, {})
+    run_sessions(balancer, 450)
+    assert completed(balancer, 'cond') == {'a': 300, 'b': 100, 'c': 50}
+
+
+@pytest.mark.parametrize('spec', [
+    'weighted(a:2, b)', 'weighted(a:0, b:1)', 'weighted(a:-1)',
+    'weighted(a:x)'])
+def test_bad_weights(spec):
+    with pytest.raises(ValueError):
+        Counterbalancer({'cond': spec}, {})
+
+
+def test_crossed_cells():
+    counts = {}
+    balancer = Counterbalancer({
+        'color': 'crossed(g, red, blue)',
+        'size': 'crossed(g, 1, 2, 3)',
+        'order': 'uniform(x, y)',
+        'fixed': 'z',
+    }, counts)
+    (args, reservations) = balancer.assign({})
+    assert list(args) == ['color', 'size', 'order', 'fixed']
+    balancer.release(args, reservations, True)
+    run_sessions(balancer, 59)
+    # Cells are counted under the group, values under each arg
+    assert counts['crossed(g)'] == {
+        json.dumps([color, size]): 10
+            for color in ['red', 'blue'] for size in ['1', '2', '3']
+    }
+    assert counts['color'] == {'red': 30, 'blue': 30}
+    assert counts['size'] == {'1': 20, '2': 20, '3': 20}
+    assert counts['order'] == {'x': 30, 'y': 30}
+    assert counts['fixed'] == {'z': 60}
+
+
+def test_crossed_needs_values():
+    with pytest.raises(ValueError):
+        Counterbalancer({'color': 'crossed(g)'}, {})
+
+
+def test_rebuilt_from_saved_counts():
+    counts = {
+        'cond': {'a': 5, 'c': 3},
+        'crossed(g)': {json.dumps(['red', '1']): 2},
+    }
+    balancer = Counterbalancer({
+        'cond': 'uniform(a, b, c)',
+        'color': 'crossed(g, red, blue)',
+        'size': 'crossed(g, 1, 2)',
+    }, counts)
+    assert completed(balancer, 'cond') == {'a': 5, 'b': 0, 'c': 3}
+    # The least-run values and cells come first
+    run_sessions(balancer, 6)
+    assert counts['crossed(g)'] == {
+        json.dumps([color, size]): 2
+            for color in ['red', 'blue'] for size in ['1', '2']
+    }
+    run_sessions(balancer, 1)
+    assert completed(balancer, 'cond') == {'a': 5, 'b': 5, 'c': 5}
+
+
+def test_run_counts_survive_saving(exp_server):
+    exp = exp_server.get_experiment(STUDY)
+    exp.start_run(session_args={
+        'color': 'crossed(g, red, blue)',
+        'size': 'crossed(g, 1, 2)',
+    })
+    for i in range(8):
+        run_session(exp_server, 'u{}'.format(i),
+            {'d{}.csv'.format(i): 'x\n1\n'})
+    assert exp.run.arg_counts['crossed(g)'] == {
+        json.dumps([color, size]): 2
+            for color in ['red', 'blue'] for size in ['1', '2']
+    }
+    run = ExperimentRun.from_dict(exp, json.loads(json.dumps(
+        exp.run.to_dict())))
+    assert run.arg_counts == exp.run.arg_counts
+    (args, _) = run.counterbalancer.assign({})
+    assert set(args) == {'color', 'size'}
+    assert run.get_key_counts('color') == [('red', 4, int(
+        args['color'] == 'red')), ('blue', 4, int(args['color'] == 'blue'))]
@@ -0,0 +1,133 @@
+import os
+import pytest
+from conftest import STUDY, login, restart, run_session
+from data_browser import LineIndex, LineIndexCache, PAGE_LINES
+
+
+def make_index(tmp_path, data, records=False):
+    path = str(tmp_path / 'data.csv')
+    with open(path, 'wb') as f:
+        f.write(data)
+    return LineIndex(path, os.stat(path), records=records)
+
+
+def test_empty_file(tmp_path):
+    index = make_index(tmp_path, b'')
+    assert index.get_lines(0, 10) == ([], False)
+    assert index.get_num_lines() == 0
+
+
+@pytest.mark.parametrize('data', [
+    b'a\nb\nc', b'a\nb\nc\n', b'a\r\nb\r\nc\r\n', b'a\r\nb\r\nc'])
+def test_line_endings(tmp_path, data):
+    index = make_index(tmp_path, data)
+    assert index.get_num_lines() is None
+    assert index.get_lines(0, 2) == ([b'a', b'b'], True)
+    assert index.get_lines(2, 2) == ([b'c'], False)
+    assert index.get_lines(3, 2) == ([], False)
+    assert index.get_num_lines() == 3
+
+
+def test_blank_lines_are_kept(tmp_path):
+    index = make_index(tmp_path, b'a\n\n\nb\n')
+    assert index.get_lines(0, 10) == ([b'a', b'', b'', b'b'], False)
+
+
+def test_records_span_quoted_newlines(tmp_path):
+    data = b'x,y\r\n1,"a\r\nb"\r\n2,"say ""hi""\nthere"\n3,c'
+    assert make_index(tmp_path, data).get_lines(0, 10)[0] == [b'x,y',
+        b'1,"a', b'b"', b'2,"say ""hi""', b'there"', b'3,c']
+    index = make_index(tmp_path, data, records=True)
+    assert index.get_lines(1, 1) == ([b'1,"a\r\nb"'], True)
+    assert index.get_lines(0, 10) == ([b'x,y', b'1,"a\r\nb"',
+        b'2,"say ""hi""\nthere"', b'3,c'], False)
+    assert index.get_num_lines() == 4
+    # An unterminated quote runs to the end of the file
+    index = make_index(tmp_path, b'x\n"a\nb\nc\n', records=True)
+    assert index.get_lines(0, 10) == ([b'x', b'"a\nb\nc'], False)
+
+
+def test_cache_follows_file_changes(tmp_path):
+    path = str(tmp_path / 'data.csv')
+    with open(path, 'wb') as f:
+        f.write(b'a\nb\n')
+    cache = LineIndexCache(max_entries=1)
+    index = cache.get(path)
+    assert index.get_lines(0, 10) == ([b'a', b'b'], False)
+    assert cache.get(path) is index
+
+    with open(path, 'ab') as f:
+        f.write(b'c\n')
+    index = cache.get(path)
+    assert index.get_lines(0, 10) == ([b'a', b'b', b'c'], False)
+    # Replaced by a shorter file
+    with open(str(tmp_path / 'new'), 'wb') as f:
+        f.write(b'z\n')
+    os.replace(str(tmp_path / 'new'), path)
+    assert cache.get(path).get_lines(0, 10) == ([b'z'], False)
+    # Parsed as records or not
+    assert cache.get(path, records=True) is not cache.get(path)
+    # Least recently used indexes are dropped
+    other = str(tmp_path / 'other')
+    with open(other, 'wb') as f:
+        f.write(b'1\n')
+    index = cache.get(path)
+    cache.get(other)
+    assert cache.get(path) is not index
+
+
+@pytest.fixture
+def data_file(app):
+    exp = app.extensions['exp_server'].get_experiment(STUDY)
+    run_path = os.path.join(exp.data_path, 'run_1')
+    os.makedirs(run_path)
+    path = os.path.join(run_path, 'data.csv')
+    with open(path, 'w', newline='') as f:
+        f.write('trial,comment\r\n')
+        for i in range(PAGE_LINES + 10):
+            f.write('{},"line one\r\nline two"\r\n'.format(i))
+    return path
+
+
+def test_browse_quoted_newlines(app, data_file):
+    with app.test_client() as client:
+        login(client)
+        response = client.get('/manage/{}/browse/1/data.csv'.format(STUDY))
+        assert response.status_code == 200
+        text = response.get_data(as_text=True)
+        assert 'Records 1&ndash;{}'.format(PAGE_LINES) in text
+        assert text.count('<td>line one\r\nline two</td>') == PAGE_LINES - 1
+        assert '<td>trial</td>' in text
+
+        response = client.get(
+            '/manage/{}/browse/1/data.csv?page=1'.format(STUDY))
+        text = response.get_data(as_text=True)
+        assert 'Records {}&ndash;{} of {}'.format(PAGE_LINES + 1,
+            PAGE_LINES + 11, PAGE_LINES + 11) in text
+        # The header is repeated on later pages
+        assert '<th>trial</th>' in text
+        assert text.count('<td>line one\r\nline two</td>') == 11
+
+
+def test_browse_past_the_end(app, data_file):
+    with app.test_client() as client:
+        login(client)
+        for page in [2, 100, -1]:
+            assert client.get('/manage/{}/browse/1/data.csv?page={}'.format(
+                STUDY, page)).status_code == 404
+        assert client.get('/manage/{}/browse/1/other.csv'.format(
+            STUDY)).status_code == 404
+
+
+def test_sessions_before_and_after_a_restart_keep_apart(exp_server):
+    exp = exp_server.get_experiment(STUDY)
+    exp.start_run()
+    first = run_session(exp_server, 'u1', {'data.csv': 'rt\n1\n'})
+    server = restart(exp_server)
+    try:
+        second = run_session(server, 'u2', {'data2.csv': 'rt\n2\n'})
+        server.flush_writes(STUDY)
+        assert server.get_data_sessions(STUDY, 1) == [
+            (first.token, ['data.csv']), (second.token, ['data2.csv'])]
+    finally:
+        server.shutdown()
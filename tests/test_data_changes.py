@@ -0,0 +1,36 @@
+import io
+import tarfile
+from conftest import STUDY, login, run_session
+
+URL = '/manage/{}/data/changes'.format(STUDY)
+
+
+def get_files(client, query=''):
+    response = client.get(URL + query)
+    assert response.status_code == 200
+    with tarfile.open(fileobj=io.BytesIO(response.get_data()),
+            mode='r:gz') as tar:
+        return sorted(member.name for member in tar.getmembers()
+            if member.isfile())
+
+
+def test_only_full_downloads_move_the_stored_cursor(app):
+    exp_server = app.extensions['exp_server']
+    exp_server.get_experiment(STUDY).start_run()
+    run_session(exp_server, 'u1', {'a.csv': 'x\n1\n'})
+    run_session(exp_server, 'u2', {'b.csv': 'x\n2\n'})
+    exp_server.flush_writes(STUDY)
+    with app.test_client() as client:
+        login(client)
+        # A listing, and downloads narrowed to other files
+        response = client.get(URL + '?format=json')
+        assert len(response.get_json()['files']) == 2
+        assert get_files(client, '?run=2') == []
+        assert get_files(client, '?until=2000-01-01') == []
+        assert get_files(client, '?cursor=1') == ['run_1/b.csv']
+
+        assert get_files(client) == ['run_1/a.csv', 'run_1/b.csv']
+        assert get_files(client) == []
+        run_session(exp_server, 'u3', {'c.csv': 'x\n3\n'})
+        exp_server.flush_writes(STUDY)
+        assert get_files(client) == ['run_1/c.csv']
@@ -0,0 +1,63 @@
+import datetime
+import threading
+from conftest import STUDY
+
+
+def add_code(exp_server):
+    exp_server.add_invite_code(STUDY,
+        timeout=datetime.datetime.now() + datetime.timedelta(hours=1),
+        session_limit=1)
+
+
+def expire_in_thread(fn):
+    errors = []
+    def run():
+        try:
+            fn()
+        except Exception as e:
+            errors.append(e)
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    return errors
+
+
+def test_expire_code_of_logged_in_participant(app):
+    exp_server = app.extensions['exp_server']
+    auth = app.extensions['auth']
+    exp_server.get_experiment(STUDY).start_run(access_type='invite-only')
+    add_code(exp_server)
+    code = list(exp_server.participant_codes)[0]
+    client = app.test_client()
+    assert client.get('/participate/{}'.format(code)).status_code == 302
+    assert code in auth.users
+    assert len(auth.user_sessions[code]) == 1
+
+    # As the expiry scheduler would, outside any request
+    errors = expire_in_thread(
+        lambda: exp_server.expire_participant_code(code))
+
+    assert errors == []
+    assert code not in exp_server.participant_codes
+    assert code not in exp_server.study_invite_codes.get(STUDY, {})
+    assert ('code', code) not in exp_server.expiry.entries
+    assert code not in auth.users
+    assert exp_server.get_session_for_user(code) is None
+    assert client.get('/study/{}/exp.js'.format(STUDY)).status_code == 404
+
+
+def test_failing_code_removal_keeps_registry_consistent(app):
+    exp_server = app.extensions['exp_server']
+    exp_server.get_experiment(STUDY).start_run(access_type='invite-only')
+    add_code(exp_server)
+    code = list(exp_server.participant_codes)[0]
+    def fail():
+        raise RuntimeError('Working outside of request context.')
+    exp_server.participant_codes[code]['on_remove'] = fail
+
+    errors = expire_in_thread(
+        lambda: exp_server.expire_participant_code(code))
+
+    assert errors == []
+    assert code not in exp_server.participant_codes
+    assert code not in exp_server.study_invite_codes.get(STUDY, {})
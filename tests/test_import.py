@@ -0,0 +1,181 @@
+import io
+import os
+import threading
+import time
+import pytest
+from werkzeug.datastructures import FileStorage
+import experiment_server
+import import_study
+from blob_store import BlobStore
+from import_study import stage_study, swap_in_study, clean_up_imports
+from conftest import STUDY as SERVER_STUDY
+
+STUDY = 'study'
+META = '{"admins": ["someone"]}'
+META_LOG = '{"type": "run_counts"}\n'
+
+
+def make_files(version):
+    return [
+        {'path': 'html/exp.js', 'name': 'exp.js', 'stream': io.BytesIO(
+            'psychoJS.start({{expName, expInfo}}); // {}'.format(
+                version).encode())},
+        {'path': 'html/resources/a.png', 'name': 'resources_a.png',
+            'stream': io.BytesIO(version.encode() * 100)},
+    ]
+
+
+def read(path_root, name):
+    with open(os.path.join(path_root, STUDY, name)) as f:
+        return f.read()
+
+
+@pytest.fixture
+def path_root(tmp_path):
+    path_root = str(tmp_path / 'study')
+    os.makedirs(path_root)
+    blob_store = BlobStore(os.path.join(path_root, '.blobs'))
+    swap_in_study(STUDY, stage_study(STUDY, make_files('v1'), path_root,
+        blob_store), path_root, blob_store)
+    with open(os.path.join(path_root, STUDY, 'meta.json'), 'w') as f:
+        f.write(META)
+    with open(os.path.join(path_root, STUDY, 'meta.json.log'), 'w') as f:
+        f.write(META_LOG)
+    return path_root
+
+
+class Crash(Exception):
+    pass
+
+
+def crash_on_call(monkeypatch, module, name, call):
+    # Makes the call'th (from 0) call of module.name raise Crash
+    original = getattr(module, name)
+    calls = []
+    def crashing(*args, **kwargs):
+        calls.append(args)
+        if len(calls) - 1 == call:
+            raise Crash()
+        return original(*args, **kwargs)
+    monkeypatch.setattr(module, name, crashing)
+
+
+def test_update_keeps_server_files(path_root):
+    blob_store = BlobStore(os.path.join(path_root, '.blobs'))
+    staging_path = stage_study(STUDY, make_files('v2'), path_root,
+        blob_store, replace=True)
+    swap_in_study(STUDY, staging_path, path_root, blob_store)
+    assert 'v2' in read(path_root, 'exp.js')
+    assert read(path_root, 'meta.json') == META
+    assert read(path_root, 'meta.json.log') == META_LOG
+    assert sorted(os.listdir(path_root)) == ['.blobs', STUDY]
+
+
+@pytest.mark.parametrize('crash_point,version', [
+    # While linking meta.json.log
+    (('import_study', 'link_or_copy', 1), 'v1'),
+    # Moving the live version to .old_
+    (('os', 'rename', 0), 'v1'),
+    # Moving the staged version in
+    (('os', 'rename', 1), 'v1'),
+    # Deleting .old_
+    (('shutil', 'rmtree', 0), 'v2'),
+])
+def test_crash_during_swap_keeps_server_files(path_root, monkeypatch,
+        crash_point, version):
+    blob_store = BlobStore(os.path.join(path_root, '.blobs'))
+    staging_path = stage_study(STUDY, make_files('v2'), path_root,
+        blob_store, replace=True)
+    (module, name, call) = crash_point
+    module = import_study if module == 'import_study' else \
+        getattr(import_study, module)
+    with monkeypatch.context() as m:
+        crash_on_call(m, module, name, call)
+        with pytest.raises(Crash):
+            swap_in_study(STUDY, staging_path, path_root, blob_store)
+
+    # Restart
+    clean_up_imports(path_root)
+
+    assert sorted(os.listdir(path_root)) == ['.blobs', STUDY]
+    assert read(path_root, 'meta.json') == META
+    assert read(path_root, 'meta.json.log') == META_LOG
+    assert version in read(path_root, 'exp.js')
+    assert len(import_study.read_manifest(
+        os.path.join(path_root, STUDY))['resources']) == 1
+
+
+def make_uploads(version):
+    return [FileStorage(stream=f['stream'], filename=f['path'])
+        for f in make_files(version)]
+
+
+@pytest.fixture
+def staging_spy(monkeypatch):
+    # Records the most imports of a study staged at the same time
+    active = {'now': 0, 'max': 0}
+    lock = threading.Lock()
+    def slow_stage_study(*args, **kwargs):
+        with lock:
+            active['now'] += 1
+            active['max'] = max(active['max'], active['now'])
+        try:
+            time.sleep(0.05)
+            return stage_study(*args, **kwargs)
+        finally:
+            with lock:
+                active['now'] -= 1
+    monkeypatch.setattr(experiment_server, 'stage_study', slow_stage_study)
+    return active
+
+
+def run_concurrently(fns):
+    barrier = threading.Barrier(len(fns))
+    errors = []
+    def run(fn):
+        barrier.wait()
+        try:
+            fn()
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(fn,)) for fn in fns]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def test_concurrent_updates_are_serialized(exp_server, staging_spy):
+    versions = ['v{}'.format(i) for i in range(4)]
+    errors = run_concurrently([
+        lambda version=version: exp_server.update_study_files(
+            SERVER_STUDY, make_uploads(version))
+        for version in versions
+    ])
+    assert errors == []
+    assert staging_spy['max'] == 1
+    study_path = os.path.join(exp_server.study_path, SERVER_STUDY)
+    with open(os.path.join(study_path, 'exp.js')) as f:
+        version = f.read().rpartition(' ')[2]
+    assert version in versions
+    # The resources match the experiment they were imported with
+    manifest = import_study.read_manifest(study_path)
+    assert len(manifest['resources']) == 1
+    with open(os.path.join(study_path,
+            manifest['resources'][0]['path'])) as f:
+        assert f.read() == version * 100
+    assert not any(name.startswith('.staging_')
+        for name in os.listdir(exp_server.study_path))
+
+
+def test_concurrent_creates_of_one_study(exp_server, staging_spy):
+    errors = run_concurrently([
+        lambda: exp_server.create_new_study({'name': 'new_study'},
+            make_uploads('v1'))
+        for _ in range(3)
+    ])
+    assert staging_spy['max'] == 1
+    assert len(errors) == 2
+    assert all(isinstance(e, ValueError) for e in errors)
+    assert 'new_study' in exp_server.experiments
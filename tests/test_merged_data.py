@@ -0,0 +1,154 @@
+import csv
+import gzip
+import os
+import pytest
+from conftest import STUDY, restart, run_session
+from merged_data import MergedDataset, TOKEN_COLUMN, RUN_COLUMN
+
+
+def write_csv(tmp_path, name, text):
+    path = str(tmp_path / name)
+    with open(path, 'w') as f:
+        f.write(text)
+    return path
+
+
+def read_merged(dataset):
+    with gzip.open(dataset.merged_path, 'rt', newline='') as f:
+        return list(csv.reader(f))
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    return MergedDataset(str(tmp_path / 'merged'))
+
+
+def test_append(tmp_path, dataset):
+    rows = dataset.append_session('0', 1, {'group': 'a'}, [
+        write_csv(tmp_path, 'a.csv', 'trial,rt\n1,0.5\n\n2,0.7\n')])
+    assert rows == [
+        {TOKEN_COLUMN: '0', RUN_COLUMN: '1', 'group': 'a', 'trial': '1',
+            'rt': '0.5'},
+        {TOKEN_COLUMN: '0', RUN_COLUMN: '1', 'group': 'a', 'trial': '2',
+            'rt': '0.7'},
+    ]
+    dataset.append_session('1', 1, {}, [
+        write_csv(tmp_path, 'b.csv', 'trial,correct\n1,1\n')])
+    assert dataset.columns == [
+        TOKEN_COLUMN, RUN_COLUMN, 'group', 'trial', 'rt', 'correct']
+    with open(dataset.rows_path) as f:
+        assert f.read().splitlines() == [
+            '0,1,a,1,0.5', '0,1,a,2,0.7', '1,1,,1,,1']
+    # Nothing in a session without CSV rows
+    assert dataset.append_session('2', 1, {}, [
+        write_csv(tmp_path, 'c.csv', 'trial\n')]) == []
+    assert MergedDataset(dataset.path).columns == dataset.columns
+
+
+def test_colliding_columns_are_renamed(tmp_path, dataset):
+    rows = dataset.append_session('0', 1,
+        {'condition': 'a', RUN_COLUMN: 'x'},
+        [write_csv(tmp_path, 'a.csv',
+            'condition,rt,rt,{}\nb,0.5,0.6,y\n'.format(TOKEN_COLUMN))])
+    assert rows == [{
+        TOKEN_COLUMN: '0', RUN_COLUMN: '1', RUN_COLUMN + '_2': 'x',
+        'condition': 'a', 'condition_2': 'b', 'rt': '0.5', 'rt_2': '0.6',
+        TOKEN_COLUMN + '_2': 'y'
+    }]
+
+
+def test_duplicate_header_names_keep_all_data(tmp_path, dataset):
+    rows = dataset.append_session('0', 1, {}, [
+        write_csv(tmp_path, 'a.csv', 'rt,rt,rt_2,rt\n1,2,3,4\n')])
+    assert rows == [{TOKEN_COLUMN: '0', RUN_COLUMN: '1', 'rt': '1',
+        'rt_2': '2', 'rt_2_2': '3', 'rt_3': '4'}]
+    dataset.compact()
+    assert read_merged(dataset) == [
+        [TOKEN_COLUMN, RUN_COLUMN, 'rt', 'rt_2', 'rt_2_2', 'rt_3'],
+        ['0', '1', '1', '2', '3', '4'],
+    ]
+
+
+def test_compact_appends_while_columns_are_unchanged(tmp_path, dataset):
+    path = write_csv(tmp_path, 'a.csv', 'trial,rt\n1,0.5\n')
+    dataset.append_session('0', 1, {}, [path])
+    dataset.compact()
+    assert dataset.is_compacted()
+    with open(dataset.merged_path, 'rb') as f:
+        first = f.read()
+    dataset.append_session('1', 1, {}, [path])
+    assert not dataset.is_compacted()
+    dataset.compact()
+    assert dataset.is_compacted()
+    with open(dataset.merged_path, 'rb') as f:
+        # Another gzip member
+        assert f.read().startswith(first)
+    assert read_merged(dataset) == [
+        [TOKEN_COLUMN, RUN_COLUMN, 'trial', 'rt'],
+        ['0', '1', '1', '0.5'],
+        ['1', '1', '1', '0.5'],
+    ]
+
+
+def test_compact_rewrites_when_columns_are_added(tmp_path, dataset):
+    dataset.append_session('0', 1, {}, [
+        write_csv(tmp_path, 'a.csv', 'trial,rt\n1,0.5\n')])
+    dataset.compact()
+    with open(dataset.merged_path, 'rb') as f:
+        first = f.read()
+    dataset.append_session('1', 1, {}, [
+        write_csv(tmp_path, 'b.csv', 'trial,rt,correct\n1,0.6,1\n')])
+    dataset.compact()
+    with open(dataset.merged_path, 'rb') as f:
+        assert not f.read().startswith(first)
+    # Earlier rows are padded to the new header
+    assert read_merged(dataset) == [
+        [TOKEN_COLUMN, RUN_COLUMN, 'trial', 'rt', 'correct'],
+        ['0', '1', '1', '0.5', ''],
+        ['1', '1', '1', '0.6', '1'],
+    ]
+    assert not os.path.exists(dataset.merged_path + '.tmp')
+
+
+def test_load_truncates_unsaved_writes(tmp_path, dataset):
+    path = write_csv(tmp_path, 'a.csv', 'trial,rt\n1,"a\nb"\n')
+    dataset.append_session('0', 1, {}, [path])
+    dataset.compact()
+    expected = read_merged(dataset)
+    with open(dataset.rows_path, 'rb') as f:
+        rows = f.read()
+    # A crash after writing rows or compressed data but before saving the
+    # state
+    with open(dataset.rows_path, 'ab') as f:
+        f.write(b'1,1,2,0.')
+    with open(dataset.merged_path, 'ab') as f:
+        f.write(b'\x1f\x8b\x08')
+
+    reloaded = MergedDataset(dataset.path)
+    with open(reloaded.rows_path, 'rb') as f:
+        assert f.read() == rows
+    assert read_merged(reloaded) == expected
+    assert reloaded.is_compacted()
+    # Later rows and compactions carry on from there
+    reloaded.append_session('1', 1, {}, [path])
+    reloaded.compact()
+    assert read_merged(reloaded) == expected + [['1', '1', '1', 'a\nb']]
+
+
+def test_sessions_before_and_after_a_restart_keep_apart(exp_server):
+    exp = exp_server.get_experiment(STUDY)
+    exp.start_run()
+    run_session(exp_server, 'u1', {'data.csv': 'rt\n1\n'})
+    server = restart(exp_server)
+    try:
+        exp = server.get_experiment(STUDY)
+        run_session(server, 'u2', {'data.csv': 'rt\n2\n'})
+        server.flush_writes(STUDY)
+        dataset = exp.get_merged_data(exp.run.id)
+        dataset.compact()
+        rows = read_merged(dataset)
+        assert rows[0] == [TOKEN_COLUMN, RUN_COLUMN, 'rt']
+        assert [row[2] for row in rows[1:]] == ['1', '2']
+        assert len(set(row[0] for row in rows[1:])) == 2
+    finally:
+        server.shutdown()
@@ -0,0 +1,75 @@
+import os
+import pytest
+import serve
+from resource_server import send_offloaded, OFFLOAD_MODES
+from conftest import STUDY
+
+
+@pytest.fixture(params=OFFLOAD_MODES)
+def client(request, monkeypatch):
+    monkeypatch.setattr(serve, 'OFFLOAD_MODE', request.param)
+    app = request.getfixturevalue('app')
+    app.extensions['exp_server'].get_experiment(STUDY).start_run(
+        access_type='anyone')
+    with open(os.path.join('study', STUDY, 'resources', 'x.png'), 'wb') as f:
+        f.write(b'png data')
+    return app.test_client()
+
+
+def check_offloaded(response, location, root, path):
+    assert response.status_code == 200
+    assert response.data == b''
+    if serve.OFFLOAD_MODE == 'x-accel-redirect':
+        assert response.headers['X-Accel-Redirect'] == location + path
+        assert 'X-Sendfile' not in response.headers
+    else:
+        assert response.headers['X-Sendfile'] == \
+            os.path.abspath(os.path.join(root, path))
+        assert 'X-Accel-Redirect' not in response.headers
+
+
+def test_study_files(client):
+    r = client.get('/study/{}/resources/x.png'.format(STUDY))
+    check_offloaded(r, serve.OFFLOAD_STUDY_LOCATION, serve.STUDY_PATH,
+        '{}/resources/x.png'.format(STUDY))
+    assert r.mimetype == 'image/png'
+    r = client.get('/study/{}/exp.js'.format(STUDY))
+    check_offloaded(r, serve.OFFLOAD_STUDY_LOCATION, serve.STUDY_PATH,
+        '{}/exp.js'.format(STUDY))
+
+
+def test_library_files(client):
+    r = client.get('/study/{}/js/core.js'.format(STUDY))
+    check_offloaded(r, serve.OFFLOAD_LIB_LOCATION,
+        os.path.dirname(serve.__file__), 'js/wrapper_core.js')
+    assert r.headers['Cache-Control'] == serve.REVALIDATE_CACHE_CONTROL
+    r = client.get('/study/{}/js/core-3.0.0b11.js'.format(STUDY))
+    assert r.headers['Cache-Control'] == serve.IMMUTABLE_CACHE_CONTROL
+
+
+def test_missing_and_traversal(client):
+    for path in ['resources/nope.png', 'resources/../exp.js',
+            'resources/%2e%2e/%2e%2e/{}/exp.js'.format(STUDY),
+            'js/..%2f..%2fserve.py']:
+        r = client.get('/study/{}/{}'.format(STUDY, path))
+        assert r.status_code == 404
+        assert 'X-Accel-Redirect' not in r.headers
+        assert 'X-Sendfile' not in r.headers
+
+
+@pytest.mark.parametrize('mode', OFFLOAD_MODES)
+def test_send_offloaded_rejects_traversal(tmp_path, mode):
+    os.makedirs(str(tmp_path / 'root' / 'study'))
+    (tmp_path / 'root' / 'study' / 'ok.txt').write_text('ok')
+    (tmp_path / 'secret.txt').write_text('secret')
+    root = str(tmp_path / 'root')
+    assert send_offloaded(mode, root, '/_o/', 'study', 'ok.txt') is not None
+    for path in ['../../secret.txt', '../study/../../secret.txt',
+            str(tmp_path / 'secret.txt'), 'missing.txt']:
+        assert send_offloaded(mode, root, '/_o/', 'study', path) is None
+
+
+def test_unknown_mode(tmp_path):
+    (tmp_path / 'ok.txt').write_text('ok')
+    with pytest.raises(ValueError):
+        send_offloaded('x-bogus', str(tmp_path), '/_o/', '', 'ok.txt')
@@ -0,0 +1,109 @@
+import os
+import pytest
+from werkzeug.http import http_date
+from conftest import STUDY
+
+SIZE = 1000
+
+
+@pytest.fixture
+def client(app):
+    app.extensions['exp_server'].get_experiment(STUDY).start_run(
+        access_type='anyone')
+    with open(os.path.join('study', STUDY, 'resources', 'x.bin'), 'wb') as f:
+        f.write(bytes(range(256)) * 3 + bytes(SIZE - 768))
+    return app.test_client()
+
+
+def get(client, **headers):
+    return client.get('/study/{}/resources/x.bin'.format(STUDY),
+        headers=headers)
+
+
+def data():
+    with open(os.path.join('study', STUDY, 'resources', 'x.bin'), 'rb') as f:
+        return f.read()
+
+
+def test_whole_file(client):
+    r = get(client)
+    assert r.status_code == 200
+    assert r.data == data()
+    assert r.headers['Accept-Ranges'] == 'bytes'
+    assert r.headers['Content-Length'] == str(SIZE)
+    assert r.headers['ETag']
+
+
+def test_single_range(client):
+    r = get(client, Range='bytes=10-19')
+    assert r.status_code == 206
+    assert r.data == data()[10:20]
+    assert r.headers['Content-Range'] == 'bytes 10-19/{}'.format(SIZE)
+    assert r.headers['Content-Length'] == '10'
+
+
+def test_open_ended_range(client):
+    r = get(client, Range='bytes=990-')
+    assert r.status_code == 206
+    assert r.data == data()[990:]
+    assert r.headers['Content-Range'] == 'bytes 990-999/{}'.format(SIZE)
+
+
+def test_suffix_range(client):
+    r = get(client, Range='bytes=-10')
+    assert r.status_code == 206
+    assert r.data == data()[-10:]
+    assert r.headers['Content-Range'] == 'bytes 990-999/{}'.format(SIZE)
+
+
+def test_range_past_the_end_is_clipped(client):
+    r = get(client, Range='bytes=995-5000')
+    assert r.status_code == 206
+    assert r.data == data()[995:]
+
+
+def test_unsatisfiable_range(client):
+    r = get(client, Range='bytes=5000-6000')
+    assert r.status_code == 416
+    assert r.headers['Content-Range'] == 'bytes */{}'.format(SIZE)
+    assert r.data == b''
+
+
+def test_multiple_ranges_send_whole_file(client):
+    r = get(client, Range='bytes=0-1,5-6')
+    assert r.status_code == 200
+    assert r.data == data()
+
+
+def test_if_range(client):
+    etag = get(client).headers['ETag']
+    r = get(client, Range='bytes=0-9', **{'If-Range': etag})
+    assert r.status_code == 206
+    assert r.data == data()[:10]
+    # The client's copy is out of date: send all of it
+    r = get(client, Range='bytes=0-9', **{'If-Range': '"stale"'})
+    assert r.status_code == 200
+    assert r.data == data()
+    r = get(client, Range='bytes=0-9', **{'If-Range': http_date(0)})
+    assert r.status_code == 200
+    r = get(client, Range='bytes=0-9',
+        **{'If-Range': get(client).headers['Last-Modified']})
+    assert r.status_code == 206
+
+
+def test_not_modified(client):
+    r = get(client)
+    assert get(client, **{'If-None-Match': r.headers['ETag']}).status_code \
+        == 304
+    assert get(client, **{'If-Modified-Since': r.headers['Last-Modified']}) \
+        .status_code == 304
+    assert get(client, **{'If-None-Match': '"stale"'}).status_code == 200
+
+
+def test_missing_and_traversal(client):
+    assert client.get('/study/{}/resources/nope.bin'.format(STUDY)) \
+        .status_code == 404
+    assert client.get('/study/{}/resources/../exp.js'.format(STUDY)) \
+        .status_code == 404
+    assert client.get('/study/{}/resources/%2e%2e/exp.js'.format(STUDY)) \
+        .status_code == 404
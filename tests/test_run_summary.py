@@ -0,0 +1,115 @@
+import math
+import os
+import pytest
+from conftest import STUDY, restart, run_session
+from run_summary import RunSummary
+
+
+@pytest.fixture
+def summary(tmp_path):
+    return RunSummary(str(tmp_path / 'run_1' / 'summary.json'), ['cond'])
+
+
+def group_report(report, cond):
+    return next(group for group in report['groups']
+        if group['values'] == [cond])
+
+
+def test_aggregates_per_group(summary):
+    summary.add_session('1', {'cond': 'a'}, True, 10.0)
+    summary.add_session('2', {'cond': 'a'}, True, 20.0)
+    summary.add_session('3', {'cond': 'a'}, False, 99.0)
+    summary.add_session('4', {'cond': 'b'}, False, 5.0)
+    summary.add_rows('1', 'data.csv', {'cond': 'a'}, [
+        {'rt': '0.5', 'word': 'x'}, {'rt': '1.5', 'word': 'nan'}])
+    summary.add_rows('2', 'data.csv', {'cond': 'a'}, [
+        {'rt': '1.0', 'word': 'inf'}])
+
+    report = summary.get_report()
+    assert report['sessions'] == 4
+    assert report['complete'] == 2
+    assert report['completion_rate'] == 0.5
+    assert report['columns'] == ['rt']
+    a = group_report(report, 'a')
+    assert (a['sessions'], a['complete']) == (3, 2)
+    assert a['completion_rate'] == pytest.approx(2 / 3)
+    # Only completed sessions' durations count
+    assert a['duration']['n'] == 2
+    assert a['duration']['mean'] == 15.0
+    assert a['duration']['sd'] == 5.0
+    assert a['columns']['rt'] == {'n': 3, 'mean': 1.0,
+        'sd': pytest.approx(math.sqrt(1 / 6)), 'min': 0.5, 'max': 1.5}
+    b = group_report(report, 'b')
+    assert b['completion_rate'] == 0.0
+    assert b['duration'] is None
+    assert b['columns'] == {}
+    # Overall durations merge the groups'
+    assert report['duration']['mean'] == 15.0
+
+
+def test_replayed_updates_count_once(summary):
+    summary.add_session('1', {'cond': 'a'}, True, 10.0)
+    summary.add_rows('1', 'data.csv', {'cond': 'a'}, [{'rt': '1'}])
+    report = summary.get_report()
+    seq = summary.seq
+
+    summary.add_session('1', {'cond': 'a'}, True, 10.0)
+    summary.add_rows('1', 'data.csv', {'cond': 'a'}, [{'rt': '1'}])
+    assert summary.seq == seq
+    assert summary.get_report() is report
+    # Another file of the session still counts
+    summary.add_rows('1', 'more.csv', {'cond': 'a'}, [{'rt': '3'}])
+    assert group_report(summary.get_report(), 'a')['columns']['rt']['n'] \
+        == 2
+
+
+def test_rerecorded_data_counts_once(exp_server):
+    exp = exp_server.get_experiment(STUDY)
+    exp.start_run(session_args={'cond': 'uniform(a)'})
+    session = run_session(exp_server, 'u1', {'data.csv': 'rt\n2\n'})
+    exp_server.flush_writes(STUDY)
+    summary = exp.get_run_summary(exp.run)
+    report = summary.get_report()
+    assert report['sessions'] == 1
+    assert group_report(report, 'a')['columns']['rt']['n'] == 1
+
+    # As when the write is replayed
+    exp.run.record_written(session.token, ['data.csv'],
+        session_args={'cond': 'a'})
+    assert summary.get_report() == report
+    assert os.path.exists(summary.path)
+
+
+def test_sessions_after_a_restart_are_counted(exp_server):
+    exp = exp_server.get_experiment(STUDY)
+    exp.start_run(session_args={'cond': 'uniform(a)'})
+    first = run_session(exp_server, 'u1', {'data.csv': 'rt\n2\n'})
+    run_session(exp_server, 'u2', complete=False)
+    server = restart(exp_server)
+    try:
+        exp = server.get_experiment(STUDY)
+        second = run_session(server, 'u3', {'data.csv': 'rt\n4\n'})
+        server.flush_writes(STUDY)
+        assert int(second.token) > int(first.token) + 1
+        report = exp.get_run_summary(exp.run).get_report()
+        assert report['sessions'] == 3
+        assert report['complete'] == 2
+        assert group_report(report, 'a')['columns']['rt']['mean'] == 3.0
+        assert exp.run.num_sessions == 2
+    finally:
+        server.shutdown()
+
+
+def test_session_tokens_survive_lost_metadata(exp_server):
+    # Sessions written after the metadata was last saved, as after a crash
+    exp = exp_server.get_experiment(STUDY)
+    exp.start_run()
+    saved = exp.meta_to_dict()
+    session = run_session(exp_server, 'u1', {'data.csv': 'rt\n2\n'})
+    exp_server.flush_writes(STUDY)
+    exp.load_meta(saved)
+    assert exp.run.next_session_token == int(session.token)
+    # From the summary alone
+    exp.write_log.max_tokens.clear()
+    exp.load_meta(saved)
+    assert exp.run.next_session_token == int(session.token)
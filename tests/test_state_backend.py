@@ -0,0 +1,34 @@
+import sqlite3
+from state_backend import SqliteStateBackend, SERVER_KEY
+
+
+def test_sqlite_round_trip(tmp_path):
+    db_path = str(tmp_path / 'state.db')
+    # A database made before the unused indexes were dropped
+    db = sqlite3.connect(db_path)
+    db.execute('CREATE TABLE participant_codes (code TEXT PRIMARY KEY, '
+        'study TEXT NOT NULL, is_secret_url INTEGER NOT NULL, timeout TEXT, '
+        'unique_session INTEGER, session_limit INTEGER, '
+        'session_count INTEGER)')
+    db.execute('CREATE INDEX participant_codes_study '
+        'ON participant_codes (study)')
+    db.commit()
+    db.close()
+
+    backend = SqliteStateBackend(db_path)
+    backend.save_snapshot('s1', {'admins': ['a'], 'next_run_id': 2,
+        'run': {'id': 1, 'num_sessions': 3, 'size': None,
+            'arg_counts': '{"cond": {"x": 1}}'}})
+    backend.append_records('s1', [{'type': 'run_counts', 'run': 1,
+        'num_sessions': 4, 'arg_counts': {'cond': {'x': 2}}}])
+    backend.append_records(SERVER_KEY, [{'type': 'code_added', 'props': {
+        'code': 'c', 'study': 's1', 'timeout': None, 'unique_session': True,
+        'session_limit': 1, 'session_count': 0}}])
+    assert backend.load('s1') == {'admins': ['a'], 'next_run_id': 2,
+        'group': None, 'run': {'id': 1, 'num_sessions': 4, 'size': None,
+            'arg_counts': '{"cond": {"x": 2}}'}}
+    assert [props['code'] for props in
+        backend.load(SERVER_KEY)['participant_codes']] == ['c']
+    assert backend.db.execute('''SELECT name FROM sqlite_master
+        WHERE type = 'index' AND sql IS NOT NULL''').fetchall() == []
+    backend.close()
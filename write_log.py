@@ -0,0 +1,111 @@
+import datetime
+import json
+import threading
+from journal import write_file_atomic
+from logger import log
+
+
+class WriteLog():
+    # Append-only list of the data files written for a study, one JSON line
+    # per file, numbered with a sequence that only goes up:
+    #   {"seq": 12, "run": 1, "token": "5", "file": "run_1/x.csv",
+    #    "time": "2020-05-01T12:00:00"}
+    # A sequence number works as an export cursor: everything after it was
+    # written since. Users' cursors are kept in a separate file.
+
+    def __init__(self, path, cursors_path):
+        self.path = path
+        self.cursors_path = cursors_path
+        self.lock = threading.Lock()
+        # Byte offset of each record; record n (seq n + 1) starts at
+        # offsets[n]
+        self.offsets = []
+        # Run id -> highest (numeric) session token recorded for it
+        self.max_tokens = {}
+        self.load()
+        try:
+            with open(cursors_path) as f:
+                self.cursors = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.cursors = {}
+
+    def load(self):
+        try:
+            with open(self.path, 'r+') as f:
+                end = 0
+                for line in iter(f.readline, ''):
+                    try:
+                        if not line.endswith('\n'):
+                            raise ValueError()
+                        record = json.loads(line)
+                    except ValueError:
+                        # Interrupted append; cut it off
+                        log('Dropping partial record in {}'.format(self.path))
+                        f.truncate(end)
+                        break
+                    self.offsets.append(end)
+                    self.note_token(record['run'], record['token'])
+                    end = f.tell()
+        except FileNotFoundError:
+            pass
+
+    def note_token(self, run_id, token):
+        if str(token).isdigit():
+            self.max_tokens[run_id] = max(
+                self.max_tokens.get(run_id, 0), int(token))
+
+    def get_max_token(self, run_id):
+        with self.lock:
+            return self.max_tokens.get(run_id, 0)
+
+    def get_cursor(self):
+        # The latest sequence number
+        return len(self.offsets)
+
+    def record(self, run_id, token, files):
+        time = datetime.datetime.now().isoformat()
+        with self.lock, open(self.path, 'a') as f:
+            self.note_token(run_id, token)
+            for file in files:
+                self.offsets.append(f.tell())
+                f.write(json.dumps({
+                    'seq': len(self.offsets),
+                    'run': run_id,
+                    'token': token,
+                    'file': file,
+                    'time': time
+                }) + '\n')
+
+    def read(self, after=0, run=None, since=None, until=None):
+        # Records with a sequence number above `after`, optionally only for
+        # one run or written in a time window (ISO format times).
+        # Returns them with the cursor to pass next time.
+        with self.lock:
+            cursor = len(self.offsets)
+            if after >= cursor:
+                return ([], cursor)
+            start = self.offsets[max(after, 0)]
+        records = []
+        with open(self.path) as f:
+            f.seek(start)
+            for _ in range(cursor - max(after, 0)):
+                record = json.loads(f.readline())
+                if run is not None and record['run'] != run:
+                    continue
+                # ISO format times compare correctly as strings
+                if (since is not None and record['time'] < since) or \
+                        (until is not None and record['time'] >= until):
+                    continue
+                records.append(record)
+        return (records, cursor)
+
+    def get_user_cursor(self, user):
+        with self.lock:
+            return self.cursors.get(user, 0)
+
+    def set_user_cursor(self, user, cursor):
+        with self.lock:
+            if cursor <= self.cursors.get(user, 0):
+                return
+            self.cursors[user] = cursor
+            write_file_atomic(self.cursors_path, json.dumps(self.cursors))